@@ -0,0 +1,151 @@
+"""
+Controle de admissão (load shedding) das mensagens que vão para a IA.
+
+Quando a OpenAI fica lenta, as mensagens se acumulam mais rápido do que são respondidas.
+Aqui o processo limita o trabalho aceito: no máximo ADMISSION_MAX_IN_FLIGHT mensagens
+sendo processadas e ADMISSION_MAX_BACKLOG esperando vaga, repartidas entre as classes de
+prioridade pelos pesos (ver scheduling.py), que também definem quem recebe a próxima vaga.
+Acima do limite da classe a mensagem não é admitida: vai para o armazenamento durável (adiada) e, com ADMISSION_OVERLOAD_ACTION=canned,
+o cliente recebe uma resposta pronta avisando que será atendido em instantes. As adiadas são
+readmitidas quando a fila cai para metade do limite.
+
+Como a espera na fila é limitada, a latência das mensagens admitidas fica limitada
+(≈ (backlog / in-flight + 1) × tempo de resposta), mesmo com sobrecarga de 10× (ver
+`python benchmarks.py overload` e `python benchmarks.py priority`).
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import ADMISSION_ADMITTED, ADMISSION_SHED, ADMISSION_IN_FLIGHT, ADMISSION_BACKLOG, JOB_LATENCY
+from scheduling import PRIORITY_DIRECT, PRIORITY_WEIGHTS, WeightedFairQueue
+
+logger = logging.getLogger(__name__)
+
+ADMISSION_MAX_IN_FLIGHT = int(os.getenv('ADMISSION_MAX_IN_FLIGHT', 8))
+ADMISSION_MAX_BACKLOG = int(os.getenv('ADMISSION_MAX_BACKLOG', 32))
+# "defer": só adia; "canned": adia e envia ADMISSION_CANNED_REPLY
+ADMISSION_OVERLOAD_ACTION = os.getenv('ADMISSION_OVERLOAD_ACTION', 'canned').lower()
+ADMISSION_OVERLOAD_ACTIONS = ('defer', 'canned')
+ADMISSION_CANNED_REPLY = os.getenv(
+    'ADMISSION_CANNED_REPLY',
+    "Recebemos sua mensagem! 🙏 Estamos com muitos atendimentos agora e responderemos em instantes."
+)
+# Uma resposta pronta por cliente nesse intervalo (não repete a cada mensagem)
+ADMISSION_CANNED_COOLDOWN_SECONDS = float(os.getenv('ADMISSION_CANNED_COOLDOWN_SECONDS', 300))
+ADMISSION_RESUME_INTERVAL_SECONDS = float(os.getenv('ADMISSION_RESUME_INTERVAL_SECONDS', 5))
+_CANNED_MEMORY = 10000
+
+
+class AdmissionController:
+    """
+    Limita as mensagens admitidas e não concluídas deste processo. try_admit() decide na
+    chegada (sem bloquear); run() ocupa uma das max_in_flight vagas durante o processamento.
+    As vagas livres vão para a próxima mensagem da fila justa ponderada entre as classes
+    (ordem de chegada dentro de cada classe). Um threading.Semaphore não serviria: threads
+    novas passam na frente e a espera das antigas deixa de ser limitada.
+
+    O backlog é repartido entre as classes pelos pesos: um grupo que inunda a fila dele
+    não faz as conversas diretas serem recusadas.
+    """
+
+    def __init__(self, max_in_flight: int = ADMISSION_MAX_IN_FLIGHT, max_backlog: int = ADMISSION_MAX_BACKLOG,
+                 weights: dict = None):
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_backlog = max(0, max_backlog)
+        weights = dict(weights or PRIORITY_WEIGHTS)
+        total_weight = sum(weights.values())
+        self.backlog_limits = {
+            priority: max(1, round(self.max_backlog * weight / total_weight)) for priority, weight in weights.items()
+        }
+        self._lock = threading.Lock()
+        self._free_slots = self.max_in_flight
+        self._slot_waiters = WeightedFairQueue(weights)
+        self.waiting = {priority: 0 for priority in weights}
+        self.running = 0
+        self.admitted = 0
+        self.shed = 0
+        self._canned_sent = OrderedDict()
+
+    def try_admit(self, priority: str = PRIORITY_DIRECT) -> bool:
+        with self._lock:
+            if self.waiting[priority] >= self.backlog_limits[priority]:
+                self.shed += 1
+                return False
+            self.waiting[priority] += 1
+            self.admitted += 1
+        ADMISSION_ADMITTED.labels(priority=priority).inc()
+        ADMISSION_BACKLOG.labels(priority=priority).inc()
+        return True
+
+    def _acquire_slot(self, priority: str):
+        with self._lock:
+            if self._free_slots > 0 and not len(self._slot_waiters):
+                self._free_slots -= 1
+                return
+            turn = threading.Event()
+            self._slot_waiters.push(priority, turn)
+        turn.wait()
+
+    def _release_slot(self):
+        with self._lock:
+            waiter = self._slot_waiters.pop()
+            if waiter is not None:
+                # Passa a vaga direto para a próxima da fila justa
+                waiter[1].set()
+            else:
+                self._free_slots += 1
+
+    def run(self, fn, job: dict):
+        """Executa fn(job) de uma mensagem admitida, esperando uma vaga de processamento."""
+        priority = job.get("priority", PRIORITY_DIRECT)
+        self._acquire_slot(priority)
+        with self._lock:
+            self.waiting[priority] -= 1
+            self.running += 1
+        ADMISSION_BACKLOG.labels(priority=priority).dec()
+        ADMISSION_IN_FLIGHT.inc()
+        try:
+            return fn(job)
+        finally:
+            with self._lock:
+                self.running -= 1
+            ADMISSION_IN_FLIGHT.dec()
+            self._release_slot()
+            if job.get("received_at"):
+                JOB_LATENCY.labels(priority=priority).observe(time.time() - job["received_at"])
+
+    def has_room_for_deferred(self) -> bool:
+        """Readmite adiadas só com folga (fila abaixo da metade), para não oscilar."""
+        with self._lock:
+            return sum(self.waiting.values()) < self.max_backlog // 2 and self.running < self.max_in_flight
+
+    def should_send_canned(self, jid: str, cooldown: float = ADMISSION_CANNED_COOLDOWN_SECONDS) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            last = self._canned_sent.get(jid)
+            if last is not None and now - last < cooldown:
+                return False
+            self._canned_sent[jid] = now
+            self._canned_sent.move_to_end(jid)
+            while len(self._canned_sent) > _CANNED_MEMORY:
+                self._canned_sent.popitem(last=False)
+            return True
+
+    def record_shed(self, action: str, priority: str = PRIORITY_DIRECT):
+        ADMISSION_SHED.labels(action=action, priority=priority).inc()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "max_in_flight": self.max_in_flight,
+                "max_backlog": self.max_backlog,
+                "in_flight": self.running,
+                "backlog": dict(self.waiting),
+                "backlog_limits": dict(self.backlog_limits),
+                "admitted": self.admitted,
+                "shed": self.shed,
+            }
@@ -7,17 +7,23 @@ Refatorado com LangChain para gerenciamento de IA e memória, AGORA COM SISTEMA
 
 import os
 import requests
-from flask import Flask, request, jsonify
+import openai
+from flask import Flask, request, jsonify, Response
 from dotenv import load_dotenv
 import logging
 import threading
-import shutil # Importar shutil para manipulação de diretórios
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FuturesTimeoutError
+import signal
+import sys
 from flask_cors import CORS # <--- JÁ ESTÁ IMPORTADO, ÓTIMO!
 
 # LangChain Imports
 from langchain_openai import ChatOpenAI, OpenAIEmbeddings # OpenAIEmbeddings precisa ser importado aqui também
 from langchain.memory import ConversationBufferMemory
-from langchain.chains import ConversationChain
+from langchain_community.callbacks import get_openai_callback
+from langchain_core.messages import get_buffer_string
+from langchain_core.prompts import format_document
 from langchain.prompts import PromptTemplate
 
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -26,10 +32,38 @@ from datetime import datetime, timedelta
 from functools import wraps
 
 # RAG Imports
-from langchain_chroma import Chroma
-from langchain.chains import RetrievalQA
 from langchain.schema import Document # Mantido, caso precise explicitamente, mas pode ser removido se não usado
 
+from embedding_pipeline import EMBEDDING_MODEL, CachedQueryEmbeddings
+from vector_index import VECTOR_BACKEND
+from lexical_index import RETRIEVAL_MODE
+from mega_instances import MEGA_INSTANCES, MegaInstanceRouter
+from conversation_affinity import ConversationRouter
+from job_store import PENDING_JOBS_DIRECTORY, PendingJobStore
+from admission import (
+    ADMISSION_MAX_IN_FLIGHT, ADMISSION_OVERLOAD_ACTION, ADMISSION_OVERLOAD_ACTIONS, ADMISSION_CANNED_REPLY,
+    ADMISSION_RESUME_INTERVAL_SECONDS, AdmissionController
+)
+from webhook_parser import KIND_MEDIA, KIND_STATUS, KIND_TEXT, parse_webhook
+from media_pipeline import MEDIA_PIPELINE_ENABLED, MediaPipeline
+from conversation_log import CONVERSATION_LOG_ENABLED, ConversationLog
+from flood_control import FLOOD_COOLDOWN_REPLY, FloodLimiter
+from context_compression import CONTEXT_COMPRESSION_ENABLED, compress_documents
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from deadlines import (
+    DEADLINE_FALLBACK_REPLY, LLM_MAX_RETRIES, LLM_TIMEOUT_SECONDS, RESPONSE_DEADLINE_SECONDS,
+    RETRIEVAL_DEADLINE_SECONDS, DeadlineExceeded, LatencyTracker, call_with_deadline, hedged_call
+)
+from model_routing import MODEL_FAST, ModelRouter
+from token_budget import PromptPart, TokenBudget, TokenCounter, TokenLedger
+from scheduling import PRIORITY_DIRECT, PRIORITY_API, PRIORITY_BACKGROUND, priority_for_jid
+import metrics
+from metrics import DEADLINE_EXCEEDED, LATE_REPLIES
+from knowledge_bases import (
+    DEFAULT_KNOWLEDGE_BASE, DEFAULT_PERSIST_DIRECTORY, KnowledgeBaseRegistry,
+    resolve_tenant, validate_metadata_filter, persist_directory_for
+)
+
 # --- INÍCIO DAS CORREÇÕES DE ORDEM ---
 
 # 1. Configuração de Logging: DEVE SER O PRIMEIRO A SER CONFIGURADO
@@ -66,6 +100,7 @@ logger.info(f" Debug - SECRET_KEY: {'***' if SECRET_KEY else 'None'}")
 logger.info(f"🔍 Debug - MEGA_API_BASE_URL: {MEGA_API_BASE_URL}")
 logger.info(f"🔍 Debug - MEGA_API_TOKEN: {'***' if MEGA_API_TOKEN else 'None'}")
 logger.info(f"🔍 Debug - MEGA_INSTANCE_ID: {MEGA_INSTANCE_ID}")
+logger.info(f"🔍 Debug - MEGA_INSTANCES: {list(MEGA_INSTANCES) or 'None'}")
 logger.info(f"🔍 Debug - OPENAI_API_KEY: {'***' if OPENAI_API_KEY else 'None'}")
 
 # Validação das variáveis essenciais: APÓS CARREGAMENTO
@@ -77,6 +112,11 @@ required_vars = {
     'OPENAI_API_KEY': OPENAI_API_KEY
 }
 
+# Com MEGA_INSTANCES (várias instâncias, ver mega_instances.py) a instância única é opcional
+if MEGA_INSTANCES:
+    required_vars.pop('MEGA_API_TOKEN')
+    required_vars.pop('MEGA_INSTANCE_ID')
+
 missing_vars = [var for var, value in required_vars.items() if not value]
 
 if missing_vars:
@@ -84,18 +124,33 @@ if missing_vars:
     logger.error("Certifique-se de que todas as variáveis essenciais estão configuradas corretamente.")
     exit(1)
 
+# Instâncias da MEGA API atendidas por este processo, cada uma com credenciais, pool HTTP,
+# limite de envio e workers próprios
+mega_instances = MegaInstanceRouter(MEGA_INSTANCE_ID, MEGA_API_BASE_URL, MEGA_API_TOKEN, MEGA_INSTANCES)
+logger.info(f"📱 Instâncias MEGA API configuradas: {list(mega_instances.instances)} (padrão: {mega_instances.default_instance_id})")
+
 # --- FIM DAS CORREÇÕES DE ORDEM INICIAIS ---
 
 
 # --- INÍCIO DA CONFIGURAÇÃO DO LANGCHAIN E RAG: MOVIDO PARA CIMA ---
 
 # Configuração do LangChain LLM (ChatOpenAI)
+# Modelo base das cadeias (as respostas saem do modelo escolhido pelo model_router)
 llm = ChatOpenAI(
     api_key=OPENAI_API_KEY,
-    model="gpt-3.5-turbo", # Ou "gpt-4" se preferir e tiver acesso
-    temperature=0.7 # Criatividade da resposta
+    model=MODEL_FAST,
+    temperature=0.7, # Criatividade da resposta
+    timeout=LLM_TIMEOUT_SECONDS,
+    max_retries=LLM_MAX_RETRIES
 )
 
+# Circuit breakers da OpenAI (ver circuit_breaker.py; os da MEGA API ficam em cada instância)
+llm_breaker = CircuitBreaker("llm")
+embeddings_breaker = CircuitBreaker("embeddings")
+
+# Roteador entre o modelo rápido e o avançado, configurados na página "Configuração" do Streamlit
+model_router = ModelRouter(OPENAI_API_KEY)
+
 # Template de prompt personalizado para a IA (original, para fallback e conversação geral)
 prompt_template = PromptTemplate(
     input_variables=["history", "input"],
@@ -110,193 +165,237 @@ Usuário: {input}
 Assistente:"""
 )
 
+# Orçamento de tokens do prompt e consumo por conversa (ver token_budget.py)
+token_budget = TokenBudget(TokenCounter(llm.model_name))
+token_ledger = TokenLedger()
+
 # Dicionário para armazenar memórias por usuário
 user_memories = {}
+# Histórico em disco (ver conversation_log.py): nada é lido aqui, cada conversa é restaurada na primeira mensagem
+conversation_log = ConversationLog().start() if CONVERSATION_LOG_ENABLED else None
 
 def get_user_memory(user_id):
     """Obtém ou cria uma memória para o usuário específico"""
     if user_id not in user_memories:
-        user_memories[user_id] = ConversationBufferMemory(
+        memory = ConversationBufferMemory(
             memory_key="history",
             return_messages=False # Mantenha como False para compatibilidade com o prompt_template
         )
-        logger.info(f"Nova memória criada para o usuário: {user_id}")
+        turns = conversation_log.restore(user_id) if conversation_log else []
+        for user_message, ai_response in turns:
+            memory.chat_memory.add_user_message(user_message)
+            memory.chat_memory.add_ai_message(ai_response)
+        user_memories[user_id] = memory
+        logger.info(f"Nova memória criada para o usuário: {user_id} ({len(turns)} trocas restauradas do disco)")
     return user_memories[user_id]
 
-# Variáveis globais para o sistema RAG
-PERSIST_DIRECTORY = "./chroma_db"
-RAG_ENABLED = False
-rag_chain = None
-vectorstore = None
+# Bases de conhecimento (ver knowledge_bases.py). Cada instância do WhatsApp pode ter a sua;
+# a base padrão (PERSIST_DIRECTORY, um ponteiro para a versão publicada) atende a API de chat
+# e as instâncias sem base própria. Uma base nunca é apagada aqui: se a nova versão não puder
+# ser carregada, a anterior continua sendo servida.
+PERSIST_DIRECTORY = DEFAULT_PERSIST_DIRECTORY
 
-def initialize_vectorstore():
-    """Inicializa o vectorstore com verificação de compatibilidade de embeddings."""
-    global RAG_ENABLED, rag_chain, vectorstore # Declarar como globais para modificar
-    
-    try:
-        # Usar o mesmo modelo de embedding do seu código principal
-        # 'text-embedding-ada-002' tem 1536 dimensões. Se seu ChromaDB foi criado com 384,
-        # ele precisa ser recriado ou o modelo precisa ser ajustado (ex: text-embedding-3-small com dimensions=384).
-        embeddings_model = OpenAIEmbeddings(
-            model="text-embedding-ada-002", # Mantendo o modelo original que você usava
-            openai_api_key=os.getenv('OPENAI_API_KEY')
-        )
-        
-        vectorstore_recreated = False
-        if os.path.exists(PERSIST_DIRECTORY) and os.listdir(PERSIST_DIRECTORY):
-            try:
-                logger.info("Tentando carregar ChromaDB existente...")
-                temp_vectorstore = Chroma(
-                    persist_directory=PERSIST_DIRECTORY,
-                    embedding_function=embeddings_model
-                )
-                # Forçar uma busca para verificar compatibilidade
-                # Isso pode falhar se a dimensão for incompatível
-                temp_vectorstore.similarity_search("teste", k=1) 
-                logger.info("✅ ChromaDB carregado com sucesso!")
-                vectorstore = temp_vectorstore
-            except Exception as e:
-                logger.warning(f"⚠️ ChromaDB existente é incompatível ou corrupto: {e}. Removendo e recriando.")
-                if os.path.exists(PERSIST_DIRECTORY):
-                    shutil.rmtree(PERSIST_DIRECTORY) # Remove o diretório problemático
-                vectorstore_recreated = True
-                vectorstore = Chroma(
-                    persist_directory=PERSIST_DIRECTORY,
-                    embedding_function=embeddings_model
-                )
-        else:
-            logger.warning("⚠️ Nenhuma base de conhecimento (chroma_db) encontrada. Criando nova.")
-            vectorstore_recreated = True
-            vectorstore = Chroma(
-                persist_directory=PERSIST_DIRECTORY,
-                embedding_function=embeddings_model
-            )
+# Usar o mesmo modelo de embedding usado na ingestão (EMBEDDING_MODEL).
+# O cache de perguntas permite ao MMR reaproveitar o vetor da busca.
+embeddings_model = CachedQueryEmbeddings(OpenAIEmbeddings(
+    model=EMBEDDING_MODEL,
+    openai_api_key=os.getenv('OPENAI_API_KEY')
+), breaker=embeddings_breaker)
+knowledge_bases = KnowledgeBaseRegistry(llm, embeddings_model)
 
-        # Verifica e carrega documentos se a base de dados estiver vazia ou foi recriada
-        if vectorstore_recreated or (vectorstore and vectorstore._collection.count() == 0):
-            logger.info("📚 NOTA: A base de conhecimento foi recriada ou está vazia. Por favor, use a interface Streamlit para fazer o upload de documentos.")
-            # Se você tiver um método programático para carregar documentos aqui, adicione-o.
-            # Ex:
-            # from langchain_community.document_loaders import TextLoader
-            # from langchain.text_splitter import RecursiveCharacterTextSplitter
-            # loader = TextLoader("path/to/your/initial_document.txt")
-            # documents = loader.load()
-            # text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-            # chunks = text_splitter.split_documents(documents)
-            # vectorstore.add_documents(chunks)
-
-        if vectorstore and vectorstore._collection.count() > 0:
-            doc_count = vectorstore._collection.count()
-            logger.info(f"📚 Base de conhecimento: {doc_count} documentos carregados.")
-            retriever = vectorstore.as_retriever(
-                search_type="similarity",
-                search_kwargs={"k": 3}
-            )
-            rag_chain = RetrievalQA.from_chain_type(
-                llm=llm,
-                chain_type="stuff",
-                retriever=retriever,
-                return_source_documents=True
-            )
-            RAG_ENABLED = True
-            logger.info("🧠 Sistema RAG ativado e pronto!")
-        else:
-            RAG_ENABLED = False
-            rag_chain = None
-            logger.warning("⚠️ ChromaDB vazio ou sem documentos. RAG desativado.")
-
-    except Exception as e:
-        logger.error(f"❌ Erro ao inicializar ChromaDB: {e}", exc_info=True)
-        RAG_ENABLED = False
-        rag_chain = None
-    finally:
-        logger.info(f"Status final do RAG: {'Ativado' if RAG_ENABLED else 'Desativado'}")
+def default_knowledge_base():
+    """Base padrão carregada (ou None). Recarrega se uma nova versão foi publicada."""
+    return knowledge_bases.get(DEFAULT_KNOWLEDGE_BASE)
 
+# Carrega a base padrão já na inicialização
+RAG_ENABLED = default_knowledge_base() is not None
+if not RAG_ENABLED:
+    logger.warning("⚠️ Nenhuma base de conhecimento padrão (chroma_db). Use a interface Streamlit para fazer o upload de documentos.")
+logger.info(f"Status final do RAG: {'Ativado' if RAG_ENABLED else 'Desativado'}")
 
-# NOVO: Chamada para inicializar o vectorstore globalmente
-initialize_vectorstore()
 
 # --- FIM DA CONFIGURAÇÃO DO LANGCHAIN E RAG ---
 
 
 # --- FUNÇÕES AUXILIARES ---
 
-def generate_ai_response(message_text: str, user_id: str) -> str:
+AI_ERROR_REPLY = "Desculpe, não consegui gerar uma resposta no momento. Por favor, tente novamente mais tarde."
+
+# Etapas com prazo (busca, chamadas à IA e suas cópias) rodam aqui; ver deadlines.py
+stage_executor = ThreadPoolExecutor(max_workers=ADMISSION_MAX_IN_FLIGHT * 4, thread_name_prefix="ai-stage")
+# Respostas completas: continuam depois do aviso de prazo para a resposta atrasada ser enviada.
+# Quem espera cada uma ocupa uma vaga da admissão até ela terminar, então bastam ADMISSION_MAX_IN_FLIGHT.
+response_executor = ThreadPoolExecutor(max_workers=ADMISSION_MAX_IN_FLIGHT, thread_name_prefix="ai-response")
+llm_latencies = LatencyTracker()
+
+def generate_ai_response(message_text: str, user_id: str, instance_id: str = None,
+                         knowledge_base_name: str = None, metadata_filter: dict = None) -> str:
     """
     Gera uma resposta da IA usando o LangChain.
     Prioriza o sistema RAG se ativado e houver contexto relevante.
     Caso contrário, usa a cadeia de conversação padrão.
+    A base de conhecimento e o filtro de metadados vêm da instância (ver knowledge_bases.KB_TENANTS),
+    a menos que knowledge_base_name / metadata_filter sejam informados.
     """
     try:
         logger.info(f"Gerando resposta IA para a mensagem de '{user_id}': '{message_text[:100]}...'")
 
         memory = get_user_memory(user_id) # Obter memória específica do usuário
         final_response = ""
-        used_rag = False # Flag para saber se o RAG foi a fonte da resposta
 
         # --- 1. Tentar responder com RAG ---
-        # Garante que RAG_ENABLED e rag_chain estejam definidos globalmente pela initialize_vectorstore()
-        if RAG_ENABLED and rag_chain:
+        tenant_knowledge_base, tenant_filter = resolve_tenant(instance_id)
+        # Base já marcada em uso: descarregada (LRU) ou substituída por outra thread antes ou
+        # durante a busca, ela só é fechada quando retrieve_documents a libera
+        knowledge_base = knowledge_bases.acquire(knowledge_base_name or tenant_knowledge_base)
+        current_rag_chain = None
+        if knowledge_base:
             try:
-                logger.info(f"📖 Tentando recuperar informações da base de conhecimento para '{user_id}'...")
-                rag_result = rag_chain.invoke({"query": message_text})
-
-                rag_answer = rag_result.get("result", "")
-                sources = rag_result.get("source_documents", [])
+                current_rag_chain = knowledge_base.rag_chain(metadata_filter or tenant_filter)
+            except Exception:
+                knowledge_base.release()
+                raise
+        if current_rag_chain:
+            try:
+                logger.info(f"📖 Tentando recuperar informações da base de conhecimento '{knowledge_base.name}' para '{user_id}'...")
+                # Recuperação e geração separadas (em vez de current_rag_chain.invoke) para
+                # comprimir os trechos e ajustá-los ao orçamento (os de pior colocação saem primeiro)
+                documents = call_with_deadline(
+                    stage_executor, lambda: retrieve_documents(knowledge_base, current_rag_chain, message_text),
+                    RETRIEVAL_DEADLINE_SECONDS, "retrieval"
+                )
+                if CONTEXT_COMPRESSION_ENABLED:
+                    documents = compress_documents(message_text, documents)
+                combine_chain = current_rag_chain.combine_documents_chain
+                question, parts, token_report = token_budget.fit(
+                    combine_chain.llm_chain.prompt.format(context="", question=""),
+                    message_text,
+                    [PromptPart("context", document.page_content, -rank, document) for rank, document in enumerate(documents)]
+                )
+                sources = [Document(page_content=part.text, metadata=part.payload.metadata) for part in parts]
+                # Mesmo prompt da cadeia "stuff", mas no modelo escolhido pelo roteador
+                context = combine_chain.document_separator.join(
+                    format_document(source, combine_chain.document_prompt) for source in sources
+                )
+                rag_answer = invoke_routed_llm(
+                    user_id, "rag", combine_chain.llm_chain.prompt.format_prompt(context=context, question=question),
+                    token_report, message_text, retrieval_hit=bool(sources)
+                )
 
                 # Critério para decidir se a resposta RAG é "útil"
                 # Uma resposta é considerada útil se houver fontes e a resposta não for genérica de "não encontrei"
                 if sources and len(rag_answer) > 50 and "não encontrei informações" not in rag_answer.lower() and "não consigo responder" not in rag_answer.lower():
                     final_response = rag_answer
-                    used_rag = True
                     logger.info(f"📖 RAG encontrou {len(sources)} documentos relevantes e gerou uma resposta útil: '{final_response[:100]}...'")
                 else:
                     logger.info("⚠️ RAG ativado, mas nenhum documento relevante ou resposta útil encontrada para esta consulta.")
+            except DeadlineExceeded as e:
+                logger.warning(f"⏱️ Consulta RAG para '{user_id}' abandonada: {e}. Prosseguindo para conversação padrão.")
             except Exception as e:
                 logger.error(f"Erro na consulta RAG para '{user_id}': {e}", exc_info=True)
                 logger.info("⚠️ Falha na consulta RAG. Prosseguindo para conversação padrão.")
         else:
             logger.info("❌ Sistema RAG desativado ou não inicializado. Prosseguindo para conversação padrão.")
 
-        # --- 2. Se RAG não gerou uma resposta útil, usar a ConversationChain padrão ---
+        # --- 2. Se RAG não gerou uma resposta útil, usar a conversa com histórico ---
         if not final_response:
-            logger.info("💬 Usando ConversationChain padrão para gerar resposta.")
-            # A ConversationChain já gerencia a memória automaticamente com o prompt_template padrão.
-            conversation_chain_instance = ConversationChain( # Renomeado para evitar conflito com 'conversation' global se definido
-                llm=llm,
-                memory=memory,
-                prompt=prompt_template, # Usa o prompt_template original (apenas history e input)
-                verbose=True
+            logger.info("💬 Usando conversação padrão (histórico + prompt_template) para gerar resposta.")
+            # O histórico entra no prompt_template como a ConversationChain montava; as trocas
+            # mais antigas saem primeiro quando o prompt passa do orçamento
+            messages = memory.chat_memory.messages
+            turns = [messages[i:i + 2] for i in range(0, len(messages), 2)]
+            user_input, parts, token_report = token_budget.fit(
+                prompt_template.format(history="", input=""),
+                message_text,
+                [PromptPart("history", get_buffer_string(turn), age) for age, turn in enumerate(turns)]
+            )
+            prompt = prompt_template.format(history="\n".join(part.text for part in parts), input=user_input)
+            final_response = invoke_routed_llm(
+                user_id, "conversation", prompt, token_report, message_text, history_turns=len(turns)
             )
-            final_response = conversation_chain_instance.predict(input=message_text)
 
-        # --- 3. Atualizar memória manualmente se a resposta veio do RAG ---
-        # Se a resposta final veio do RAG (e não da ConversationChain), precisamos adicionar
-        # a interação (input do usuário e output do RAG) à memória para manter o histórico.
-        # A ConversationChain.predict() já faz isso automaticamente.
-        if used_rag:
-            memory.save_context({"input": message_text}, {"output": final_response})
-            logger.info("Memória atualizada manualmente com entrada e saída RAG para manter histórico.")
+        # --- 3. Atualizar a memória com a interação ---
+        # O histórico completo fica guardado; o orçamento só limita o que vai em cada prompt.
+        memory.save_context({"input": message_text}, {"output": final_response})
+        if conversation_log:
+            conversation_log.append(user_id, message_text, final_response)
 
         logger.info(f"Resposta da IA gerada para '{user_id}': '{final_response[:100]}...'")
         return final_response
 
+    except CircuitOpenError:
+        # Quem chamou adia a mensagem até a OpenAI voltar
+        raise
     except Exception as e:
         logger.error(f"Erro ao gerar resposta da IA para '{user_id}': {e}", exc_info=True)
-        return "Desculpe, não consegui gerar uma resposta no momento. Por favor, tente novamente mais tarde."
+        return AI_ERROR_REPLY
 
-def send_whatsapp_message(phone_number: str, message: str) -> bool:
+def retrieve_documents(knowledge_base, rag_chain, message_text: str):
+    """Busca na base pega com knowledge_bases.acquire() e a libera no fim (mesmo passado o prazo)."""
+    try:
+        return rag_chain.retriever.invoke(message_text)
+    finally:
+        knowledge_base.release()
+
+def invoke_routed_llm(user_id: str, kind: str, prompt, token_report: dict, message_text: str,
+                      retrieval_hit: bool = False, history_turns: int = 0) -> str:
+    """Chama o modelo do nível escolhido pelo roteador (ver model_routing.py) e registra o consumo."""
+    tier, tier_llm = model_router.route(message_text, retrieval_hit=retrieval_hit, history_turns=history_turns)
+
+    def call():
+        # O callback de uso vale só na thread em que a chamada roda
+        started = time.perf_counter()
+        with get_openai_callback() as usage:
+            response = tier_llm.invoke(prompt).content
+        return response, usage, time.perf_counter() - started
+
+    # Com a OpenAI fora do ar, falha na hora (CircuitOpenError) em vez de esperar o timeout
+    llm_breaker.check()
+    try:
+        (response, usage, seconds), winner = hedged_call(
+            stage_executor, call, LLM_TIMEOUT_SECONDS, llm_latencies.hedge_delay(tier_llm.model_name), stage=kind
+        )
+    except Exception as e:
+        # Erros 4xx são do pedido (prompt recusado pela política de conteúdo, contexto longo
+        # demais, modelo inválido na configuração), não da disponibilidade da OpenAI: um usuário
+        # ou uma configuração ruim não abre o breaker de todas as conversas. 429 conta.
+        request_error = isinstance(e, openai.APIStatusError) and e.status_code < 500 and e.status_code != 429
+        llm_breaker.record(not request_error)
+        raise
+    llm_breaker.record_success()
+    llm_latencies.record(tier_llm.model_name, seconds)
+    model_router.record(tier, tier_llm.model_name, seconds, usage.total_cost)
+    record_token_usage(user_id, kind, token_report, usage, response)
+    return response
+
+def record_token_usage(user_id: str, kind: str, token_report: dict, usage, response: str):
+    """Registra os tokens de uma chamada (os da OpenAI; a contagem local se ela não informar)."""
+    prompt_tokens = usage.prompt_tokens or token_report["prompt"]
+    completion_tokens = usage.completion_tokens or token_budget.counter.count(response)
+    token_ledger.record(user_id, kind, prompt_tokens, completion_tokens, usage.total_cost)
+    logger.info(
+        f"🔢 Tokens ({kind}) de '{user_id}': prompt {prompt_tokens}, resposta {completion_tokens}. "
+        f"Partes do prompt: {token_report}"
+    )
+
+def send_whatsapp_message(phone_number: str, message: str, instance_id: str = None) -> bool:
     """
-    Envia uma mensagem de texto para um número de WhatsApp via MEGA API.
+    Envia uma mensagem de texto para um número de WhatsApp via MEGA API, pela instância
+    informada (ou a padrão), respeitando o limite de envios por segundo dela.
     """
+    instance = mega_instances.get(instance_id)
+    if instance is None:
+        logger.error(f"❌ Instância MEGA API '{instance_id}' não configurada. Mensagem para {phone_number} não enviada.")
+        return False
+    # MEGA API fora do ar: falha na hora em vez de esperar o timeout de 15 s
+    if not instance.breaker.allow():
+        logger.error(f"❌ Circuit breaker da instância {instance.instance_id} aberto. Mensagem para {phone_number} não enviada.")
+        return False
+    success = False
+    dependency_failed = False
     try:
         # CONSTRUÇÃO DA URL CORRETA COM BASE NA DOCUMENTAÇÃO (SUA ORIGINAL)
-        url = f"{MEGA_API_BASE_URL}/rest/sendMessage/{MEGA_INSTANCE_ID}/text"
-
-        headers = {
-            'Authorization': f'Bearer {MEGA_API_TOKEN}',
-            'Content-Type': 'application/json'
-        }
+        url = instance.url("sendMessage", "text")
 
         formatted_phone_number = phone_number
         if not ("@s.whatsapp.net" in phone_number or "@g.us" in phone_number):
@@ -309,9 +408,14 @@ def send_whatsapp_message(phone_number: str, message: str) -> bool:
             }
         }
 
+        if not instance.acquire_send_slot():
+            logger.error(f"❌ Limite de envios da instância {instance.instance_id} esgotado. Mensagem para {formatted_phone_number} descartada.")
+            return False
+
         logger.info(f"Tentando enviar mensagem para {formatted_phone_number} via MEGA API (URL: {url})")
         logger.debug(f"Payload: {payload}")
-        response = requests.post(url, json=payload, headers=headers, timeout=15)
+        # Sessão da instância: credenciais nos headers e conexões reaproveitadas
+        response = instance.session.post(url, json=payload, timeout=15)
 
         response.raise_for_status()
 
@@ -321,84 +425,246 @@ def send_whatsapp_message(phone_number: str, message: str) -> bool:
             return False
 
         logger.info(f"Mensagem enviada com sucesso para {formatted_phone_number}. Status HTTP: {response.status_code}, Resposta da API: {response_json}")
+        success = True
         return True
 
     except requests.exceptions.RequestException as e:
         logger.error(f"Erro de requisição ao enviar mensagem para {phone_number} via MEGA API: {e}", exc_info=True)
         if hasattr(e, 'response') and e.response is not None:
             logger.error(f"Resposta de erro da API: {e.response.text}")
+        # Erros 4xx são do pedido (número inválido etc.), não da disponibilidade da API
+        dependency_failed = e.response is None or e.response.status_code >= 500
         return False
     except Exception as e:
         logger.error(f"Erro inesperado ao enviar mensagem via MEGA API: {e}", exc_info=True)
         return False
-
-def process_message_async(phone_full_jid: str, message_text: str, sender_name: str):
+    finally:
+        instance.record_send(success)
+        instance.breaker.record(dependency_failed)
+
+# Última resposta pendente de cada conversa: uma resposta atrasada sai antes da resposta
+# à mensagem seguinte do mesmo remoteJid
+_reply_turns_lock = threading.Lock()
+_reply_turns = {}
+
+def take_reply_turn(phone_full_jid: str):
+    """(evento da resposta anterior ou None, evento desta resposta), na ordem de chegada."""
+    turn = threading.Event()
+    with _reply_turns_lock:
+        previous = _reply_turns.get(phone_full_jid)
+        _reply_turns[phone_full_jid] = turn
+    return previous, turn
+
+def finish_reply_turn(phone_full_jid: str, turn: threading.Event):
+    turn.set()
+    with _reply_turns_lock:
+        if _reply_turns.get(phone_full_jid) is turn:
+            del _reply_turns[phone_full_jid]
+
+def process_message_async(phone_full_jid: str, message_text: str, sender_name: str, instance_id: str = None):
     """
     Função assíncrona para processar a mensagem do usuário, gerar a resposta da IA e enviá-la.
     Executada em uma thread separada para não bloquear o webhook principal.
     """
+    previous_turn, turn = take_reply_turn(phone_full_jid)
     try:
-        logger.info(f"Iniciando processamento assíncrono da mensagem de {sender_name} ({phone_full_jid}).")
+        logger.info(f"Iniciando processamento assíncrono da mensagem de {sender_name} ({phone_full_jid}, instância {instance_id or 'padrão'}).")
 
         user_id_for_memory = phone_full_jid.replace('@s.whatsapp.net', '').replace('@g.us', '')
+        if instance_id:
+            # O mesmo número pode falar com instâncias (negócios) diferentes: históricos separados
+            user_id_for_memory = f"{instance_id}:{user_id_for_memory}"
+
+        # 1. Gerar resposta com IA (que agora lida com RAG internamente), com prazo: passando
+        # de RESPONSE_DEADLINE_SECONDS o cliente recebe um aviso e a resposta segue depois.
+        # A espera continua neste worker: a vaga da admissão fica ocupada, o drain espera a
+        # resposta atrasada e uma CircuitOpenError no meio dela adia a mensagem.
+        response_future = response_executor.submit(generate_ai_response, message_text, user_id_for_memory, instance_id=instance_id)
+        try:
+            ai_response = response_future.result(timeout=RESPONSE_DEADLINE_SECONDS)
+        except FuturesTimeoutError:
+            DEADLINE_EXCEEDED.labels(stage="response").inc()
+            logger.warning(f"⏱️ Resposta para {phone_full_jid} passou de {RESPONSE_DEADLINE_SECONDS}s. Enviando aviso.")
+            send_whatsapp_message(phone_full_jid, DEADLINE_FALLBACK_REPLY, instance_id)
+            ai_response = response_future.result()
+            if previous_turn is not None:
+                previous_turn.wait()
+            send_late_reply(ai_response, phone_full_jid, instance_id)
+            return
 
-        # 1. Gerar resposta com IA (que agora lida com RAG internamente)
-        ai_response = generate_ai_response(message_text, user_id_for_memory)
+        # Responde na ordem das mensagens: a resposta atrasada da anterior sai antes desta
+        if previous_turn is not None:
+            previous_turn.wait()
 
-        # 2. Enviar resposta de volta ao usuário via MEGA API
-        success = send_whatsapp_message(phone_full_jid, ai_response)
+        # 2. Enviar resposta de volta ao usuário via MEGA API, pela mesma instância
+        success = send_whatsapp_message(phone_full_jid, ai_response, instance_id)
 
         if success:
             logger.info(f"✅ Resposta da IA enviada com sucesso para {phone_full_jid}.")
         else:
             logger.error(f"❌ Falha ao enviar a resposta da IA para {phone_full_jid}.")
 
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"Erro no processamento assíncrono da mensagem: {e}", exc_info=True)
-
-def process_webhook_async_corrected_for_logs(data):
-    """
-    Processa webhook de forma assíncrona. Esta versão é mais robusta
-    na forma como extrai os dados do payload da MEGA API.
-    Utilizada para fins de depuração e compatibilidade com logs anteriores.
-    """
+    finally:
+        finish_reply_turn(phone_full_jid, turn)
+
+def send_late_reply(ai_response: str, phone_full_jid: str, instance_id: str = None):
+    """Envia a resposta que chegou depois do aviso de prazo (erros não são enviados)."""
+    if ai_response == AI_ERROR_REPLY:
+        LATE_REPLIES.labels(result="failed").inc()
+        logger.error(f"❌ A resposta atrasada para {phone_full_jid} falhou; o cliente ficou só com o aviso.")
+        return
+    LATE_REPLIES.labels(result="sent").inc()
+    if send_whatsapp_message(phone_full_jid, ai_response, instance_id):
+        logger.info(f"✅ Resposta atrasada enviada para {phone_full_jid}.")
+
+def process_conversation_job(job: dict):
     try:
-        message_type = data.get('messageType')
-        message_content = None
+        process_message_async(job["jid"], job["text"], job["sender"], job["instance"])
+    except CircuitOpenError as e:
+        # A OpenAI caiu durante o processamento: a mensagem volta para as adiadas
+        shed_conversation_job(job, reason=str(e))
 
-        if message_type == 'conversation':
-            message_content = data.get('message', {}).get('conversation')
-        elif message_type == 'textMessage':
-            message_content = data.get('message', {}).get('text')
+def run_admitted_job(job: dict):
+    admission.run(process_conversation_job, job)
 
-        is_from_me = data.get('key', {}).get('fromMe', False)
-
-        if not message_content or is_from_me:
-            logger.info(f"Webhook (process_webhook_async_corrected_for_logs) ignorado (messageType: {message_type}, fromMe: {is_from_me}, hasContent: {bool(message_content)})")
+def shed_conversation_job(job: dict, reason: str = "sobrecarga"):
+    """
+    Sobrecarga ou dependência fora do ar: a mensagem é adiada no armazenamento durável, sem
+    iniciar trabalho da IA, e (ADMISSION_OVERLOAD_ACTION=canned) o cliente recebe uma resposta pronta.
+    """
+    action = "defer" if job.get("deferred") else ADMISSION_OVERLOAD_ACTION
+    deferred_jobs.save([dict(job, deferred=True)], reason=reason)
+    if action == "canned" and admission.should_send_canned(job["jid"]):
+        canned_reply_executor.submit(send_whatsapp_message, job["jid"], ADMISSION_CANNED_REPLY, job["instance"])
+    admission.record_shed(action, job.get("priority", PRIORITY_DIRECT))
+    logger.warning(f"⚠️ Mensagem de {job['jid']} adiada ({reason}, {action}). {admission.stats()}")
+
+def enqueue_conversation_job(job: dict):
+    """Enfileira nos workers da instância uma mensagem cuja conversa pertence a este processo."""
+    if mega_instances.get(job["instance"]) is None:
+        logger.warning(f"Mensagem de instância não configurada descartada: {job['instance']}")
+        return
+    if "media" in job:
+        # Download e processamento fora daqui (ver media_pipeline.py): o texto extraído
+        # volta para esta função como uma mensagem de texto comum
+        media_pipeline.submit(job)
+        return
+    # Adiadas por sobrecarga já passaram pelo limite do remetente
+    if not job.get("deferred"):
+        decision, job = flood_limiter.check(job)
+        if decision != "allow":
             return
-
-        sender_full_jid = data.get('key', {}).get('remoteJid', '')
-        sender_name = data.get('pushName', 'Usuário')
-
-        if not sender_full_jid:
-            logger.warning("JID do remetente não encontrado no webhook.")
+    admit_conversation_job(job)
+
+def admit_conversation_job(job: dict):
+    instance = mega_instances.get(job["instance"])
+    if instance is None:
+        return
+    # Jobs antigos (gravados antes das classes de prioridade) recebem a classe pelo JID
+    job.setdefault("priority", priority_for_jid(job["jid"]))
+    # OpenAI ou a instância fora do ar: adia em vez de ocupar um worker até o timeout
+    for breaker in (llm_breaker, instance.breaker):
+        if breaker.is_open():
+            shed_conversation_job(job, reason=f"circuit breaker '{breaker.name}' aberto")
             return
+    if not admission.try_admit(job["priority"]):
+        shed_conversation_job(job)
+        return
+    # Workers da instância: uma instância sobrecarregada não atrasa as outras
+    if instance.submit(job, run_admitted_job) is None:
+        # Desligamento em andamento: fica para o próximo processo
+        pending_jobs.save([job], reason="recebido durante o desligamento")
+
+# Mensagens não respondidas no desligamento, retomadas pelo próximo processo
+pending_jobs = PendingJobStore()
+
+# Controle de admissão (ver admission.py): limita o trabalho aceito e adia o excedente
+if ADMISSION_OVERLOAD_ACTION not in ADMISSION_OVERLOAD_ACTIONS:
+    raise ValueError(f"ADMISSION_OVERLOAD_ACTION inválido: '{ADMISSION_OVERLOAD_ACTION}' (opções: {', '.join(ADMISSION_OVERLOAD_ACTIONS)})")
+admission = AdmissionController()
+deferred_jobs = PendingJobStore(os.path.join(PENDING_JOBS_DIRECTORY, "deferred"))
+# Respostas prontas de sobrecarga saem fora dos workers das instâncias (que estão cheios)
+canned_reply_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="canned-reply")
+
+# Limite por remetente (ver flood_control.py): checado aqui, no worker dono do remoteJid, que
+# vê todas as mensagens da conversa. As mensagens juntadas seguem direto para a admissão.
+flood_limiter = FloodLimiter(
+    on_flush=admit_conversation_job,
+    notify=lambda job: canned_reply_executor.submit(send_whatsapp_message, job["jid"], FLOOD_COOLDOWN_REPLY, job["instance"])
+)
 
-        user_id_for_memory = sender_full_jid.replace('@s.whatsapp.net', '').replace('@g.us', '')
-
-        logger.info(f"Processando mensagem (process_webhook_async_corrected_for_logs) de {sender_name} ({user_id_for_memory}): '{message_content}'")
-
-        ai_response = generate_ai_response(message_content, user_id_for_memory)
+# Mídias recebidas: baixadas e processadas fora dos workers das instâncias
+media_pipeline = MediaPipeline(mega_instances, on_done=enqueue_conversation_job)
 
-        success = send_whatsapp_message(sender_full_jid, ai_response)
+# Tarefas de fundo (resumos, re-embedding) disputam as vagas da IA com a menor prioridade
+background_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="background")
 
-        if success:
-            logger.info(f"✅ Resposta da IA enviada com sucesso para {sender_full_jid}.")
-        else:
-            logger.error(f"❌ Falha ao enviar a resposta da IA para {sender_full_jid}.")
+def submit_background_job(name: str, fn):
+    """
+    Agenda fn() como tarefa de fundo: ela espera uma vaga de processamento na classe
+    "background" (ver scheduling.py), sem atrasar as conversas. Retorna o Future, ou None se
+    a fila de fundo estiver cheia.
+    """
+    if not admission.try_admit(PRIORITY_BACKGROUND):
+        logger.warning(f"⚠️ Fila de tarefas de fundo cheia. Tarefa '{name}' não agendada.")
+        return None
+    job = {"name": name, "priority": PRIORITY_BACKGROUND, "received_at": time.time()}
+    return background_executor.submit(admission.run, lambda _job: fn(), job)
+
+def resume_deferred_jobs():
+    """Readmite as mensagens adiadas por sobrecarga quando a fila esvazia."""
+    while not _drained:
+        time.sleep(ADMISSION_RESUME_INTERVAL_SECONDS)
+        try:
+            # Com a OpenAI fora do ar as adiadas voltariam direto para o armazenamento
+            if admission.has_room_for_deferred() and not llm_breaker.is_open():
+                for job in deferred_jobs.claim(limit=max(1, admission.max_backlog // 2)):
+                    conversation_router.dispatch(job)
+        except Exception as e:
+            logger.error(f"Erro ao retomar mensagens adiadas: {e}", exc_info=True)
+# Prazo para terminar as respostas em andamento ao desligar (menor que o graceful_timeout do gunicorn)
+DRAIN_TIMEOUT_SECONDS = float(os.getenv('DRAIN_TIMEOUT_SECONDS', 25))
+_drain_lock = threading.Lock()
+_drained = False
 
-    except Exception as e:
-        logger.error(f"Erro no processamento assíncrono do webhook (process_webhook_async_corrected_for_logs): {e}", exc_info=True)
+def drain(timeout: float = DRAIN_TIMEOUT_SECONDS):
+    """
+    Desligamento gracioso: para de aceitar jobs, espera as respostas em andamento até o
+    prazo e grava as restantes para o próximo processo. Chamado pelo hook worker_exit do
+    gunicorn (gunicorn.conf.py) ou pelo SIGTERM no servidor de desenvolvimento.
+    """
+    global _drained
+    with _drain_lock:
+        if _drained:
+            return
+        _drained = True
+    # Conversas repassadas por outros workers passam a ser processadas por eles
+    conversation_router.close()
+    report = mega_instances.drain(timeout)
+    pending_jobs.save(report.pop("leftover_jobs"), reason="drain")
+    # Mídias ainda não baixadas: o próximo processo recomeça pelo download
+    pending_jobs.save(media_pipeline.shutdown(), reason="drain (mídias)")
+    if conversation_log:
+        conversation_log.close()
+    report.update({"pid": os.getpid(), "finished_at": datetime.now().isoformat()})
+    pending_jobs.write_drain_report(report)
+    logger.info(
+        f"🛑 Drain concluído em {report['duration_seconds']}s: {report['completed']} respostas concluídas, "
+        f"{report['abandoned']} abandonadas (gravadas para o próximo processo)."
+    )
+
+# Cada remoteJid tem um worker dono, onde fica a memória da conversa
+conversation_router = ConversationRouter(enqueue_conversation_job)
+conversation_router.start()
+
+# Retoma as mensagens que o processo anterior não conseguiu responder
+for pending_job in pending_jobs.claim():
+    conversation_router.dispatch(pending_job)
+threading.Thread(target=resume_deferred_jobs, name="resume-deferred", daemon=True).start()
 
 
 # --- FIM DAS FUNÇÕES AUXILIARES ---
@@ -409,15 +675,9 @@ def process_webhook_async_corrected_for_logs(data):
 @app.route('/')
 def home():
     """Endpoint de teste para verificar se o Flask está rodando."""
-    doc_count = 0
-    # A variável vectorstore agora é global e deveria estar acessível aqui
-    if RAG_ENABLED and vectorstore: # Verifica se vectorstore foi inicializado com sucesso
-        try:
-            collection = vectorstore._collection
-            doc_count = collection.count()
-        except Exception as e:
-            logger.warning(f"Não foi possível obter a contagem de documentos para o endpoint home: {e}")
-            doc_count = "unknown"
+    # Contagem registrada ao carregar a versão da base padrão (vale para qualquer VECTOR_BACKEND)
+    knowledge_base = default_knowledge_base()
+    doc_count = knowledge_base.document_count if knowledge_base else 0
 
     # A data e hora devem ser geradas dinamicamente
     # datetime já está importado do topo, não precisa de 'import datetime' aqui
@@ -428,8 +688,9 @@ def home():
         "status": "success",
         "message": "WhatsApp AI Agent está rodando!",
         "version": "1.0",
-        "rag_enabled": RAG_ENABLED,
+        "rag_enabled": knowledge_base is not None,
         "documents_in_chromadb": doc_count,
+        "vector_backend": VECTOR_BACKEND,
         "current_time_utc": now_utc.strftime("%d/%m/%Y %H:%M:%S (UTC)"),
         "current_time_brasília": now_brt.strftime("%d/%m/%Y %H:%M:%S (UTC-3)")
     })
@@ -440,35 +701,73 @@ def webhook():
     Endpoint principal para receber notificações (webhooks) da MEGA API.
     """
     try:
-        data = request.get_json()
-        if data is None:
+        body = request.get_data()
+        if not body:
             logger.warning("Webhook recebido sem dados JSON.")
             return jsonify({"status": "error", "message": "No JSON data"}), 400
-
-        logger.info(f"Webhook recebido: {data}")
-
-        if (data and
-            data.get('messageType') == 'conversation' and
-            data.get('message', {}).get('conversation') and
-            data.get('key', {}).get('remoteJid') and
-            not data.get('key', {}).get('fromMe', False)):
-
-            phone_full_jid = data['key']['remoteJid']
-            message_text = data['message']['conversation']
-            sender_name = data.get('pushName', 'Usuário')
-
-            logger.info(f"Mensagem de texto válida recebida de {sender_name} ({phone_full_jid}): '{message_text}'")
-
-            thread = threading.Thread(
-                target=process_message_async,
-                args=(phone_full_jid, message_text, sender_name)
-            )
-            thread.start()
+        try:
+            # Uma passada sobre o JSON para todos os tipos de evento (ver webhook_parser.py)
+            inbound = parse_webhook(body)
+        except ValueError as e:
+            logger.warning(f"Webhook com JSON inválido: {e}")
+            return jsonify({"status": "error", "message": "Invalid JSON data"}), 400
+
+        logger.info(f"Webhook recebido: {inbound}")
+
+        if inbound.kind == KIND_TEXT:
+            # Instância da MEGA API que recebeu a mensagem: escolhe a base de conhecimento
+            if mega_instances.get(inbound.instance) is None:
+                logger.warning(f"Webhook de instância não configurada ignorado: {inbound.instance}")
+                return jsonify({"status": "ignored", "message": "Instância não configurada."}), 200
+
+            logger.info(f"Mensagem de texto válida recebida de {inbound.sender} ({inbound.jid}, instância {inbound.instance or 'padrão'}): '{inbound.text}'")
+
+            # A conversa é processada pelo worker dono do remoteJid (ver conversation_affinity.py)
+            conversation_router.dispatch({
+                "jid": inbound.jid,
+                "text": inbound.text,
+                "sender": inbound.sender,
+                "instance": inbound.instance,
+                "priority": priority_for_jid(inbound.jid),
+                "received_at": time.time()
+            })
 
             return jsonify({"status": "received", "message": "Mensagem recebida e em processamento"}), 200
 
+        elif inbound.kind == KIND_MEDIA and MEDIA_PIPELINE_ENABLED:
+            if mega_instances.get(inbound.instance) is None:
+                logger.warning(f"Webhook de instância não configurada ignorado: {inbound.instance}")
+                return jsonify({"status": "ignored", "message": "Instância não configurada."}), 200
+
+            logger.info(f"Mídia ({inbound.media_type}) recebida de {inbound.sender} ({inbound.jid}, instância {inbound.instance or 'padrão'}).")
+
+            # Mesmo caminho do texto até o worker dono do remoteJid, que agenda a mídia
+            conversation_router.dispatch({
+                "jid": inbound.jid,
+                "text": inbound.text or "",
+                "sender": inbound.sender,
+                "instance": inbound.instance,
+                "priority": priority_for_jid(inbound.jid),
+                "received_at": time.time(),
+                "media": {
+                    "media_type": inbound.media_type,
+                    "caption": inbound.text,
+                    "media_url": inbound.media_url,
+                    "media_key": inbound.media_key,
+                    "mimetype": inbound.mimetype,
+                    "file_name": inbound.file_name,
+                    "file_length": inbound.file_length,
+                }
+            })
+
+            return jsonify({"status": "received", "message": "Mídia recebida e em processamento"}), 200
+
+        elif inbound.kind == KIND_STATUS:
+            logger.debug(f"Atualização de status {inbound.status} da mensagem {inbound.message_id} ({inbound.jid}).")
+            return jsonify({"status": "ignored", "message": "Atualização de status."}), 200
+
         else:
-            logger.info(f"Webhook ignorado (não é uma mensagem de texto para processamento de IA ou é uma mensagem própria): {data.get('messageType', 'Tipo Desconhecido')}")
+            logger.info(f"Webhook ignorado (não é uma mensagem de texto para processamento de IA ou é uma mensagem própria): {inbound.message_type or 'Tipo Desconhecido'}")
             return jsonify({"status": "ignored", "message": "Payload não é uma mensagem de texto para processamento de IA ou é uma mensagem própria."}), 200
 
     except Exception as e:
@@ -483,11 +782,12 @@ def health_check():
     mega_api_status = "disconnected"
     mega_api_response_detail = "N/A"
     try:
-        test_url = f"{MEGA_API_BASE_URL}/rest/instance/{MEGA_INSTANCE_ID}/status"
-        headers = {
-            'Authorization': f'Bearer {MEGA_API_TOKEN}'
-        }
-        response = requests.get(test_url, headers=headers, timeout=5)
+        # Conectividade verificada pela instância padrão; as demais aparecem em "mega_instances"
+        instance = mega_instances.get()
+        if instance is None:
+            raise requests.exceptions.RequestException("nenhuma instância padrão (defina MEGA_INSTANCE_ID)")
+        test_url = instance.url("instance", "status")
+        response = instance.session.get(test_url, timeout=5)
         if response.status_code == 200:
             mega_api_status = "connected"
             mega_api_response_detail = response.json()
@@ -500,24 +800,44 @@ def health_check():
         mega_api_response_detail = str(e)
         logger.error(f"Falha ao conectar com MEGA API durante o health check: {e}", exc_info=True)
 
-    doc_count = 0
-    if RAG_ENABLED and vectorstore: # Usando vectorstore que é global
-        try:
-            collection = vectorstore._collection
-            doc_count = collection.count()
-        except Exception as e:
-            logger.warning(f"Não foi possível obter a contagem de documentos para o health check: {e}")
-            doc_count = "unknown"
+    knowledge_base = default_knowledge_base()
+    doc_count = knowledge_base.document_count if knowledge_base else 0
 
     return jsonify({
         "status": "healthy",
         "flask_app": "running",
         "mega_api_connectivity": mega_api_status,
         "mega_api_response_detail": mega_api_response_detail,
-        "rag_enabled": RAG_ENABLED,
-        "documents_in_chromadb": doc_count
+        "mega_instances": mega_instances.stats(),
+        "conversation_affinity": conversation_router.stats(),
+        "last_drain": pending_jobs.read_drain_report(),
+        "admission": admission.stats(),
+        "flood_control": flood_limiter.stats(),
+        "token_usage": token_ledger.stats(),
+        "model_routing": model_router.stats(),
+        "media_pipeline": media_pipeline.stats(),
+        "conversation_log": conversation_log.stats() if conversation_log else None,
+        "circuit_breakers": {
+            breaker.name: breaker.stats()
+            for breaker in [llm_breaker, embeddings_breaker] + [instance.breaker for instance in mega_instances.instances.values()]
+        },
+        "rag_enabled": knowledge_base is not None,
+        "documents_in_chromadb": doc_count,
+        "vector_backend": VECTOR_BACKEND,
+        "retrieval_mode": RETRIEVAL_MODE,
+        "knowledge_base_version": knowledge_base.version_hash if knowledge_base else None,
+        "knowledge_bases_loaded": {
+            name: {"documents": kb.document_count, "version": kb.version_hash}
+            for name, kb in knowledge_bases.loaded().items()
+        }
     })
 
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Métricas Prometheus (admissão, sobrecarga, latência das respostas)."""
+    body, content_type = metrics.render()
+    return Response(body, mimetype=content_type)
+
 @app.route('/test_mega_api_send', methods=['POST'])
 def test_mega_api_send():
     """
@@ -527,6 +847,7 @@ def test_mega_api_send():
     data = request.get_json()
     test_phone = data.get('phone')
     test_message = data.get('message')
+    test_instance_id = data.get('instance_id')
 
     if not test_phone or not test_message:
         return jsonify({"status": "error", "message": "Parâmetros 'phone' e 'message' são obrigatórios"}), 400
@@ -538,7 +859,7 @@ def test_mega_api_send():
     else:
         test_phone_formatted = test_phone
 
-    success = send_whatsapp_message(test_phone_formatted, test_message)
+    success = send_whatsapp_message(test_phone_formatted, test_message, test_instance_id)
 
     if success:
         return jsonify({"status": "success", "message": f"Mensagem de teste enviada para {test_phone}"}), 200
@@ -557,10 +878,30 @@ def api_chat():
         
         user_message = data['message']
         logger.info(f"📩 Mensagem recebida via API: {user_message}")
+
+        # Opcionais: instância (usa a base dela), base explícita e filtro {"tag"/"source": valor}
+        instance_id = data.get('instance_id')
+        knowledge_base_name = data.get('knowledge_base')
+        try:
+            if knowledge_base_name:
+                persist_directory_for(knowledge_base_name)
+            metadata_filter = validate_metadata_filter(data.get('filter'))
+        except ValueError as e:
+            return jsonify({"status": "error", "message": str(e)}), 400
         
         # Processa a mensagem usando a mesma lógica do webhook
         # generate_ai_response já inclui a lógica RAG e de conversação padrão
-        response_text = generate_ai_response(user_message, "api_user")
+        # Testes pela API passam pela admissão na classe "api": não tiram a vez dos clientes
+        if not admission.try_admit(PRIORITY_API):
+            return jsonify({"status": "error", "message": ADMISSION_CANNED_REPLY}), 503
+        job = {"priority": PRIORITY_API, "received_at": time.time()}
+        response_text = admission.run(lambda _job: generate_ai_response(
+            user_message,
+            f"{instance_id}:api_user" if instance_id else "api_user",
+            instance_id=instance_id,
+            knowledge_base_name=knowledge_base_name,
+            metadata_filter=metadata_filter
+        ), job)
         
         return jsonify({
             "status": "success",
@@ -569,6 +910,8 @@ def api_chat():
             "timestamp": datetime.now().isoformat()
         })
         
+    except CircuitOpenError as e:
+        return jsonify({"status": "error", "message": str(e)}), 503
     except Exception as e:
         logger.error(f"Erro no endpoint /api/chat: {e}", exc_info=True)
         return jsonify({"status": "error", "message": "Erro interno do servidor"}), 500
@@ -715,4 +1058,10 @@ if __name__ == '__main__':
 
     logger.info(f"Iniciando WhatsApp AI Agent na porta {port} (Debug: {debug})")
     logger.info(f"🧠 Sistema RAG: {'✅ Ativado' if RAG_ENABLED else '❌ Desativado'}")
+
+    def _handle_sigterm(signum, frame):
+        drain()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, _handle_sigterm)
+
     app.run(host='0.0.0.0', port=port, debug=debug)
\ No newline at end of file
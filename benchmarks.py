@@ -0,0 +1,560 @@
+#!/usr/bin/env python3
+"""
+Benchmarks do WhatsApp AI Agent.
+Rodam offline (sem chamadas à OpenAI ou à MEGA API), usando embeddings falsos e dados sintéticos.
+
+Uso:
+    python benchmarks.py streaming-ingest [--pages 2000] [--max-memory-mb 64]
+    python benchmarks.py vector-backends [--sizes 1000,10000,50000] [--queries 200] [--dimension 1536]
+    python benchmarks.py quantization [--corpus 20000] [--queries 200] [--dimension 1536] [--min-recall 0.95]
+    python benchmarks.py overload [--overload 10] [--service-ms 50] [--duration 3]
+    python benchmarks.py priority [--overload 10] [--service-ms 50] [--duration 3] [--instance-concurrency 4]
+    python benchmarks.py context-compression [--corpus 20000] [--queries 200] [--min-reduction 0.5]
+    python benchmarks.py webhook-parser [--iterations 20000]
+    python benchmarks.py conversation-log [--conversations 1000,20000] [--turns 10]
+"""
+
+import os
+import sys
+import time
+import hashlib
+import argparse
+import threading
+import tempfile
+import tracemalloc
+
+import numpy as np
+
+
+# --- DADOS SINTÉTICOS E DUBLÊS ---
+
+class FakeEmbeddings:
+    """Embeddings determinísticos (hash do texto), sem rede. Mesma interface do OpenAIEmbeddings."""
+
+    def __init__(self, dimension: int = 1536):
+        self.dimension = dimension
+        self._base = [((i * 37) % 256) / 255.0 - 0.5 for i in range(dimension)]
+
+    def _vector(self, text: str):
+        shift = int.from_bytes(hashlib.sha256(text.encode("utf-8")).digest()[:4], "big") % self.dimension
+        return self._base[shift:] + self._base[:shift]
+
+    def embed_documents(self, texts):
+        return [self._vector(text) for text in texts]
+
+    def embed_query(self, text):
+        return self._vector(text)
+
+
+class NullCollection:
+    """Coleção que só conta o que recebe (para medir o pipeline sem o custo do Chroma)."""
+
+    def __init__(self):
+        self.stored = 0
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.stored += len(ids)
+
+    def get(self, ids=None, include=None):
+        return {"ids": []}
+
+    def delete(self, ids=None):
+        pass
+
+    def count(self):
+        return self.stored
+
+
+def _pdf_escape(text: str) -> str:
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_synthetic_pdf(path: str, pages: int, lines_per_page: int = 40):
+    """Gera um PDF de texto com o número de páginas pedido, escrevendo objeto a objeto (sem dependências)."""
+    offsets = {}
+    page_ids = [4 + 2 * i for i in range(pages)]
+    with open(path, "wb") as f:
+        def write_object(obj_id, body: bytes):
+            offsets[obj_id] = f.tell()
+            f.write(f"{obj_id} 0 obj\n".encode("latin-1") + body + b"\nendobj\n")
+
+        f.write(b"%PDF-1.4\n")
+        write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        kids = " ".join(f"{page_id} 0 R" for page_id in page_ids)
+        write_object(2, f"<< /Type /Pages /Kids [{kids}] /Count {pages} >>".encode("latin-1"))
+        write_object(3, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>")
+        for i, page_id in enumerate(page_ids):
+            lines = [
+                f"Pagina {i + 1}, linha {n + 1}: produto COD-{i:05d}-{n:02d} custa R$ {(i * 7 + n) % 500},90 no catalogo."
+                for n in range(lines_per_page)
+            ]
+            text_ops = " ".join(f"({_pdf_escape(line)}) Tj T*" for line in lines)
+            content = f"BT /F1 9 Tf 11 TL 36 806 Td {text_ops} ET".encode("latin-1")
+            write_object(page_id, (
+                f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 595 842] "
+                f"/Resources << /Font << /F1 3 0 R >> >> /Contents {page_id + 1} 0 R >>"
+            ).encode("latin-1"))
+            write_object(page_id + 1, f"<< /Length {len(content)} >>\nstream\n".encode("latin-1") + content + b"\nendstream")
+
+        xref_offset = f.tell()
+        total_objects = 3 + 2 * pages
+        f.write(f"xref\n0 {total_objects + 1}\n0000000000 65535 f \n".encode("latin-1"))
+        for obj_id in range(1, total_objects + 1):
+            f.write(f"{offsets[obj_id]:010d} 00000 n \n".encode("latin-1"))
+        f.write(f"trailer\n<< /Size {total_objects + 1} /Root 1 0 R >>\nstartxref\n{xref_offset}\n%%EOF\n".encode("latin-1"))
+    return path
+
+
+# --- BENCHMARKS ---
+
+def bench_streaming_ingest(args) -> bool:
+    """Ingestão em fluxo de um PDF sintético grande sob um teto fixo de memória (pico do tracemalloc)."""
+    from ingestion import iter_chunks, ingest_incremental
+
+    with tempfile.TemporaryDirectory() as workdir:
+        pdf_path = write_synthetic_pdf(os.path.join(workdir, "catalogo.pdf"), args.pages)
+        size_mb = os.path.getsize(pdf_path) / 1024 / 1024
+        print(f"PDF sintético: {args.pages} páginas, {size_mb:.1f} MB")
+
+        collection = NullCollection()
+        tracemalloc.start()
+        started = time.perf_counter()
+        stats = ingest_incremental(
+            iter_chunks([pdf_path], max_workers=1),
+            collection,
+            FakeEmbeddings(),
+            os.path.join(workdir, "kb"),
+        )
+        elapsed = time.perf_counter() - started
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    peak_mb = peak / 1024 / 1024
+    print(f"Chunks gravados: {stats['added']} em {elapsed:.1f}s")
+    print(f"Pico de memória (tracemalloc): {peak_mb:.1f} MB (teto: {args.max_memory_mb} MB)")
+    return peak_mb <= args.max_memory_mb
+
+
+def _latency_summary(samples) -> str:
+    samples = np.asarray(samples) * 1000
+    return f"p50 {np.percentile(samples, 50):7.2f} ms | p95 {np.percentile(samples, 95):7.2f} ms"
+
+
+def bench_vector_backends(args) -> bool:
+    """Latência do top-k no Chroma x índice NumPy memory-mapped, para vários tamanhos de base."""
+    import chromadb
+    from vector_index import COLLECTION_NAME, build_numpy_index, NumpyVectorIndex
+
+    rng = np.random.default_rng(42)
+    ok = True
+    for size in [int(value) for value in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as workdir:
+            # Normalizados como os embeddings da OpenAI: distância L2 do Chroma e cosseno ordenam igual
+            vectors = rng.standard_normal((size, args.dimension), dtype=np.float32)
+            vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+            collection = chromadb.PersistentClient(path=workdir).get_or_create_collection(COLLECTION_NAME)
+            for start in range(0, size, 5000):
+                end = min(size, start + 5000)
+                collection.add(
+                    ids=[f"chunk-{i}" for i in range(start, end)],
+                    embeddings=vectors[start:end],
+                    documents=[f"documento {i}" for i in range(start, end)],
+                    metadatas=[{"source": "benchmark"} for _ in range(start, end)],
+                )
+            build_numpy_index(workdir)
+            index = NumpyVectorIndex.open(workdir, build_if_missing=False)
+
+            # Consultas próximas de chunks conhecidos (como uma pergunta sobre um trecho da base)
+            targets = rng.integers(0, size, args.queries)
+            queries = vectors[targets] + 0.5 * rng.standard_normal((args.queries, args.dimension), dtype=np.float32) / np.sqrt(args.dimension)
+            chroma_times, numpy_times, overlap, hits = [], [], 0, 0
+            for target, query in zip(targets, queries):
+                started = time.perf_counter()
+                chroma_ids = collection.query(query_embeddings=[query], n_results=args.k, include=[])["ids"][0]
+                chroma_times.append(time.perf_counter() - started)
+
+                started = time.perf_counter()
+                numpy_ids = [index.record(position)["id"] for position, _ in index.search(query, args.k)]
+                numpy_times.append(time.perf_counter() - started)
+                overlap += len(set(chroma_ids) & set(numpy_ids))
+                hits += numpy_ids[0] == f"chunk-{target}"
+            index.close()
+
+        # O NumPy é exato; o Chroma usa HNSW (aproximado), então o recall dele é medido contra o NumPy
+        recall = overlap / (args.queries * args.k)
+        print(f"{size:>8} chunks | chroma {_latency_summary(chroma_times)} (recall@{args.k} {recall:.0%}) | "
+              f"numpy {_latency_summary(numpy_times)}")
+        ok = ok and hits / args.queries >= 0.99
+    return ok
+
+
+def synthetic_embeddings(rng, size: int, dimension: int, clusters: int = 200):
+    """Vetores unitários agrupados em tópicos (mais parecidos com embeddings reais do que ruído puro)."""
+    centers = rng.standard_normal((clusters, dimension), dtype=np.float32)
+    vectors = centers[rng.integers(0, clusters, size)] + rng.standard_normal((size, dimension), dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def bench_quantization(args) -> bool:
+    """Recall@k x memória varrida por consulta para float32 e int8 (com e sem rescoring exato)."""
+    from vector_index import VECTOR_INDEX_DTYPES, NumpyVectorIndex, write_numpy_index
+
+    rng = np.random.default_rng(7)
+    vectors = synthetic_embeddings(rng, args.corpus, args.dimension)
+    queries = vectors[rng.integers(0, args.corpus, args.queries)]
+    queries = queries + 0.5 * rng.standard_normal(queries.shape, dtype=np.float32) / np.sqrt(args.dimension)
+    truth = [set(np.argsort(-(vectors @ query))[:args.k].tolist()) for query in queries]
+
+    ok = True
+    with tempfile.TemporaryDirectory() as workdir:
+        pages = (
+            (
+                [f"chunk-{i}" for i in range(start, min(args.corpus, start + 1000))],
+                vectors[start:start + 1000],
+                ["" for _ in range(start, min(args.corpus, start + 1000))],
+                [{} for _ in range(start, min(args.corpus, start + 1000))],
+            )
+            for start in range(0, args.corpus, 1000)
+        )
+        index_directory = write_numpy_index(os.path.join(workdir, "index"), pages, args.corpus, args.dimension, "float32")
+
+        print(f"Corpus: {args.corpus} × {args.dimension}, {args.queries} consultas, k={args.k}")
+        for dtype in VECTOR_INDEX_DTYPES:
+            rescore_factors = [args.rescore_factor] if dtype == "float32" else [1, args.rescore_factor]
+            for rescore_factor in rescore_factors:
+                index = NumpyVectorIndex(index_directory, dtype=dtype, rescore_factor=rescore_factor)
+                times, found = [], 0
+                for query, expected in zip(queries, truth):
+                    started = time.perf_counter()
+                    result = index.search(query, args.k)
+                    times.append(time.perf_counter() - started)
+                    found += len(expected & {position for position, _ in result})
+                recall = found / (args.queries * args.k)
+                label = "exato" if dtype == "float32" else f"{rescore_factor * args.k} candidatos"
+                print(f"{dtype:>8} ({label:>14}) | {index.scan_bytes / 1024 / 1024:7.1f} MB/consulta | "
+                      f"recall@{args.k} {recall:6.1%} | {_latency_summary(times)}")
+                if rescore_factor == args.rescore_factor:
+                    ok = ok and recall >= args.min_recall
+                index.close()
+    return ok
+
+
+FILLER_SENTENCES = (
+    "Nossa equipe de atendimento responde de segunda a sexta, das 8h às 18h.",
+    "Todos os produtos passam por controle de qualidade antes do envio.",
+    "A garantia cobre defeitos de fabricação, mas não danos causados por mau uso.",
+    "Pedidos feitos até as 14h são separados no mesmo dia.",
+    "O pagamento pode ser feito por Pix, boleto ou cartão de crédito em até 10 vezes.",
+    "Consulte as condições de troca na página de políticas da loja.",
+    "As imagens do catálogo são ilustrativas e podem variar conforme o lote.",
+    "Clientes cadastrados recebem ofertas exclusivas por e-mail e WhatsApp.",
+    "A entrega para regiões remotas pode ter prazo adicional informado no checkout.",
+    "Em caso de dúvida sobre o produto, fale com um consultor antes da compra.",
+    "O manual de instruções acompanha a embalagem e também está disponível no site.",
+    "Promoções não são cumulativas com outros cupons de desconto.",
+)
+
+COMPRESSION_QUESTIONS = (
+    # (fato no chunk, pergunta com as mesmas palavras, pergunta com outras palavras e o código,
+    #  paráfrase sem o código: como o cliente costuma perguntar, quase sem palavras do fato)
+    ("O {code} custa {answer} à vista.", "Quanto custa o {code}?", "Qual o valor do {code}?",
+     "Qual é o preço desse produto?"),
+    ("A entrega do {code} leva {answer} para capitais.", "Qual o prazo de entrega do {code}?",
+     "Em quanto tempo o {code} chega?", "Em quantos dias chega na minha casa?"),
+    ("A garantia do {code} é de {answer} contra defeitos.", "Qual a garantia do {code}?",
+     "Por quanto tempo o {code} é coberto?", "Se quebrar, fico coberto por quanto tempo?"),
+)
+
+
+def compression_fixture(rng, size: int):
+    """Chunks de ~1000 caracteres com um fato sobre um produto no meio de frases genéricas."""
+    chunks = []
+    for i in range(size):
+        kind = int(rng.integers(0, len(COMPRESSION_QUESTIONS)))
+        code = f"PRD-{i:05d}"
+        answer = (f"R$ {rng.integers(100, 5000)},90", f"{rng.integers(2, 15)} dias úteis",
+                  f"{rng.integers(3, 36)} meses")[kind]
+        sentences = [FILLER_SENTENCES[j] for j in rng.permutation(len(FILLER_SENTENCES))[:12]]
+        sentences.insert(int(rng.integers(0, len(sentences))), COMPRESSION_QUESTIONS[kind][0].format(code=code, answer=answer))
+        chunks.append((kind, code, answer, " ".join(sentences)[:1000]))
+    return chunks
+
+
+def bench_context_compression(args) -> bool:
+    """Tokens do contexto x recall da resposta (o fato continua no contexto?) com compressão extrativa."""
+    from langchain_core.documents import Document
+    from context_compression import compress_documents
+    from token_budget import TokenCounter
+
+    rng = np.random.default_rng(11)
+    chunks = compression_fixture(rng, args.corpus // 10)
+    counter = TokenCounter("gpt-3.5-turbo")
+    ok = True
+    print(f"Corpus: {len(chunks)} chunks, {args.queries} perguntas por tipo, k={args.k} chunks por pergunta")
+    for label, question_index in (("mesmas palavras", 1), ("outras + código", 2), ("paráfrase", 3)):
+        before = after = found = 0
+        for position in rng.integers(0, len(chunks), args.queries):
+            kind, code, answer, text = chunks[position]
+            # Recuperação simulada: o chunk certo mais k-1 distratores, em ordem aleatória
+            distractors = [chunks[j][3] for j in rng.choice(len(chunks), args.k - 1, replace=False) if j != position]
+            documents = [Document(page_content=content) for content in [text] + distractors]
+            rng.shuffle(documents)
+            question = COMPRESSION_QUESTIONS[kind][question_index].format(code=code)
+            compressed = compress_documents(question, documents)
+            before += sum(counter.count(document.page_content) for document in documents)
+            after += sum(counter.count(document.page_content) for document in compressed)
+            found += any(answer in document.page_content for document in compressed)
+        reduction = 1 - after / before
+        recall = found / args.queries
+        print(f"{label:16} | tokens do contexto {before / args.queries:6.0f} → {after / args.queries:5.0f} "
+              f"por pergunta ({reduction:5.1%} menos) | recall da resposta {recall:6.1%}")
+        # As paráfrases sem o código medem o limite da compressão léxica (só sobra a sobreposição
+        # de palavras comuns): o recall delas é informado à parte e não entra no critério
+        if question_index < 3:
+            ok = ok and recall >= args.min_recall and reduction >= args.min_reduction
+    return ok
+
+
+def _legacy_webhook_extract(body: bytes):
+    """Extração antiga do webhook(): json da stdlib e .get encadeados, só conversation/textMessage."""
+    import json
+    data = json.loads(body)
+    message_type = data.get('messageType')
+    text = None
+    if message_type == 'conversation':
+        text = data.get('message', {}).get('conversation')
+    elif message_type == 'textMessage':
+        text = data.get('message', {}).get('text')
+    if text and data.get('key', {}).get('remoteJid') and not data.get('key', {}).get('fromMe', False):
+        return (data['key']['remoteJid'], text, data.get('pushName', 'Usuário'),
+                data.get('instance_key') or data.get('instanceKey') or data.get('instance'))
+    return None
+
+
+def bench_webhook_parser(args) -> bool:
+    """Tempo por payload do parser único (orjson, uma passada) x a extração antiga, nos exemplos gravados."""
+    import json
+    from webhook_parser import parse_webhook
+
+    fixtures_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "mega_webhooks.json")
+    with open(fixtures_path, "r", encoding="utf-8") as f:
+        fixtures = json.load(f)
+    bodies = [json.dumps(fixture["payload"], ensure_ascii=False).encode("utf-8") for fixture in fixtures]
+
+    ok = True
+    for fixture, body in zip(fixtures, bodies):
+        record = parse_webhook(body)
+        wrong = {field: getattr(record, field) for field, value in fixture["expected"].items() if getattr(record, field) != value}
+        if wrong:
+            print(f"❌ {fixture['name']}: esperado {fixture['expected']}, obtido {wrong}")
+            ok = False
+    print(f"Exemplos: {len(fixtures)} payloads ({sum(map(len, bodies)) / len(bodies):.0f} bytes em média), "
+          f"{args.iterations} repetições")
+
+    timings = {}
+    for label, fn in (("extração antiga", _legacy_webhook_extract), ("parse_webhook", parse_webhook)):
+        started = time.perf_counter()
+        for _ in range(args.iterations):
+            for body in bodies:
+                fn(body)
+        timings[label] = (time.perf_counter() - started) / (args.iterations * len(bodies))
+        print(f"{label:16} | {timings[label] * 1e6:6.2f} µs/payload")
+    return ok and timings["parse_webhook"] <= timings["extração antiga"]
+
+
+def bench_conversation_log(args) -> bool:
+    """Reinício e primeira restauração com históricos de tamanhos diferentes, e vazão das gravações."""
+    from conversation_log import ConversationLog
+
+    sizes = [int(size) for size in args.conversations.split(",")]
+    results = {}
+    for size in sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            log = ConversationLog(directory, fsync_interval=0.005).start()
+            started = time.perf_counter()
+            for turn in range(args.turns):
+                for conversation in range(size):
+                    log.append(f"5511{conversation:08d}", f"pergunta {turn} sobre o pedido", f"resposta {turn} " * 20)
+            log.flush(timeout=120)
+            write_seconds = time.perf_counter() - started
+            log.compact()
+            # Um segmento ainda não compactado, como depois de um reinício no meio do intervalo
+            for conversation in range(0, size, 10):
+                log.append(f"5511{conversation:08d}", "última pergunta", "última resposta")
+            log.close()
+            fsyncs = log.stats()["fsyncs"]
+
+            started = time.perf_counter()
+            restarted = ConversationLog(directory)
+            startup = time.perf_counter() - started
+            restore_times, restored = [], 0
+            for conversation in range(0, size, max(1, size // 200)):
+                started = time.perf_counter()
+                restored += len(restarted.restore(f"5511{conversation:08d}"))
+                restore_times.append(time.perf_counter() - started)
+            results[size] = (startup, float(np.percentile(restore_times, 50)))
+            print(f"{size:7} conversas × {args.turns} trocas | gravação {size * args.turns / write_seconds:8.0f} trocas/s "
+                  f"({size * args.turns / fsyncs:6.1f} por fsync) | reinício {startup * 1000:6.2f} ms | "
+                  f"1ª restauração p50 {results[size][1] * 1000:6.2f} ms ({restored / len(restore_times):.1f} trocas)")
+    smallest, largest = results[sizes[0]], results[sizes[-1]]
+    # Nada é carregado no reinício: o tempo não cresce com o histórico
+    return largest[0] <= max(5 * smallest[0], 0.05) and largest[1] <= max(5 * smallest[1], 0.02)
+
+
+def _simulate_load(rate: float, duration: float, service_seconds: float, workers: int, admission=None):
+    """
+    Chegadas a `rate` mensagens/s durante `duration` s, processadas por `workers` threads com
+    tempo de serviço fixo (uma resposta da IA simulada). Retorna (latências das admitidas, não admitidas).
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    latencies, shed = [], 0
+    lock = threading.Lock()
+
+    def _serve(job):
+        time.sleep(service_seconds)
+        with lock:
+            latencies.append(time.perf_counter() - job["arrived"])
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        started = time.perf_counter()
+        for i in range(int(rate * duration)):
+            # Chegadas em ritmo constante
+            delay = started + i / rate - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            job = {"arrived": time.perf_counter()}
+            if admission is None:
+                executor.submit(_serve, job)
+            elif admission.try_admit():
+                executor.submit(admission.run, _serve, job)
+            else:
+                shed += 1
+    return latencies, shed
+
+
+def bench_overload(args) -> bool:
+    """Latência das mensagens admitidas sob sobrecarga, com e sem controle de admissão."""
+    from admission import AdmissionController
+
+    service = args.service_ms / 1000
+    capacity = args.in_flight / service
+    rate = capacity * args.overload
+    print(f"Capacidade {capacity:.0f} msg/s ({args.in_flight} em paralelo × {args.service_ms} ms); "
+          f"chegada {rate:.0f} msg/s ({args.overload:g}×) por {args.duration:g} s")
+
+    latencies, _ = _simulate_load(rate, args.duration, service, args.in_flight)
+    print(f"sem admissão  | {len(latencies):5} respondidas | {_latency_summary(latencies)} | máx {max(latencies) * 1000:8.1f} ms")
+
+    admission = AdmissionController(max_in_flight=args.in_flight, max_backlog=args.backlog)
+    latencies, shed = _simulate_load(rate, args.duration, service, args.in_flight + args.backlog, admission)
+    worst = max(latencies)
+    # Pior caso admitido: esperar a fila inteira andar (backlog / paralelismo rodadas) + o próprio serviço
+    bound = (admission.backlog_limits["direct"] / args.in_flight + 1) * service * 1.5
+    print(f"com admissão  | {len(latencies):5} respondidas, {shed} adiadas | {_latency_summary(latencies)} | "
+          f"máx {worst * 1000:8.1f} ms (limite {bound * 1000:.0f} ms)")
+    return worst <= bound
+
+
+def bench_priority(args) -> bool:
+    """
+    Latência das conversas diretas com um grupo inundando o agente, fila única x fila justa
+    ponderada. Os jobs seguem o caminho do webhook: admissão e depois MegaInstance.submit,
+    com os workers da instância (--instance-concurrency) como gargalo, como no padrão.
+    """
+    from admission import AdmissionController
+    from mega_instances import MegaInstance
+
+    service = args.service_ms / 1000
+    capacity = min(args.in_flight, args.instance_concurrency) / service
+    group_rate, direct_rate = capacity * args.overload, capacity * 0.2
+    print(f"Capacidade {capacity:.0f} msg/s; grupo {group_rate:.0f} msg/s ({args.overload:g}×) + diretas {direct_rate:.0f} msg/s "
+          f"por {args.duration:g} s")
+
+    def _run(single_queue: bool):
+        admission = AdmissionController(max_in_flight=args.in_flight, max_backlog=args.backlog)
+        latencies = {"direct": [], "group": []}
+        shed = {"direct": 0, "group": 0}
+        lock = threading.Lock()
+
+        def _serve(job):
+            time.sleep(service)
+            with lock:
+                latencies[job["kind"]].append(time.perf_counter() - job["arrived"])
+
+        # Fila única: tudo na mesma classe, em ordem de chegada (como antes das prioridades)
+        arrivals = sorted(
+            [(i / group_rate, "group") for i in range(int(group_rate * args.duration))] +
+            [(i / direct_rate, "direct") for i in range(int(direct_rate * args.duration))]
+        )
+        instance = MegaInstance("bench", "http://localhost", "token", max_concurrency=args.instance_concurrency)
+        started = time.perf_counter()
+        for offset, kind in arrivals:
+            delay = started + offset - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            priority = "direct" if single_queue else kind
+            job = {"arrived": time.perf_counter(), "kind": kind, "priority": priority}
+            if admission.try_admit(priority):
+                instance.submit(job, lambda admitted: admission.run(_serve, admitted))
+            else:
+                shed[kind] += 1
+        instance.shutdown(wait=True)
+        return latencies, shed
+
+    results = {}
+    for label, single_queue in (("fila única", True), ("fila justa", False)):
+        latencies, shed = _run(single_queue)
+        results[label] = latencies
+        for kind in ("direct", "group"):
+            print(f"{label:10} | {kind:6} | {len(latencies[kind]):5} respondidas, {shed[kind]:5} adiadas | "
+                  f"{_latency_summary(latencies[kind])}")
+    # Com a fila justa, as diretas passam na frente do grupo na fila dos workers da instância e
+    # esperam só ~um worker liberar (com a fila por ordem de chegada na instância, ~3 tempos de resposta)
+    fair_direct = np.percentile(results["fila justa"]["direct"], 95)
+    return fair_direct <= 2.5 * service
+
+
+BENCHMARKS = {
+    "streaming-ingest": bench_streaming_ingest,
+    "vector-backends": bench_vector_backends,
+    "quantization": bench_quantization,
+    "overload": bench_overload,
+    "priority": bench_priority,
+    "context-compression": bench_context_compression,
+    "webhook-parser": bench_webhook_parser,
+    "conversation-log": bench_conversation_log,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks offline do WhatsApp AI Agent")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--pages", type=int, default=2000, help="streaming-ingest: páginas do PDF sintético")
+    parser.add_argument("--max-memory-mb", type=float, default=64, help="streaming-ingest: teto de memória")
+    parser.add_argument("--sizes", default="1000,10000,50000", help="vector-backends: tamanhos da base, separados por vírgula")
+    parser.add_argument("--queries", type=int, default=200, help="vector-backends/quantization/context-compression: consultas")
+    parser.add_argument("--dimension", type=int, default=1536, help="vector-backends/quantization: dimensão dos embeddings")
+    parser.add_argument("-k", type=int, default=3, help="vector-backends/quantization/context-compression: resultados por consulta")
+    parser.add_argument("--corpus", type=int, default=20000, help="quantization: chunks do corpus sintético (context-compression: ÷10)")
+    parser.add_argument("--rescore-factor", type=int, default=10, help="quantization: candidatos = k × fator")
+    parser.add_argument("--min-recall", type=float, default=0.95, help="quantization: recall@k mínimo com rescoring; context-compression: recall da resposta mínimo")
+    parser.add_argument("--min-reduction", type=float, default=0.5, help="context-compression: redução mínima de tokens do contexto")
+    parser.add_argument("--overload", type=float, default=10, help="overload/priority: chegada em múltiplos da capacidade")
+    parser.add_argument("--service-ms", type=float, default=50, help="overload/priority: tempo de resposta simulado da IA")
+    parser.add_argument("--duration", type=float, default=3, help="overload/priority: segundos de tráfego")
+    parser.add_argument("--in-flight", type=int, default=8, help="overload/priority: ADMISSION_MAX_IN_FLIGHT")
+    parser.add_argument("--backlog", type=int, default=32, help="overload/priority: ADMISSION_MAX_BACKLOG")
+    parser.add_argument("--instance-concurrency", type=int, default=4, help="priority: MEGA_INSTANCE_MAX_CONCURRENCY")
+    parser.add_argument("--iterations", type=int, default=20000, help="webhook-parser: repetições de cada payload")
+    parser.add_argument("--conversations", default="1000,20000", help="conversation-log: tamanhos do histórico, separados por vírgula")
+    parser.add_argument("--turns", type=int, default=10, help="conversation-log: trocas por conversa")
+    args = parser.parse_args()
+
+    ok = BENCHMARKS[args.benchmark](args)
+    print("✅ OK" if ok else "❌ FALHOU")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,164 @@
+"""
+Circuit breakers das dependências externas: OpenAI (LLM e embeddings) e MEGA API.
+
+Quando uma dependência cai, cada mensagem ainda esperaria o timeout inteiro dela (15 s por
+envio na MEGA API, dezenas de segundos na OpenAI) e todos os workers ficariam presos
+esperando. O breaker conta as falhas recentes: com pelo menos BREAKER_MIN_CALLS chamadas em
+BREAKER_WINDOW_SECONDS e taxa de falha acima de BREAKER_FAILURE_RATE ele abre, e as chamadas
+falham na hora (CircuitOpenError) por BREAKER_OPEN_SECONDS. Depois disso fica meio aberto:
+BREAKER_HALF_OPEN_CALLS chamadas de teste passam; se derem certo ele fecha, senão reabre.
+
+Com o breaker aberto as mensagens são adiadas (ver app.py) em vez de ocupar workers.
+Estado em /health e no Prometheus (whatsapp_circuit_breaker_state: 0 fechado, 1 meio
+aberto, 2 aberto).
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+
+from metrics import CIRCUIT_BREAKER_STATE, CIRCUIT_BREAKER_REJECTED, CIRCUIT_BREAKER_TRANSITIONS
+
+logger = logging.getLogger(__name__)
+
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', 0.5))
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 10))
+BREAKER_WINDOW_SECONDS = float(os.getenv('BREAKER_WINDOW_SECONDS', 60))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv('BREAKER_HALF_OPEN_CALLS', 1))
+
+STATE_CLOSED = "closed"
+STATE_HALF_OPEN = "half_open"
+STATE_OPEN = "open"
+_STATE_VALUES = {STATE_CLOSED: 0, STATE_HALF_OPEN: 1, STATE_OPEN: 2}
+
+
+class CircuitOpenError(RuntimeError):
+    def __init__(self, name: str, retry_after: float):
+        super().__init__(f"circuit breaker '{name}' aberto (nova tentativa em {retry_after:.0f}s)")
+        self.name = name
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    def __init__(self, name: str, failure_rate: float = BREAKER_FAILURE_RATE, min_calls: int = BREAKER_MIN_CALLS,
+                 window_seconds: float = BREAKER_WINDOW_SECONDS, open_seconds: float = BREAKER_OPEN_SECONDS,
+                 half_open_calls: int = BREAKER_HALF_OPEN_CALLS):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = max(1, min_calls)
+        self.window_seconds = window_seconds
+        self.open_seconds = open_seconds
+        self.half_open_calls = max(1, half_open_calls)
+        self._lock = threading.Lock()
+        self._results = deque()  # (instante, falhou)
+        self._failures = 0
+        self._state = STATE_CLOSED
+        self._opened_at = 0.0
+        self._trials = 0
+        self.rejected = 0
+        CIRCUIT_BREAKER_STATE.labels(dependency=name).set(0)
+
+    def _set_state(self, state: str):
+        self._state = state
+        CIRCUIT_BREAKER_STATE.labels(dependency=self.name).set(_STATE_VALUES[state])
+        CIRCUIT_BREAKER_TRANSITIONS.labels(dependency=self.name, state=state).inc()
+        log = logger.warning if state == STATE_OPEN else logger.info
+        log(f"🔌 Circuit breaker '{self.name}': {state}.")
+
+    def _current_state(self, now: float) -> str:
+        if self._state == STATE_OPEN and now - self._opened_at >= self.open_seconds:
+            self._trials = 0
+            self._set_state(STATE_HALF_OPEN)
+        return self._state
+
+    @property
+    def state(self) -> str:
+        with self._lock:
+            return self._current_state(time.monotonic())
+
+    def is_open(self) -> bool:
+        """Aberto e ainda sem chamadas de teste: vale a pena adiar o trabalho."""
+        return self.state == STATE_OPEN
+
+    def allow(self) -> bool:
+        """Reserva uma chamada. Com False a chamada não deve ser feita (falha rápida)."""
+        with self._lock:
+            state = self._current_state(time.monotonic())
+            if state == STATE_CLOSED:
+                return True
+            if state == STATE_HALF_OPEN and self._trials < self.half_open_calls:
+                self._trials += 1
+                return True
+            self.rejected += 1
+        CIRCUIT_BREAKER_REJECTED.labels(dependency=self.name).inc()
+        return False
+
+    def check(self):
+        """allow() que levanta CircuitOpenError."""
+        if not self.allow():
+            raise CircuitOpenError(self.name, self.retry_after())
+
+    def retry_after(self) -> float:
+        with self._lock:
+            if self._state != STATE_OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (time.monotonic() - self._opened_at))
+
+    def record(self, failed: bool):
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            if state == STATE_HALF_OPEN:
+                if failed:
+                    self._opened_at = now
+                    self._set_state(STATE_OPEN)
+                else:
+                    # Dependência de volta: começa uma janela nova
+                    self._results.clear()
+                    self._failures = 0
+                    self._set_state(STATE_CLOSED)
+                return
+            if state == STATE_OPEN:
+                return
+            self._results.append((now, failed))
+            self._failures += failed
+            while self._results and now - self._results[0][0] > self.window_seconds:
+                self._failures -= self._results.popleft()[1]
+            calls = len(self._results)
+            if calls >= self.min_calls and self._failures / calls >= self.failure_rate:
+                self._opened_at = now
+                self._set_state(STATE_OPEN)
+
+    def record_success(self):
+        self.record(False)
+
+    def record_failure(self):
+        self.record(True)
+
+    def call(self, fn, *args, **kwargs):
+        """fn(*args, **kwargs) protegido: falha rápida com o breaker aberto, exceções contam como falha."""
+        self.check()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception:
+            self.record_failure()
+            raise
+        self.record_success()
+        return result
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            state = self._current_state(now)
+            calls = len(self._results)
+            return {
+                "state": state,
+                "recent_calls": calls,
+                "recent_failure_rate": round(self._failures / calls, 3) if calls else 0.0,
+                "rejected": self.rejected,
+                "retry_after_seconds": round(max(0.0, self.open_seconds - (now - self._opened_at)), 1)
+                if state == STATE_OPEN else 0.0,
+            }
@@ -0,0 +1,85 @@
+"""
+Compressão extrativa do contexto recuperado, sem chamadas à IA.
+
+A cadeia "stuff" cola os chunks inteiros (até 1000 caracteres cada) no prompt, mesmo quando
+só uma frase responde à pergunta. Aqui cada chunk recuperado é dividido em frases e ficam só
+as CONTEXT_COMPRESSION_MAX_SENTENCES que mais compartilham termos com a pergunta (tokens do
+BM25, ver lexical_index.tokenize, pesados pela raridade entre as frases recuperadas), na
+ordem original. Um chunk sem nenhum termo da pergunta (recuperado só pela semelhança dos
+embeddings) segue inteiro: não há como julgar as frases dele pelo texto.
+
+Ativado com CONTEXT_COMPRESSION_ENABLED=true. Redução de tokens e recall do contexto da
+resposta: `python benchmarks.py context-compression`. Perguntas parafraseadas, sem o código do
+produto nem as palavras do trecho, perdem a resposta com frequência (≈2/3 de recall no benchmark).
+"""
+
+import os
+import re
+import math
+import logging
+from collections import Counter
+
+from lexical_index import tokenize
+
+logger = logging.getLogger(__name__)
+
+CONTEXT_COMPRESSION_ENABLED = os.getenv('CONTEXT_COMPRESSION_ENABLED', 'false').lower() == 'true'
+CONTEXT_COMPRESSION_MAX_SENTENCES = int(os.getenv('CONTEXT_COMPRESSION_MAX_SENTENCES', 3))
+# Frases com pontuação abaixo dessa fração da melhor do chunk são descartadas
+CONTEXT_COMPRESSION_MIN_RELATIVE_SCORE = float(os.getenv('CONTEXT_COMPRESSION_MIN_RELATIVE_SCORE', 0.3))
+# Prefixo usado para casar variações da mesma palavra (preço/preços, entrega/entregamos)
+_STEM_LENGTH = 5
+
+# Fim de frase: . ! ? ou quebra de linha, seguido de espaço; não quebra "R$ 1.299,90" nem "v2.1"
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def split_sentences(text: str):
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence and sentence.strip()]
+
+
+def _terms(text: str) -> set:
+    # Só palavras são reduzidas ao prefixo; códigos e números precisam casar inteiros
+    return {token[:_STEM_LENGTH] if token.isalpha() else token for token in tokenize(text)}
+
+
+def compress_text(query_terms: set, sentences, sentence_terms, idf: dict,
+                  max_sentences: int = CONTEXT_COMPRESSION_MAX_SENTENCES,
+                  min_relative_score: float = CONTEXT_COMPRESSION_MIN_RELATIVE_SCORE):
+    """Frases mantidas de um chunk (na ordem original), ou None se nenhuma casa com a pergunta."""
+    scores = [sum(idf[term] for term in terms & query_terms) for terms in sentence_terms]
+    best = max(scores, default=0.0)
+    if best <= 0:
+        return None
+    ranked = sorted(range(len(sentences)), key=lambda i: scores[i], reverse=True)
+    selected = sorted(i for i in ranked[:max_sentences] if scores[i] >= best * min_relative_score)
+    return " ".join(sentences[i] for i in selected)
+
+
+def compress_documents(query: str, documents, max_sentences: int = CONTEXT_COMPRESSION_MAX_SENTENCES,
+                       min_relative_score: float = CONTEXT_COMPRESSION_MIN_RELATIVE_SCORE):
+    """Documentos com page_content reduzido às frases relevantes (metadados preservados)."""
+    query_terms = _terms(query)
+    if not query_terms or not documents:
+        return list(documents)
+    split = [split_sentences(document.page_content) for document in documents]
+    terms = [[_terms(sentence) for sentence in sentences] for sentences in split]
+    # Raridade de cada termo da pergunta entre todas as frases recuperadas
+    total = sum(len(sentences) for sentences in split)
+    frequency = Counter(term for chunk_terms in terms for sentence_terms in chunk_terms
+                        for term in sentence_terms & query_terms)
+    idf = {term: math.log(1 + total / count) for term, count in frequency.items()}
+
+    compressed, before, after = [], 0, 0
+    for document, sentences, sentence_terms in zip(documents, split, terms):
+        text = compress_text(query_terms, sentences, sentence_terms, idf, max_sentences, min_relative_score)
+        if text is None:
+            compressed.append(document)
+            text = document.page_content
+        else:
+            compressed.append(document.model_copy(update={"page_content": text}))
+        before += len(document.page_content)
+        after += len(text)
+    if before:
+        logger.info(f"🗜️ Contexto comprimido: {before} → {after} caracteres ({len(documents)} chunks).")
+    return compressed
@@ -0,0 +1,220 @@
+"""
+Afinidade de conversas entre os workers do gunicorn.
+
+Cada worker tem a própria memória (user_memories): se mensagens seguidas do mesmo cliente
+caem em workers diferentes, o contexto se perde. Aqui cada remoteJid tem um worker dono,
+escolhido por hash consistente, e o worker que recebeu o webhook repassa a mensagem ao dono
+por um socket Unix local. O estado de cada conversa fica num único processo.
+
+Os workers disputam AFFINITY_WORKERS vagas (uma trava fcntl por vaga, mantida enquanto o
+processo vive); quem fica com a vaga i escuta em <AFFINITY_SOCKET_DIRECTORY>/worker-<i>.sock.
+Quando um worker é reciclado, o substituto herda a vaga e as mesmas conversas. Se o dono
+estiver indisponível (conexão ou envio falham), a mensagem é processada localmente (sem
+perder a resposta). Depois de enviada ela é do dono, mesmo sem confirmação a tempo:
+processá-la também aqui daria duas respostas e dividiria a memória da conversa.
+
+Com um único worker (padrão, WEB_CONCURRENCY não definido) nada é repassado. Não use
+`gunicorn --preload`: a thread do socket precisa ser criada em cada worker.
+"""
+
+import os
+import bisect
+import fcntl
+import socket
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import orjson
+
+logger = logging.getLogger(__name__)
+
+# Número de vagas: deve ser o número de workers do gunicorn (que também lê WEB_CONCURRENCY)
+AFFINITY_WORKERS = int(os.getenv('AFFINITY_WORKERS', os.getenv('WEB_CONCURRENCY', 1)))
+AFFINITY_SOCKET_DIRECTORY = os.getenv('AFFINITY_SOCKET_DIRECTORY', '/tmp/whatsapp-agent-affinity')
+AFFINITY_VIRTUAL_NODES = int(os.getenv('AFFINITY_VIRTUAL_NODES', 64))
+AFFINITY_FORWARD_TIMEOUT_SECONDS = float(os.getenv('AFFINITY_FORWARD_TIMEOUT_SECONDS', 2))
+
+
+def _hash64(key: str) -> int:
+    # hash() do Python muda entre processos: todos os workers precisam do mesmo anel
+    return int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HashRing:
+    """Anel de hash consistente com nós virtuais (adicionar uma vaga move ~1/N das conversas)."""
+
+    def __init__(self, nodes, virtual_nodes: int = AFFINITY_VIRTUAL_NODES):
+        points = sorted((_hash64(f"{node}#{replica}"), node) for node in nodes for replica in range(virtual_nodes))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def owner(self, key: str):
+        if not self._nodes:
+            return None
+        return self._nodes[bisect.bisect(self._hashes, _hash64(key)) % len(self._nodes)]
+
+
+class ConversationRouter:
+    """
+    Entrega cada conversa ao worker dono. handler(job) processa um job localmente e deve
+    retornar rápido (ex.: enfileirando nos workers da instância); job é um dict serializável
+    que inclui a chave "jid".
+    """
+
+    def __init__(self, handler, workers: int = AFFINITY_WORKERS, socket_directory: str = AFFINITY_SOCKET_DIRECTORY,
+                 forward_timeout: float = AFFINITY_FORWARD_TIMEOUT_SECONDS):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.socket_directory = socket_directory
+        self.forward_timeout = forward_timeout
+        self.ring = HashRing(range(self.workers))
+        self.slot = None
+        self._lock_file = None
+        self._server = None
+        self._handler_executor = None
+        self._accept_thread = None
+        self._stats_lock = threading.Lock()
+        self.local = 0
+        self.forwarded = 0
+        self.received = 0
+        self.forward_failures = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.workers > 1
+
+    def socket_path(self, slot: int) -> str:
+        return os.path.join(self.socket_directory, f"worker-{slot}.sock")
+
+    def start(self):
+        """Ocupa uma vaga livre e passa a aceitar jobs repassados pelos outros workers."""
+        if not self.enabled:
+            return
+        os.makedirs(self.socket_directory, exist_ok=True)
+        for slot in range(self.workers):
+            lock_file = open(os.path.join(self.socket_directory, f"worker-{slot}.lock"), "w")
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                lock_file.close()
+                continue
+            self.slot, self._lock_file = slot, lock_file
+            break
+        if self.slot is None:
+            # Mais processos que vagas (ex.: durante um reload): este worker só repassa
+            logger.warning(f"⚠️ Nenhuma vaga de afinidade livre ({self.workers}). Este worker vai repassar todas as conversas.")
+            return
+
+        path = self.socket_path(self.slot)
+        if os.path.exists(path):
+            os.unlink(path)  # Socket do processo anterior desta vaga (a trava garante que ele morreu)
+        self._server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._server.bind(path)
+        self._server.listen(128)
+        # Uma thread só: os jobs repassados seguem para o handler na ordem em que chegaram,
+        # sem que um handler lento segure o accept dos próximos
+        self._handler_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"affinity-handler-{self.slot}")
+        self._accept_thread = threading.Thread(target=self._serve, name=f"affinity-{self.slot}", daemon=True)
+        self._accept_thread.start()
+        logger.info(f"🔀 Worker {os.getpid()} é dono da vaga {self.slot}/{self.workers} ({path}).")
+
+    def _serve(self):
+        server = self._server
+        while True:
+            try:
+                connection, _ = server.accept()
+            except OSError:
+                return  # Socket fechado (close())
+            with connection:
+                try:
+                    connection.settimeout(self.forward_timeout)
+                    job = orjson.loads(connection.makefile("rb").readline())
+                    self._handler_executor.submit(self._handle_forwarded, job)
+                except Exception as e:
+                    logger.error(f"Erro ao receber conversa repassada: {e}", exc_info=True)
+                    continue
+                try:
+                    # Confirma o recebimento, não o processamento (que fica para o handler)
+                    connection.sendall(b"ok\n")
+                except OSError as e:
+                    logger.warning(f"Confirmação da conversa repassada de {job.get('jid')} não entregue ({e}); o job segue aqui.")
+
+    def _handle_forwarded(self, job: dict):
+        try:
+            self.handler(job)
+            with self._stats_lock:
+                self.received += 1
+        except Exception as e:
+            logger.error(f"Erro ao processar conversa repassada de {job.get('jid')}: {e}", exc_info=True)
+
+    def owner(self, jid: str):
+        return self.ring.owner(jid)
+
+    def dispatch(self, job: dict) -> str:
+        """Processa o job aqui ou no worker dono do jid. Retorna "local" ou "forwarded"."""
+        owner = self.owner(job["jid"]) if self.enabled else self.slot
+        if owner != self.slot:
+            if self._forward(owner, job):
+                with self._stats_lock:
+                    self.forwarded += 1
+                return "forwarded"
+            with self._stats_lock:
+                self.forward_failures += 1
+            logger.warning(f"⚠️ Worker dono da conversa {job['jid']} (vaga {owner}) indisponível. Processando localmente.")
+        self.handler(job)
+        with self._stats_lock:
+            self.local += 1
+        return "local"
+
+    def _forward(self, slot: int, job: dict) -> bool:
+        """Repassa o job ao dono. False só se a conexão ou o envio falharam (aí ele é processado aqui)."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(self.forward_timeout)
+            try:
+                connection.connect(self.socket_path(slot))
+                connection.sendall(orjson.dumps(job) + b"\n")
+            except OSError:
+                return False
+            try:
+                acknowledged = connection.makefile("rb").readline().strip() == b"ok"
+            except OSError:
+                acknowledged = False
+        if not acknowledged:
+            logger.warning(f"⚠️ Worker dono da conversa {job['jid']} (vaga {slot}) não confirmou o recebimento a tempo. "
+                           f"Considerada entregue (processar aqui também duplicaria a resposta).")
+        return True
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "workers": self.workers,
+                "slot": self.slot,
+                "local": self.local,
+                "forwarded": self.forwarded,
+                "received": self.received,
+                "forward_failures": self.forward_failures,
+            }
+
+    def close(self):
+        if self._server is not None:
+            try:
+                # Acorda o accept() bloqueado: a thread dele termina antes do handler fechar
+                self._server.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self._server.close()
+            self._server = None
+            self._accept_thread.join(self.forward_timeout + 1)
+            try:
+                os.unlink(self.socket_path(self.slot))
+            except FileNotFoundError:
+                pass
+        if self._handler_executor is not None:
+            # Os repassados já confirmados chegam aos workers das instâncias antes do drain delas
+            self._handler_executor.shutdown(wait=True)
+            self._handler_executor = None
+        if self._lock_file is not None:
+            self._lock_file.close()
+            self._lock_file = None
@@ -0,0 +1,306 @@
+"""
+Histórico das conversas em disco: log só de acréscimo + snapshots compactados por conversa.
+
+Sem isso o histórico vive só em user_memories e cada deploy ou reciclagem de worker apaga o
+contexto de todos os clientes. Aqui:
+
+- cada troca (mensagem do cliente + resposta) é acrescentada ao segmento ativo do processo
+  (active-<id>.jsonl) por uma thread escritora, com um único fsync por lote
+  (CONVERSATION_LOG_FSYNC_INTERVAL_SECONDS: numa queda perdem-se no máximo as trocas desse
+  intervalo); quem responde ao cliente nunca espera o disco;
+- a cada CONVERSATION_SNAPSHOT_INTERVAL_SECONDS um processo (trava fcntl) compacta os
+  segmentos fechados em um snapshot por conversa (snapshots/<hash[:2]>/<hash>.json, só as últimas
+  CONVERSATION_LOG_MAX_TURNS trocas) e apaga os segmentos;
+- na inicialização nada é carregado: a memória de uma conversa é restaurada na primeira
+  mensagem dela (snapshot da conversa + segmentos ainda não compactados). O tempo de
+  reinício não depende do tamanho do histórico.
+
+Cada segmento ativo fica travado (fcntl) pelo processo que escreve nele; um segmento sem
+trava é de um processo que morreu e é fechado na próxima compactação.
+
+Benchmark: `python benchmarks.py conversation-log`.
+"""
+
+import os
+import time
+import uuid
+import fcntl
+import glob
+import hashlib
+import logging
+import threading
+
+import orjson
+
+from metrics import CONVERSATION_LOG_RECORDS, CONVERSATION_LOG_FSYNC_BATCH, CONVERSATION_RESTORES, CONVERSATION_COMPACTIONS
+
+logger = logging.getLogger(__name__)
+
+CONVERSATION_LOG_ENABLED = os.getenv('CONVERSATION_LOG_ENABLED', 'true').lower() == 'true'
+CONVERSATION_LOG_DIRECTORY = os.getenv('CONVERSATION_LOG_DIRECTORY', './conversation_log')
+CONVERSATION_LOG_FSYNC_INTERVAL_SECONDS = float(os.getenv('CONVERSATION_LOG_FSYNC_INTERVAL_SECONDS', 0.05))
+# Trocas guardadas por conversa (o orçamento de tokens decide quantas entram em cada prompt)
+CONVERSATION_LOG_MAX_TURNS = int(os.getenv('CONVERSATION_LOG_MAX_TURNS', 50))
+CONVERSATION_SNAPSHOT_INTERVAL_SECONDS = float(os.getenv('CONVERSATION_SNAPSHOT_INTERVAL_SECONDS', 300))
+# Segmento ativo maior que isso é fechado antes do intervalo (limita a leitura na restauração)
+CONVERSATION_LOG_SEGMENT_BYTES = int(os.getenv('CONVERSATION_LOG_SEGMENT_BYTES', 8 * 1024 * 1024))
+
+COMPACTION_LOCK_FILENAME = "compaction.lock"
+
+
+def _snapshot_key(user_id: str) -> str:
+    return hashlib.blake2b(user_id.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _read_records(path: str, user_id: str = None):
+    """Registros de um segmento (de uma conversa só, se informada). Ignora a última linha incompleta."""
+    needle = None if user_id is None else b'"u":' + orjson.dumps(user_id)
+    try:
+        f = open(path, "rb")
+    except FileNotFoundError:
+        directory, name = os.path.split(path)
+        if name.startswith("active-"):
+            # Fechado (active- → sealed-) entre o glob e a leitura: ainda não foi compactado,
+            # então as trocas dele não estão no snapshot
+            yield from _read_records(os.path.join(directory, "sealed-" + name[len("active-"):]), user_id)
+        # Fechado e compactado (apagado) enquanto líamos: as trocas já estão no snapshot
+        return
+    with f:
+        for line in f:
+            if needle is not None and needle not in line:
+                continue
+            try:
+                record = orjson.loads(line)
+            except orjson.JSONDecodeError:
+                continue
+            if user_id is None or record.get("u") == user_id:
+                yield record
+
+
+def _merge_turns(*sources, max_turns: int = CONVERSATION_LOG_MAX_TURNS):
+    """Trocas [instante, entrada, saída] em ordem, sem repetições, só as últimas max_turns."""
+    turns = {}
+    for source in sources:
+        for turn in source:
+            turns[(turn[0], turn[1], turn[2])] = turn
+    return sorted(turns.values(), key=lambda turn: turn[0])[-max_turns:]
+
+
+class ConversationLog:
+    def __init__(self, directory: str = CONVERSATION_LOG_DIRECTORY, max_turns: int = CONVERSATION_LOG_MAX_TURNS,
+                 fsync_interval: float = CONVERSATION_LOG_FSYNC_INTERVAL_SECONDS,
+                 snapshot_interval: float = CONVERSATION_SNAPSHOT_INTERVAL_SECONDS,
+                 segment_bytes: int = CONVERSATION_LOG_SEGMENT_BYTES):
+        self.directory = directory
+        self.snapshot_directory = os.path.join(directory, "snapshots")
+        self.max_turns = max_turns
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.segment_bytes = segment_bytes
+        os.makedirs(self.snapshot_directory, exist_ok=True)
+        self._condition = threading.Condition()
+        self._buffer = []
+        self._closed = False
+        self._appended = 0  # trocas acrescentadas / gravadas, para flush() saber quando terminar
+        self._written = 0
+        self._io_lock = threading.Lock()  # segmento ativo (escrita x rotação)
+        self._segment = None
+        self._open_segment()
+        self.stats_counters = {"appended": 0, "fsyncs": 0, "restored": 0, "compactions": 0}
+        self._writer = threading.Thread(target=self._write_loop, name="conversation-log", daemon=True)
+        self._compactor = threading.Thread(target=self._compact_loop, name="conversation-compaction", daemon=True)
+
+    def start(self):
+        self._writer.start()
+        self._compactor.start()
+        return self
+
+    # --- escrita ---
+
+    def _open_segment(self):
+        path = os.path.join(self.directory, f"active-{int(time.time())}-{uuid.uuid4().hex[:12]}.jsonl")
+        segment = open(path, "ab")
+        # Travado enquanto este processo vive: sem trava, o segmento é de um processo morto
+        fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        self._segment = segment
+
+    def _seal_segment(self):
+        """Fecha o segmento ativo (vira sealed-*, pronto para a compactação) e abre outro."""
+        segment = self._segment
+        if segment.tell() == 0:
+            return
+        segment.flush()
+        os.fsync(segment.fileno())
+        os.replace(segment.name, segment.name.replace("active-", "sealed-"))
+        segment.close()
+        self._open_segment()
+
+    def append(self, user_id: str, user_message: str, ai_response: str):
+        """Acrescenta uma troca; gravada e sincronizada pela thread escritora no próximo lote."""
+        record = orjson.dumps({"u": user_id, "t": time.time(), "i": user_message, "o": ai_response}) + b"\n"
+        with self._condition:
+            if self._closed:
+                logger.warning(f"⚠️ Log de conversas fechado: troca de '{user_id}' não gravada.")
+                return
+            self._buffer.append(record)
+            self._appended += 1
+            self._condition.notify()
+
+    def _write_batch(self, batch):
+        with self._io_lock:
+            segment = self._segment
+            segment.write(b"".join(batch))
+            segment.flush()
+            os.fsync(segment.fileno())
+            if segment.tell() >= self.segment_bytes:
+                self._seal_segment()
+        CONVERSATION_LOG_RECORDS.inc(len(batch))
+        CONVERSATION_LOG_FSYNC_BATCH.observe(len(batch))
+        self.stats_counters["appended"] += len(batch)
+        self.stats_counters["fsyncs"] += 1
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._buffer and not self._closed:
+                    self._condition.wait()
+                if not self._buffer and self._closed:
+                    return
+            # Junta o que chegar durante o intervalo num único fsync
+            time.sleep(self.fsync_interval)
+            with self._condition:
+                batch, self._buffer = self._buffer, []
+                appended = self._appended
+            try:
+                self._write_batch(batch)
+            except OSError as e:
+                logger.error(f"❌ Falha ao gravar {len(batch)} trocas no log de conversas: {e}", exc_info=True)
+            with self._condition:
+                self._written = appended
+                self._condition.notify_all()
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Espera o que já foi acrescentado ser gravado e sincronizado."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            target = self._appended
+            while self._written < target:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or not self._writer.is_alive():
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self, timeout: float = 5.0):
+        """Grava o restante e para as threads (chamado no drain)."""
+        flushed = self.flush(timeout)
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        if self._writer.is_alive():
+            self._writer.join(timeout)
+        if not flushed:
+            logger.warning("⚠️ Log de conversas fechado com trocas ainda não gravadas.")
+
+    # --- restauração ---
+
+    def _snapshot_path(self, user_id: str) -> str:
+        key = _snapshot_key(user_id)
+        return os.path.join(self.snapshot_directory, key[:2], f"{key}.json")
+
+    def _load_snapshot(self, path: str):
+        try:
+            with open(path, "rb") as f:
+                return orjson.loads(f.read())["turns"]
+        except FileNotFoundError:
+            return []
+
+    def _segments(self):
+        return sorted(glob.glob(os.path.join(self.directory, "sealed-*.jsonl"))) + \
+            sorted(glob.glob(os.path.join(self.directory, "active-*.jsonl")))
+
+    def restore(self, user_id: str):
+        """Últimas trocas da conversa: [(mensagem do cliente, resposta), ...] em ordem."""
+        started = time.monotonic()
+        # Segmentos antes do snapshot: se a compactação rodar no meio, as trocas que sumirem
+        # dos segmentos já estarão no snapshot (gravado antes de os segmentos serem apagados)
+        logged = [[record["t"], record["i"], record["o"]] for path in self._segments() for record in _read_records(path, user_id)]
+        turns = _merge_turns(self._load_snapshot(self._snapshot_path(user_id)), logged, max_turns=self.max_turns)
+        CONVERSATION_RESTORES.labels(result="restored" if turns else "empty").inc()
+        if turns:
+            self.stats_counters["restored"] += 1
+            logger.info(f"📜 {len(turns)} trocas restauradas para '{user_id}' em {(time.monotonic() - started) * 1000:.1f} ms.")
+        return [(user_message, ai_response) for _, user_message, ai_response in turns]
+
+    # --- compactação ---
+
+    def _compact_loop(self):
+        while not self._closed:
+            time.sleep(self.snapshot_interval)
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"❌ Erro na compactação do log de conversas: {e}", exc_info=True)
+
+    def _seal_orphans(self):
+        """Segmentos ativos de processos que morreram (sem trava) passam a fechados."""
+        own = self._segment.name
+        for path in glob.glob(os.path.join(self.directory, "active-*.jsonl")):
+            if path == own:
+                continue
+            try:
+                with open(path, "ab") as segment:
+                    fcntl.flock(segment.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.replace(path, path.replace("active-", "sealed-"))
+            except BlockingIOError:
+                continue  # processo vivo
+            except FileNotFoundError:
+                continue
+
+    def _write_snapshot(self, user_id: str, turns):
+        path = self._snapshot_path(user_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "wb") as f:
+            f.write(orjson.dumps({"u": user_id, "turns": turns}))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def compact(self) -> dict:
+        """Segmentos fechados → snapshots por conversa. Um processo por vez (os outros pulam)."""
+        started = time.monotonic()
+        with open(os.path.join(self.directory, COMPACTION_LOCK_FILENAME), "a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return {"skipped": True}
+            with self._io_lock:
+                self._seal_segment()
+            self._seal_orphans()
+            segments = sorted(glob.glob(os.path.join(self.directory, "sealed-*.jsonl")))
+            by_user = {}
+            for path in segments:
+                for record in _read_records(path):
+                    by_user.setdefault(record["u"], []).append([record["t"], record["i"], record["o"]])
+            for user_id, logged in by_user.items():
+                self._write_snapshot(user_id, _merge_turns(self._load_snapshot(self._snapshot_path(user_id)), logged,
+                                                           max_turns=self.max_turns))
+            for path in segments:
+                os.remove(path)
+        report = {
+            "segments": len(segments),
+            "conversations": len(by_user),
+            "turns": sum(map(len, by_user.values())),
+            "seconds": round(time.monotonic() - started, 3),
+        }
+        CONVERSATION_COMPACTIONS.inc()
+        self.stats_counters["compactions"] += 1
+        if segments:
+            logger.info(f"🗜️ Log de conversas compactado: {report}")
+        return report
+
+    def stats(self) -> dict:
+        with self._condition:
+            buffered = len(self._buffer)
+        return {"directory": self.directory, "buffered": buffered, **self.stats_counters}
@@ -0,0 +1,117 @@
+"""
+Prazos por etapa da geração de respostas e requisições duplicadas (hedging) à IA.
+
+Sem prazo, uma requisição travada na OpenAI prende a thread enquanto o cliente espera. Aqui:
+
+- cada etapa tem um teto: busca na base (RETRIEVAL_DEADLINE_SECONDS) e cada chamada à IA
+  (LLM_TIMEOUT_SECONDS, também passado ao ChatOpenAI como timeout);
+- com LLM_HEDGE_ENABLED=true, se a chamada passar do p95 recente do modelo
+  (LLM_HEDGE_PERCENTILE), uma cópia é enviada e vale a que responder primeiro;
+- se a resposta inteira passar de RESPONSE_DEADLINE_SECONDS, o cliente recebe
+  DEADLINE_FALLBACK_REPLY na hora e a resposta atrasada é enviada quando chegar.
+"""
+
+import os
+import time
+import logging
+import threading
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, wait
+
+import numpy as np
+
+from metrics import DEADLINE_EXCEEDED, LLM_HEDGED
+
+logger = logging.getLogger(__name__)
+
+RESPONSE_DEADLINE_SECONDS = float(os.getenv('RESPONSE_DEADLINE_SECONDS', 20))
+RETRIEVAL_DEADLINE_SECONDS = float(os.getenv('RETRIEVAL_DEADLINE_SECONDS', 4))
+# Teto de cada chamada à IA; maior que RESPONSE_DEADLINE_SECONDS para a resposta atrasada ainda chegar
+LLM_TIMEOUT_SECONDS = float(os.getenv('LLM_TIMEOUT_SECONDS', 40))
+LLM_MAX_RETRIES = int(os.getenv('LLM_MAX_RETRIES', 1))
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'false').lower() == 'true'
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', 95))
+LLM_HEDGE_MIN_DELAY_SECONDS = float(os.getenv('LLM_HEDGE_MIN_DELAY_SECONDS', 1.0))
+# Sem amostras suficientes do modelo não há p95 confiável: nada de cópia
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv('LLM_HEDGE_MIN_SAMPLES', 20))
+LATENCY_WINDOW_SIZE = int(os.getenv('LATENCY_WINDOW_SIZE', 200))
+DEADLINE_FALLBACK_REPLY = os.getenv(
+    'DEADLINE_FALLBACK_REPLY',
+    "Só um instante! ⏳ Estou reunindo as informações e já te respondo."
+)
+
+
+class DeadlineExceeded(TimeoutError):
+    def __init__(self, stage: str, seconds: float):
+        super().__init__(f"etapa '{stage}' passou do prazo de {seconds:.1f}s")
+        self.stage = stage
+
+
+class LatencyTracker:
+    """Latências recentes de cada modelo (janela de LATENCY_WINDOW_SIZE chamadas)."""
+
+    def __init__(self, window_size: int = LATENCY_WINDOW_SIZE):
+        self.window_size = window_size
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, key: str, seconds: float):
+        with self._lock:
+            self._samples.setdefault(key, deque(maxlen=self.window_size)).append(seconds)
+
+    def percentile(self, key: str, percentile: float, min_samples: int = LLM_HEDGE_MIN_SAMPLES):
+        with self._lock:
+            samples = list(self._samples.get(key, ()))
+        if len(samples) < min_samples:
+            return None
+        return float(np.percentile(samples, percentile))
+
+    def hedge_delay(self, key: str, enabled: bool = LLM_HEDGE_ENABLED):
+        """Espera antes da cópia da requisição (None: sem cópia)."""
+        if not enabled:
+            return None
+        p95 = self.percentile(key, LLM_HEDGE_PERCENTILE)
+        return None if p95 is None else max(LLM_HEDGE_MIN_DELAY_SECONDS, p95)
+
+
+def call_with_deadline(executor, fn, seconds: float, stage: str):
+    """fn() no executor, esperando no máximo `seconds` (a thread segue até fn terminar)."""
+    future = executor.submit(fn)
+    done, _ = wait([future], timeout=seconds)
+    if not done:
+        DEADLINE_EXCEEDED.labels(stage=stage).inc()
+        raise DeadlineExceeded(stage, seconds)
+    return future.result()
+
+
+def hedged_call(executor, fn, seconds: float, hedge_delay: float = None, stage: str = "llm"):
+    """
+    fn() com prazo; se hedge_delay passar sem resposta, dispara uma cópia e vale a primeira
+    que terminar bem. Retorna (resultado, "primary" | "hedge").
+    """
+    started = time.monotonic()
+    primary = executor.submit(fn)
+    futures = [primary]
+    if hedge_delay is not None and hedge_delay < seconds:
+        done, _ = wait(futures, timeout=hedge_delay)
+        if not done:
+            futures.append(executor.submit(fn))
+            logger.info(f"🪞 Chamada passou de {hedge_delay:.1f}s (p{LLM_HEDGE_PERCENTILE:.0f}): cópia enviada.")
+
+    pending, error = set(futures), None
+    while pending:
+        remaining = seconds - (time.monotonic() - started)
+        if remaining <= 0:
+            break
+        done, pending = wait(pending, timeout=remaining, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                winner = "primary" if future is primary else "hedge"
+                if len(futures) > 1:
+                    LLM_HEDGED.labels(winner=winner).inc()
+                return future.result(), winner
+            error = error or future.exception()
+    if error is not None and not pending:
+        raise error
+    DEADLINE_EXCEEDED.labels(stage=stage).inc()
+    raise DeadlineExceeded(stage, seconds)
@@ -0,0 +1,322 @@
+"""
+Etapa de embedding da ingestão: agrupa os chunks em lotes limitados por tokens,
+processa vários lotes em paralelo, faz retry com backoff exponencial (respeitando
+o Retry-After dos erros 429) e grava um checkpoint a cada lote concluído, para que
+uma ingestão interrompida seja retomada a partir do último lote salvo.
+
+Os chunks são consumidos de um iterador e o número de lotes em andamento é limitado,
+então o consumo de memória não depende do tamanho dos documentos.
+"""
+
+import os
+import json
+import time
+import random
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED, ALL_COMPLETED
+
+import openai
+from langchain_core.embeddings import Embeddings
+
+logger = logging.getLogger(__name__)
+
+# Modelo de embedding da base de conhecimento (o mesmo na ingestão e nas consultas do app.py)
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', 'text-embedding-ada-002')
+# Dimensão gerada por cada modelo, usada para validar o manifesto da base sem chamar a API
+EMBEDDING_MODEL_DIMENSIONS = {
+    'text-embedding-ada-002': 1536,
+    'text-embedding-3-small': 1536,
+    'text-embedding-3-large': 3072,
+}
+
+# Limites dos lotes enviados à API de embeddings (a OpenAI aceita até ~300k tokens e 2048 entradas por requisição)
+EMBEDDING_BATCH_MAX_TOKENS = int(os.getenv('EMBEDDING_BATCH_MAX_TOKENS', 100000))
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv('EMBEDDING_BATCH_MAX_ITEMS', 512))
+EMBEDDING_MAX_CONCURRENCY = int(os.getenv('EMBEDDING_MAX_CONCURRENCY', 4))
+# Lotes em andamento (embedding + gravação) antes de o produtor parar de ler novos chunks
+EMBEDDING_MAX_IN_FLIGHT_BATCHES = int(os.getenv('EMBEDDING_MAX_IN_FLIGHT_BATCHES', EMBEDDING_MAX_CONCURRENCY * 2))
+EMBEDDING_MAX_RETRIES = int(os.getenv('EMBEDDING_MAX_RETRIES', 6))
+EMBEDDING_BACKOFF_BASE_SECONDS = float(os.getenv('EMBEDDING_BACKOFF_BASE_SECONDS', 1.0))
+EMBEDDING_BACKOFF_MAX_SECONDS = float(os.getenv('EMBEDDING_BACKOFF_MAX_SECONDS', 60.0))
+
+CHECKPOINT_FILENAME = ".embedding_checkpoint.json"
+
+# Embeddings de perguntas mantidos em memória (perguntas repetidas e etapas que reusam o mesmo vetor)
+QUERY_EMBEDDING_CACHE_SIZE = int(os.getenv('QUERY_EMBEDDING_CACHE_SIZE', 256))
+
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+)
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    """Conta tokens com tiktoken; se o encoding não puder ser carregado, usa a estimativa de ~4 caracteres/token."""
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    logger.warning(f"⚠️ tiktoken indisponível ({e}). Usando estimativa de tokens por caracteres.")
+                    _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return len(text) // 4 + 1
+
+
+def iter_batches(items, max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS, max_items: int = EMBEDDING_BATCH_MAX_ITEMS):
+    """
+    Agrupa pares (id, chunk) em lotes que respeitam os limites de tokens e de itens.
+    Consome o iterador de forma preguiçosa: só um lote fica em memória por vez.
+    """
+    current, current_tokens = [], 0
+    for chunk_id, chunk in items:
+        tokens = count_tokens(chunk.page_content)
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_items):
+            yield current
+            current, current_tokens = [], 0
+        current.append((chunk_id, chunk))
+        current_tokens += tokens
+    if current:
+        yield current
+
+
+def chunk_fingerprint(chunks) -> str:
+    """Impressão digital estável de uma lista de chunks (conteúdo + metadados)."""
+    digest = hashlib.sha256()
+    for chunk in chunks:
+        digest.update(chunk.page_content.encode('utf-8'))
+        digest.update(json.dumps(chunk.metadata, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(b'\x00')
+    return digest.hexdigest()
+
+
+def positional_chunk_ids(chunks, fingerprint: str = None):
+    """IDs determinísticos por posição, para que um lote refeito sobrescreva (upsert) o mesmo registro."""
+    fingerprint = fingerprint or chunk_fingerprint(chunks)
+    return [f"{fingerprint[:16]}-{index}" for index in range(len(chunks))]
+
+
+def _batch_key(batch) -> str:
+    return hashlib.sha256("\x00".join(chunk_id for chunk_id, _ in batch).encode('utf-8')).hexdigest()[:24]
+
+
+def checkpoint_path_for(persist_directory: str) -> str:
+    return os.path.join(persist_directory, CHECKPOINT_FILENAME)
+
+
+class _Checkpoint:
+    """Conjunto de lotes concluídos de uma execução, persistido a cada lote gravado."""
+
+    def __init__(self, path: str, run_key: str):
+        self.path = path
+        self.run_key = run_key
+        self.completed = set()
+        if path and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("run_key") == run_key:
+                    self.completed = set(data.get("completed", []))
+                else:
+                    logger.info("Checkpoint de embedding pertence a outra ingestão. Recomeçando do zero.")
+            except Exception as e:
+                logger.warning(f"⚠️ Checkpoint de embedding ilegível ({e}). Recomeçando do zero.")
+
+    def add(self, batch_key: str):
+        self.completed.add(batch_key)
+        if not self.path:
+            return
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"run_key": self.run_key, "completed": sorted(self.completed)}, f)
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class _RateLimitGate:
+    """Pausa compartilhada entre os lotes: quando um lote recebe 429, todos esperam antes da próxima chamada."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._resume_at = 0.0
+
+    def wait(self):
+        while True:
+            with self._lock:
+                delay = self._resume_at - time.monotonic()
+            if delay <= 0:
+                return
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._resume_at = max(self._resume_at, time.monotonic() + seconds)
+
+
+class CachedQueryEmbeddings(Embeddings):
+    """
+    Envolve um modelo de embeddings com um cache LRU de perguntas. Os retrievers usam
+    embed_query normalmente; etapas posteriores (ex.: MMR) consultam cached_query para
+    reaproveitar o vetor sem nova chamada à API.
+    """
+
+    def __init__(self, embeddings, max_size: int = QUERY_EMBEDDING_CACHE_SIZE, breaker=None):
+        self.embeddings = embeddings
+        self.max_size = max_size
+        # circuit_breaker.CircuitBreaker opcional: com a API fora, falha na hora em vez de esperar o timeout
+        self.breaker = breaker
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def cached_query(self, text: str):
+        with self._lock:
+            vector = self._cache.get(text)
+            if vector is not None:
+                self._cache.move_to_end(text)
+            return vector
+
+    def embed_query(self, text: str):
+        vector = self.cached_query(text)
+        if vector is None:
+            if self.breaker is not None:
+                vector = self.breaker.call(self.embeddings.embed_query, text)
+            else:
+                vector = self.embeddings.embed_query(text)
+            with self._lock:
+                self._cache[text] = vector
+                while len(self._cache) > self.max_size:
+                    self._cache.popitem(last=False)
+        return vector
+
+    def embed_documents(self, texts):
+        return self.embeddings.embed_documents(texts)
+
+
+def _retry_after_seconds(error):
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    value = response.headers.get('retry-after')
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+def _embed_with_retry(embeddings, texts, gate: _RateLimitGate, max_retries: int):
+    for attempt in range(max_retries + 1):
+        gate.wait()
+        try:
+            return embeddings.embed_documents(texts)
+        except RETRYABLE_ERRORS as e:
+            if attempt >= max_retries:
+                raise
+            delay = min(EMBEDDING_BACKOFF_MAX_SECONDS, EMBEDDING_BACKOFF_BASE_SECONDS * (2 ** attempt))
+            delay = _retry_after_seconds(e) or delay * (0.5 + random.random())
+            if isinstance(e, openai.RateLimitError):
+                gate.pause(delay)
+            logger.warning(f"⚠️ Erro temporário no embedding ({type(e).__name__}). Tentativa {attempt + 1}/{max_retries}, aguardando {delay:.1f}s.")
+            time.sleep(delay)
+
+
+def embed_and_store_stream(items, collection, embeddings, checkpoint_path: str = None, run_key: str = None,
+                           max_tokens: int = EMBEDDING_BATCH_MAX_TOKENS, max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+                           max_concurrency: int = EMBEDDING_MAX_CONCURRENCY, max_retries: int = EMBEDDING_MAX_RETRIES,
+                           max_in_flight_batches: int = EMBEDDING_MAX_IN_FLIGHT_BATCHES,
+                           progress_callback=None) -> int:
+    """
+    Gera os embeddings de um fluxo de pares (id, chunk) e grava na coleção do Chroma.
+
+    collection: coleção nativa do Chroma (ex.: vectorstore._collection).
+    checkpoint_path/run_key: lotes concluídos numa execução anterior com a mesma run_key são pulados.
+    max_in_flight_batches: limite de lotes lidos e ainda não gravados; o iterador de entrada só
+        avança quando há espaço, o que mantém a memória limitada.
+    progress_callback(done_batches, written_chunks) é chamado na thread chamadora a cada lote gravado.
+
+    Retorna o número de chunks gravados nesta execução.
+    """
+    checkpoint = _Checkpoint(checkpoint_path, run_key or "")
+    if checkpoint.completed:
+        logger.info(f"♻️ Retomando ingestão: {len(checkpoint.completed)} lotes já concluídos serão pulados.")
+
+    gate = _RateLimitGate()
+    write_lock = threading.Lock()
+    written = 0
+    done_batches = 0
+    skipped_batches = 0
+
+    def _process(batch_key, batch):
+        texts = [chunk.page_content for _, chunk in batch]
+        vectors = _embed_with_retry(embeddings, texts, gate, max_retries)
+        with write_lock:
+            collection.upsert(
+                ids=[chunk_id for chunk_id, _ in batch],
+                embeddings=vectors,
+                documents=texts,
+                # O Chroma rejeita metadados vazios
+                metadatas=[chunk.metadata or {"source": "desconhecido"} for _, chunk in batch],
+            )
+            checkpoint.add(batch_key)
+        return len(batch)
+
+    def _harvest(futures, return_when):
+        nonlocal written, done_batches
+        finished, pending = wait(futures, return_when=return_when)
+        for future in finished:
+            written += future.result()
+            done_batches += 1
+            if progress_callback:
+                progress_callback(done_batches, written)
+        return pending
+
+    in_flight = set()
+    with ThreadPoolExecutor(max_workers=max(1, max_concurrency)) as executor:
+        try:
+            for batch in iter_batches(items, max_tokens, max_items):
+                batch_key = _batch_key(batch)
+                if batch_key in checkpoint.completed:
+                    skipped_batches += 1
+                    continue
+                while len(in_flight) >= max(1, max_in_flight_batches):
+                    in_flight = _harvest(in_flight, FIRST_COMPLETED)
+                in_flight.add(executor.submit(_process, batch_key, batch))
+            _harvest(in_flight, ALL_COMPLETED)
+        except Exception:
+            for future in in_flight:
+                future.cancel()
+            logger.error(f"❌ Ingestão interrompida após {done_batches} lotes gravados. Execute novamente para retomar.")
+            raise
+
+    checkpoint.clear()
+    logger.info(f"✅ {written} chunks gravados em {done_batches} lotes ({skipped_batches} lotes retomados do checkpoint).")
+    return written
+
+
+def embed_and_store(chunks, collection, embeddings, ids=None, checkpoint_path: str = None, **kwargs) -> int:
+    """
+    Versão para listas de embed_and_store_stream.
+    ids: IDs dos chunks; por padrão, IDs posicionais determinísticos.
+    """
+    chunks = list(chunks)
+    if not chunks:
+        return 0
+    fingerprint = chunk_fingerprint(chunks)
+    if ids is None:
+        ids = positional_chunk_ids(chunks, fingerprint)
+    return embed_and_store_stream(zip(ids, chunks), collection, embeddings,
+                                  checkpoint_path=checkpoint_path, run_key=fingerprint, **kwargs)
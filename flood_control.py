@@ -0,0 +1,255 @@
+"""
+Proteção contra flood por remetente (remoteJid).
+
+Cada remetente tem dois limites de janela deslizante: rajada (FLOOD_BURST_LIMIT mensagens em
+FLOOD_BURST_WINDOW_SECONDS) e sustentado (FLOOD_SUSTAINED_LIMIT em
+FLOOD_SUSTAINED_WINDOW_SECONDS). Mensagens acima do limite não geram chamadas à IA:
+
+- FLOOD_ACTION=coalesce (padrão): ficam guardadas e seguem juntas, como uma mensagem só,
+  quando o limite permitir (quem digita várias mensagens curtas seguidas é atendido de uma vez);
+- FLOOD_ACTION=drop: são descartadas.
+
+O remetente recebe FLOOD_COOLDOWN_REPLY no máximo uma vez por janela.
+
+A janela deslizante é aproximada por duas janelas fixas (atual e anterior, ponderada pelo
+tempo decorrido): seis números por remetente. No máximo FLOOD_MAX_TRACKED_SENDERS remetentes
+ficam em memória (LRU); esquecer um remetente inativo só zera a contagem dele, e as mensagens
+guardadas de um remetente esquecido são entregues na hora. As entregas agendadas ficam num heap
+(horário, remetente) atendido por uma única thread, qualquer que seja o número de remetentes.
+"""
+
+import os
+import time
+import heapq
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import FLOOD_LIMITED, FLOOD_COOLDOWN_REPLIES, FLOOD_EVICTED_PENDING, FLOOD_TRACKED_SENDERS
+
+logger = logging.getLogger(__name__)
+
+FLOOD_BURST_LIMIT = int(os.getenv('FLOOD_BURST_LIMIT', 6))
+FLOOD_BURST_WINDOW_SECONDS = float(os.getenv('FLOOD_BURST_WINDOW_SECONDS', 10))
+FLOOD_SUSTAINED_LIMIT = int(os.getenv('FLOOD_SUSTAINED_LIMIT', 40))
+FLOOD_SUSTAINED_WINDOW_SECONDS = float(os.getenv('FLOOD_SUSTAINED_WINDOW_SECONDS', 600))
+FLOOD_ACTION = os.getenv('FLOOD_ACTION', 'coalesce').lower()
+FLOOD_ACTIONS = ('drop', 'coalesce')
+# Mensagens guardadas por remetente para juntar (as mais antigas saem primeiro)
+FLOOD_COALESCE_MAX_MESSAGES = int(os.getenv('FLOOD_COALESCE_MAX_MESSAGES', 10))
+FLOOD_MAX_TRACKED_SENDERS = int(os.getenv('FLOOD_MAX_TRACKED_SENDERS', 100000))
+FLOOD_COOLDOWN_REPLY = os.getenv(
+    'FLOOD_COOLDOWN_REPLY',
+    "Recebi várias mensagens seguidas! ⏳ Vou juntar tudo e responder em instantes."
+)
+
+
+class _SlidingWindow:
+    """Parâmetros de uma janela deslizante (o estado fica em _Sender)."""
+
+    __slots__ = ("limit", "seconds")
+
+    def __init__(self, limit: int, seconds: float):
+        self.limit = max(1, limit)
+        self.seconds = seconds
+
+
+class _Sender:
+    __slots__ = ("windows", "notified_window", "pending_texts", "pending_job", "flush_at")
+
+    def __init__(self, window_count: int):
+        # [índice da janela atual, contagem da anterior, contagem da atual] por janela
+        self.windows = [[0, 0, 0] for _ in range(window_count)]
+        self.notified_window = -1
+        self.pending_texts = None
+        self.pending_job = None
+        # Horário da entrega agendada no heap do FloodLimiter (None se não há)
+        self.flush_at = None
+
+
+class FloodLimiter:
+    """
+    check(job) decide o destino de uma mensagem: "allow" (com o texto das mensagens guardadas
+    à frente), "coalesce" ou "drop". As guardadas são entregues a on_flush(job) quando o
+    limite do remetente permitir. notify(job) envia o aviso de espera (no máximo um por janela).
+    """
+
+    def __init__(self, on_flush=None, notify=None, action: str = FLOOD_ACTION,
+                 burst_limit: int = FLOOD_BURST_LIMIT, burst_seconds: float = FLOOD_BURST_WINDOW_SECONDS,
+                 sustained_limit: int = FLOOD_SUSTAINED_LIMIT, sustained_seconds: float = FLOOD_SUSTAINED_WINDOW_SECONDS,
+                 max_senders: int = FLOOD_MAX_TRACKED_SENDERS, coalesce_max_messages: int = FLOOD_COALESCE_MAX_MESSAGES):
+        if action not in FLOOD_ACTIONS:
+            raise ValueError(f"FLOOD_ACTION inválido: '{action}' (opções: {', '.join(FLOOD_ACTIONS)})")
+        self.on_flush = on_flush
+        self.notify = notify
+        self.action = action
+        self.windows = (_SlidingWindow(burst_limit, burst_seconds), _SlidingWindow(sustained_limit, sustained_seconds))
+        self.max_senders = max(1, max_senders)
+        self.coalesce_max_messages = max(1, coalesce_max_messages)
+        self._senders = OrderedDict()
+        self._lock = threading.Lock()
+        # Entregas agendadas (horário, jid); entradas de remetentes já entregues ou esquecidos
+        # são ignoradas quando saem (o horário não bate mais com sender.flush_at)
+        self._flush_heap = []
+        self._flush_ready = threading.Condition(self._lock)
+        self._flusher = None
+        # Mensagens guardadas de remetentes esquecidos pelo LRU, entregues fora da trava
+        self._evicted_jobs = []
+        self.limited = 0
+
+    def _sender(self, jid: str) -> _Sender:
+        sender = self._senders.get(jid)
+        if sender is None:
+            sender = self._senders[jid] = _Sender(len(self.windows))
+            while len(self._senders) > self.max_senders:
+                evicted_jid, evicted = self._senders.popitem(last=False)
+                if evicted.pending_texts:
+                    FLOOD_EVICTED_PENDING.inc()
+                    logger.warning(f"🚦 Remetente {evicted_jid} esquecido (LRU, {self.max_senders} em memória) com "
+                                   f"{len(evicted.pending_texts)} mensagens guardadas: entregues agora.")
+                    self._evicted_jobs.append(self._pending_job(evicted))
+            FLOOD_TRACKED_SENDERS.set(len(self._senders))
+        else:
+            self._senders.move_to_end(jid)
+        return sender
+
+    def _retry_after(self, sender: _Sender, now: float) -> float:
+        """Segundos até a próxima mensagem caber em todas as janelas (0 se já cabe)."""
+        wait = 0.0
+        for window, state in zip(self.windows, sender.windows):
+            index = int(now // window.seconds)
+            if state[0] == index:
+                previous, current = state[1], state[2]
+            elif state[0] == index - 1:
+                previous, current = state[2], 0
+            else:
+                previous, current = 0, 0
+            elapsed = now / window.seconds - index
+            if previous * (1 - elapsed) + current + 1 <= window.limit:
+                continue
+            if current + 1 > window.limit:
+                # Só cabe na próxima janela, quando a atual vira a "anterior" e vai perdendo peso
+                overflow = 1 - (window.limit - 1) / current if current else 0
+                wait = max(wait, (index + 1 + overflow) * window.seconds - now)
+            else:
+                needed = 1 - (window.limit - 1 - current) / previous
+                wait = max(wait, (index + needed) * window.seconds - now)
+        return wait
+
+    def _record(self, sender: _Sender, now: float):
+        for window, state in zip(self.windows, sender.windows):
+            index = int(now // window.seconds)
+            if state[0] == index - 1:
+                state[1], state[2] = state[2], 0
+            elif state[0] != index:
+                state[1], state[2] = 0, 0
+            state[0] = index
+            state[2] += 1
+
+    def check(self, job: dict):
+        """
+        (decisão, job). Com "allow", o job devolvido traz no texto as mensagens guardadas do
+        remetente (se houver), na ordem em que chegaram.
+        """
+        now = time.time()
+        notify = False
+        with self._lock:
+            sender = self._sender(job["jid"])
+            evicted_jobs, self._evicted_jobs = self._evicted_jobs, []
+            retry_after = self._retry_after(sender, now)
+            if retry_after <= 0:
+                self._record(sender, now)
+                if sender.pending_texts:
+                    job = dict(job, text="\n".join(sender.pending_texts + [job["text"]]))
+                    self._clear_pending(sender)
+            else:
+                self.limited += 1
+                window_index = int(now // self.windows[0].seconds)
+                if sender.notified_window != window_index:
+                    sender.notified_window = window_index
+                    notify = True
+                if self.action == "coalesce":
+                    if sender.pending_texts is None:
+                        sender.pending_texts = []
+                    sender.pending_texts.append(job["text"])
+                    del sender.pending_texts[:-self.coalesce_max_messages]
+                    sender.pending_job = job
+                    if sender.flush_at is None:
+                        self._schedule(job["jid"], sender, now + retry_after)
+        self._deliver(evicted_jobs)
+        if retry_after <= 0:
+            return "allow", job
+        FLOOD_LIMITED.labels(action=self.action).inc()
+        if notify and self.notify is not None:
+            FLOOD_COOLDOWN_REPLIES.inc()
+            self.notify(job)
+        logger.info(f"🚦 Flood de {job['jid']}: mensagem {'guardada' if self.action == 'coalesce' else 'descartada'} "
+                    f"(próxima em {retry_after:.1f}s).")
+        return self.action, job
+
+    @staticmethod
+    def _pending_job(sender: _Sender) -> dict:
+        return dict(sender.pending_job, text="\n".join(sender.pending_texts))
+
+    def _clear_pending(self, sender: _Sender):
+        sender.pending_texts = sender.pending_job = sender.flush_at = None
+
+    def _schedule(self, jid: str, sender: _Sender, flush_at: float):
+        """Agenda a entrega das guardadas do remetente (chamado com a trava)."""
+        sender.flush_at = flush_at
+        heapq.heappush(self._flush_heap, (flush_at, jid))
+        if len(self._flush_heap) > 2 * len(self._senders) + 64:
+            # Entradas vencidas de remetentes já entregues ou esquecidos: o heap fica limitado
+            # pelo número de remetentes em memória, não pelo de mensagens guardadas
+            self._flush_heap = [
+                (due, queued_jid) for due, queued_jid in self._flush_heap
+                if queued_jid in self._senders and self._senders[queued_jid].flush_at == due
+            ]
+            heapq.heapify(self._flush_heap)
+        if self._flusher is None:
+            self._flusher = threading.Thread(target=self._flush_loop, name="flood-flusher", daemon=True)
+            self._flusher.start()
+        elif self._flush_heap[0][1] == jid:
+            # Nova primeira da fila: a thread acorda mais cedo
+            self._flush_ready.notify()
+
+    def _flush_loop(self):
+        """Entrega as mensagens guardadas como uma só, quando o limite de cada remetente permite."""
+        while True:
+            with self._flush_ready:
+                while not self._flush_heap or self._flush_heap[0][0] > time.time():
+                    self._flush_ready.wait(self._flush_heap[0][0] - time.time() if self._flush_heap else None)
+                now = time.time()
+                jobs = []
+                while self._flush_heap and self._flush_heap[0][0] <= now:
+                    flush_at, jid = heapq.heappop(self._flush_heap)
+                    sender = self._senders.get(jid)
+                    if sender is None or sender.flush_at != flush_at or not sender.pending_texts:
+                        continue
+                    retry_after = self._retry_after(sender, now)
+                    if retry_after > 0:
+                        self._schedule(jid, sender, now + retry_after)
+                        continue
+                    self._record(sender, now)
+                    jobs.append(self._pending_job(sender))
+                    self._clear_pending(sender)
+            self._deliver(jobs)
+
+    def _deliver(self, jobs):
+        for job in jobs:
+            if self.on_flush is None:
+                continue
+            try:
+                self.on_flush(job)
+            except Exception as e:
+                logger.error(f"Erro ao entregar as mensagens guardadas de {job['jid']}: {e}", exc_info=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "action": self.action,
+                "tracked_senders": len(self._senders),
+                "coalescing_senders": sum(1 for sender in self._senders.values() if sender.pending_texts),
+                "scheduled_flushes": len(self._flush_heap),
+                "limited": self.limited,
+            }
@@ -0,0 +1,18 @@
+"""
+Configuração do gunicorn (Procfile: gunicorn app:app -c gunicorn.conf.py).
+
+Ao desligar ou reciclar um worker, o hook worker_exit faz o drain das respostas em andamento
+(ver app.drain): o que não terminar dentro de DRAIN_TIMEOUT_SECONDS é gravado para o próximo
+processo. O graceful_timeout dá folga para o drain antes do SIGKILL.
+"""
+
+import os
+import sys
+
+graceful_timeout = int(float(os.getenv('DRAIN_TIMEOUT_SECONDS', 25))) + 5
+
+
+def worker_exit(server, worker):
+    app_module = sys.modules.get("app")
+    if app_module is not None and hasattr(app_module, "drain"):
+        app_module.drain()
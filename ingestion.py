@@ -0,0 +1,358 @@
+"""
+Pipeline de ingestão de documentos (PDF/TXT) para a base de conhecimento.
+Compartilhado por streamlit_app.py e populate_chroma.py.
+
+O parsing de cada arquivo roda em um pool de processos, o progresso é reportado
+arquivo a arquivo e a falha de um arquivo não aborta o restante do lote.
+
+Os arquivos são lidos página a página e os chunks seguem em fluxo até o embedding
+(página → split → lote de embedding → gravação), com um número limitado de páginas
+em trânsito, de forma que o pico de memória não depende do tamanho dos documentos.
+"""
+
+import os
+import re
+import json
+import hashlib
+import logging
+import unicodedata
+import multiprocessing
+from queue import Empty, Full
+from datetime import datetime, timezone
+from concurrent.futures import ProcessPoolExecutor
+
+from langchain_community.document_loaders import PyPDFLoader, TextLoader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+from embedding_pipeline import embed_and_store_stream
+
+logger = logging.getLogger(__name__)
+
+# Configuração padrão do chunker (mesmos valores usados historicamente pelo Streamlit)
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+
+SUPPORTED_EXTENSIONS = ('.pdf', '.txt')
+UPLOAD_DIRECTORY = "uploaded_files"
+
+# Manifesto das fontes ingeridas, mantido dentro do diretório persistente do Chroma
+SOURCES_MANIFEST_FILENAME = "sources_manifest.json"
+
+_WHITESPACE_RE = re.compile(r"\s+")
+
+# Número de processos usados no parsing (0 ou 1 = executa no próprio processo)
+INGESTION_MAX_WORKERS = int(os.getenv('INGESTION_MAX_WORKERS', min(4, os.cpu_count() or 1)))
+# Páginas já divididas aguardando o embedding; os processos de parsing esperam quando o limite é atingido
+INGESTION_MAX_IN_FLIGHT_PAGES = int(os.getenv('INGESTION_MAX_IN_FLIGHT_PAGES', 32))
+
+
+def get_loader(file_path: str):
+    """Retorna o loader do LangChain adequado para a extensão do arquivo."""
+    lower_path = file_path.lower()
+    if lower_path.endswith('.pdf'):
+        return PyPDFLoader(file_path)
+    if lower_path.endswith('.txt'):
+        return TextLoader(file_path, autodetect_encoding=True)
+    raise ValueError(f"Formato de arquivo não suportado: {os.path.basename(file_path)}")
+
+
+def get_text_splitter(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    return RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+
+
+def chunker_settings(chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP) -> dict:
+    """Descrição do chunker gravada no manifesto da base (ver kb_store.py)."""
+    return {"splitter": "RecursiveCharacterTextSplitter", "chunk_size": chunk_size, "chunk_overlap": chunk_overlap}
+
+
+def split_documents(documents, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    """Divide documentos já carregados em chunks com a configuração padrão do pipeline."""
+    return get_text_splitter(chunk_size, chunk_overlap).split_documents(documents)
+
+
+def iter_page_chunks(file_path: str, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP):
+    """Carrega o arquivo página a página (lazy_load) e gera a lista de chunks de cada página."""
+    splitter = get_text_splitter(chunk_size, chunk_overlap)
+    for page in get_loader(file_path).lazy_load():
+        yield splitter.split_documents([page])
+
+
+def _stream_file_into_queue(file_path: str, chunk_size: int, chunk_overlap: int, queue, stop_event):
+    """
+    Executada dentro dos processos do pool: envia os chunks de cada página pela fila
+    (bloqueando quando ela está cheia) e sinaliza o fim ou o erro do arquivo.
+    """
+    def _put(message):
+        while not stop_event.is_set():
+            try:
+                queue.put(message, timeout=0.5)
+                return True
+            except Full:
+                continue
+        return False
+
+    try:
+        count = 0
+        for page_chunks in iter_page_chunks(file_path, chunk_size, chunk_overlap):
+            if page_chunks and not _put(("chunks", file_path, page_chunks)):
+                return
+            count += len(page_chunks)
+        _put(("done", file_path, count))
+    except Exception as e:
+        _put(("error", file_path, f"{type(e).__name__}: {e}"))
+
+
+def save_uploaded_files(uploaded_files, upload_directory: str = UPLOAD_DIRECTORY):
+    """Salva os arquivos enviados pelo Streamlit em disco e retorna os caminhos."""
+    os.makedirs(upload_directory, exist_ok=True)
+    saved_files = []
+    for uploaded_file in uploaded_files:
+        file_path = os.path.join(upload_directory, uploaded_file.name)
+        with open(file_path, "wb") as f:
+            f.write(uploaded_file.getbuffer())
+        saved_files.append(file_path)
+    return saved_files
+
+
+def iter_chunks(file_paths, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                max_workers: int = None, max_in_flight_pages: int = INGESTION_MAX_IN_FLIGHT_PAGES,
+                progress_callback=None, failures: dict = None):
+    """
+    Gera os chunks de vários arquivos à medida que as páginas são processadas.
+
+    Com max_workers > 1, cada arquivo é lido num processo do pool e as páginas chegam por uma
+    fila limitada a max_in_flight_pages (os chunks de arquivos diferentes podem se intercalar).
+    progress_callback(done, total, file_path, error) é chamado a cada arquivo concluído.
+    failures (dict opcional) recebe {file_path: mensagem de erro}; os chunks já emitidos de
+    um arquivo que falhou no meio devem ser descartados pelo chamador.
+    """
+    file_paths = list(file_paths)
+    total = len(file_paths)
+    if failures is None:
+        failures = {}
+    if max_workers is None:
+        max_workers = INGESTION_MAX_WORKERS
+
+    reported = set()
+
+    def _report(file_path, count=None, error=None):
+        reported.add(file_path)
+        if error is None:
+            logger.info(f"📄 [{len(reported)}/{total}] {os.path.basename(file_path)}: {count} chunks.")
+        else:
+            failures[file_path] = str(error)
+            logger.error(f"❌ [{len(reported)}/{total}] Falha ao processar {os.path.basename(file_path)}: {error}")
+        if progress_callback:
+            progress_callback(len(reported), total, file_path, failures.get(file_path))
+
+    if max_workers <= 1 or total <= 1:
+        for file_path in file_paths:
+            count = 0
+            try:
+                for page_chunks in iter_page_chunks(file_path, chunk_size, chunk_overlap):
+                    count += len(page_chunks)
+                    yield from page_chunks
+            except Exception as e:
+                _report(file_path, error=f"{type(e).__name__}: {e}")
+            else:
+                _report(file_path, count=count)
+        return
+
+    with multiprocessing.Manager() as manager:
+        queue = manager.Queue(maxsize=max(1, max_in_flight_pages))
+        stop_event = manager.Event()
+        with ProcessPoolExecutor(max_workers=min(max_workers, total)) as executor:
+            futures = {
+                executor.submit(_stream_file_into_queue, file_path, chunk_size, chunk_overlap, queue, stop_event): file_path
+                for file_path in file_paths
+            }
+            try:
+                while len(reported) < total:
+                    try:
+                        kind, file_path, payload = queue.get(timeout=1.0)
+                    except Empty:
+                        # Processos que morreram sem conseguir reportar (ex.: pool quebrado)
+                        for future, file_path in futures.items():
+                            if future.done() and future.exception() and file_path not in reported:
+                                _report(file_path, error=future.exception())
+                        continue
+                    if kind == "chunks":
+                        yield from payload
+                    elif kind == "done":
+                        _report(file_path, count=payload)
+                    else:
+                        _report(file_path, error=payload)
+            finally:
+                # Libera os processos bloqueados na fila se o consumidor parar antes do fim
+                stop_event.set()
+                for future in futures:
+                    future.cancel()
+
+
+def load_and_split_files(file_paths, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP,
+                         max_workers: int = None, progress_callback=None):
+    """
+    Carrega e divide vários arquivos em paralelo, acumulando todos os chunks em memória.
+    Para arquivos grandes prefira iter_chunks + ingest_incremental.
+
+    Retorna (chunks, failures), onde failures é um dict {file_path: mensagem de erro}.
+    Os chunks preservam a ordem dos arquivos de entrada.
+    """
+    file_paths = list(file_paths)
+    failures = {}
+    chunks_by_file = {}
+    for chunk in iter_chunks(file_paths, chunk_size, chunk_overlap, max_workers=max_workers,
+                             progress_callback=progress_callback, failures=failures):
+        chunks_by_file.setdefault(chunk_source(chunk), []).append(chunk)
+
+    chunks = []
+    for file_path in file_paths:
+        if file_path not in failures:
+            chunks.extend(chunks_by_file.get(file_path, []))
+    return chunks, failures
+
+
+def files_run_key(file_paths, chunk_size: int = CHUNK_SIZE, chunk_overlap: int = CHUNK_OVERLAP, extra_texts=()) -> str:
+    """Identifica uma ingestão pelo conteúdo dos arquivos e pela configuração do chunker (usada no checkpoint)."""
+    digest = hashlib.sha256(f"{chunk_size}:{chunk_overlap}".encode("utf-8"))
+    for file_path in sorted(file_paths):
+        digest.update(os.path.basename(file_path).encode("utf-8"))
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(block)
+    for text in extra_texts:
+        digest.update(text.encode("utf-8"))
+    return digest.hexdigest()
+
+
+
+def tag_chunks(chunks, tag: str = None):
+    """
+    Marca os chunks com metadata["tag"] (ex.: "produtos", "suporte") para filtrar a busca
+    por assunto (ver knowledge_bases.py). Sem tag, repassa os chunks como estão.
+    """
+    for chunk in chunks:
+        if tag:
+            chunk.metadata["tag"] = tag
+        yield chunk
+
+# --- IDs determinísticos e ingestão incremental ---
+
+def normalize_content(text: str) -> str:
+    """Normaliza o texto do chunk (Unicode NFC e espaços colapsados) antes do hash."""
+    return _WHITESPACE_RE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def chunk_source(chunk) -> str:
+    return str(chunk.metadata.get("source", "desconhecido"))
+
+
+def content_chunk_id(source: str, content: str) -> str:
+    """ID determinístico do chunk: hash da fonte + conteúdo normalizado."""
+    payload = f"{source}\x00{normalize_content(content)}".encode("utf-8")
+    return hashlib.sha256(payload).hexdigest()[:32]
+
+
+def load_sources_manifest(persist_directory: str) -> dict:
+    path = os.path.join(persist_directory, SOURCES_MANIFEST_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("sources", {})
+    except Exception as e:
+        logger.warning(f"⚠️ Manifesto de fontes ilegível em '{path}' ({e}). Ignorando.")
+        return {}
+
+
+def save_sources_manifest(persist_directory: str, sources: dict):
+    os.makedirs(persist_directory, exist_ok=True)
+    path = os.path.join(persist_directory, SOURCES_MANIFEST_FILENAME)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump({"sources": sources}, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _skip_stored(collection, items, stats: dict, page_size: int = 256):
+    """Descarta os pares (id, chunk) que já estão na coleção (bases sem manifesto ou builds retomados)."""
+    page = []
+
+    def _flush():
+        existing = set(collection.get(ids=[chunk_id for chunk_id, _ in page], include=[]).get("ids", []))
+        stats["unchanged"] += len(existing)
+        return [(chunk_id, chunk) for chunk_id, chunk in page if chunk_id not in existing]
+
+    for item in items:
+        page.append(item)
+        if len(page) >= page_size:
+            yield from _flush()
+            page = []
+    if page:
+        yield from _flush()
+
+
+def _delete_ids(collection, ids, page_size: int = 1000):
+    ids = list(ids)
+    for start in range(0, len(ids), page_size):
+        collection.delete(ids=ids[start:start + page_size])
+
+
+def ingest_incremental(chunks, collection, embeddings, persist_directory: str, checkpoint_path: str = None,
+                       run_key: str = None, failures: dict = None, progress_callback=None) -> dict:
+    """
+    Aplica na coleção apenas a diferença entre os chunks recebidos e o que já foi ingerido.
+
+    chunks pode ser um gerador (ex.: iter_chunks): os chunks seguem em fluxo para o embedding
+    e só os IDs ficam em memória. Para cada fonte recebida, chunks inalterados são ignorados,
+    chunks novos passam pelo embedding e chunks que deixaram de existir são removidos.
+    Fontes listadas em failures (arquivos que falharam no parsing) são revertidas: os chunks
+    novos gravados delas são apagados e o manifesto delas não muda.
+
+    Retorna as contagens {"added", "unchanged", "deleted", "failed_sources"}.
+    """
+    if failures is None:
+        failures = {}
+    sources_manifest = load_sources_manifest(persist_directory)
+    previous_ids = {source: set(entry.get("chunk_ids", [])) for source, entry in sources_manifest.items()}
+    seen_ids = {}
+    stats = {"added": 0, "unchanged": 0, "deleted": 0, "failed_sources": []}
+
+    def _new_items():
+        for chunk in chunks:
+            source = chunk_source(chunk)
+            chunk_id = content_chunk_id(source, chunk.page_content)
+            source_ids = seen_ids.setdefault(source, {})  # dict como conjunto ordenado
+            if chunk_id in source_ids:
+                continue
+            source_ids[chunk_id] = None
+            if chunk_id in previous_ids.get(source, ()):
+                stats["unchanged"] += 1
+                continue
+            yield chunk_id, chunk
+
+    stats["added"] = embed_and_store_stream(
+        _skip_stored(collection, _new_items(), stats),
+        collection,
+        embeddings,
+        checkpoint_path=checkpoint_path,
+        run_key=run_key,
+        progress_callback=progress_callback,
+    )
+
+    now = datetime.now(timezone.utc).isoformat()
+    for source, source_ids in seen_ids.items():
+        old_ids = previous_ids.get(source, set())
+        if source in failures:
+            _delete_ids(collection, [chunk_id for chunk_id in source_ids if chunk_id not in old_ids])
+            stats["failed_sources"].append(source)
+            continue
+        obsolete = [chunk_id for chunk_id in old_ids if chunk_id not in source_ids]
+        _delete_ids(collection, obsolete)
+        stats["deleted"] += len(obsolete)
+        sources_manifest[source] = {"chunk_ids": list(source_ids), "ingested_at": now}
+
+    save_sources_manifest(persist_directory, sources_manifest)
+    logger.info(f"🔁 Ingestão incremental: {stats['added']} chunks novos, {stats['unchanged']} inalterados, "
+                f"{stats['deleted']} removidos, {len(stats['failed_sources'])} fontes com falha.")
+    return stats
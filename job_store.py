@@ -0,0 +1,96 @@
+"""
+Jobs de mensagens guardados em disco para o próximo processo.
+
+No desligamento (deploy, reciclagem de worker) as mensagens que não puderam ser respondidas
+a tempo são gravadas aqui; o próximo processo as reivindica na inicialização e as processa.
+Cada arquivo é reivindicado com um rename atômico, então dois workers nunca pegam o mesmo.
+"""
+
+import os
+import json
+import time
+import uuid
+import glob
+import logging
+
+logger = logging.getLogger(__name__)
+
+PENDING_JOBS_DIRECTORY = os.getenv('PENDING_JOBS_DIRECTORY', './pending_jobs')
+# Jobs mais antigos que isso são descartados na retomada (a resposta já não faz sentido)
+PENDING_JOB_MAX_AGE_SECONDS = float(os.getenv('PENDING_JOB_MAX_AGE_SECONDS', 3600))
+DRAIN_REPORT_FILENAME = "last_drain.json"
+
+
+class PendingJobStore:
+    """Arquivos JSON Lines com jobs pendentes (dicts com "received_at" em epoch)."""
+
+    def __init__(self, directory: str = PENDING_JOBS_DIRECTORY, max_age_seconds: float = PENDING_JOB_MAX_AGE_SECONDS):
+        self.directory = directory
+        self.max_age_seconds = max_age_seconds
+
+    def save(self, jobs, reason: str = "shutdown"):
+        """Grava os jobs num arquivo novo. Retorna o caminho (ou None se não havia jobs)."""
+        jobs = list(jobs)
+        if not jobs:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        name = f"pending-{int(time.time() * 1000)}-{os.getpid()}-{uuid.uuid4().hex[:8]}.jsonl"
+        path = os.path.join(self.directory, name)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for job in jobs:
+                f.write(json.dumps(job, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+        logger.info(f"💾 {len(jobs)} jobs pendentes gravados em {path} ({reason}).")
+        return path
+
+    def claim(self, limit: int = None):
+        """
+        Reivindica e remove os arquivos pendentes, do mais antigo ao mais novo, até somar
+        `limit` jobs (todos, sem limite). Retorna os jobs ainda dentro do prazo.
+        """
+        jobs, expired = [], 0
+        now = time.time()
+        for path in sorted(glob.glob(os.path.join(self.directory, "pending-*.jsonl"))):
+            if limit is not None and len(jobs) >= limit:
+                break
+            claimed_path = f"{path}.claimed-{os.getpid()}"
+            try:
+                os.rename(path, claimed_path)
+            except FileNotFoundError:
+                continue  # Outro worker reivindicou primeiro
+            try:
+                with open(claimed_path, "r", encoding="utf-8") as f:
+                    for line in f:
+                        if not line.strip():
+                            continue
+                        job = json.loads(line)
+                        if now - job.get("received_at", now) > self.max_age_seconds:
+                            expired += 1
+                        else:
+                            jobs.append(job)
+            except Exception as e:
+                logger.error(f"❌ Arquivo de jobs pendentes ilegível '{claimed_path}': {e}")
+                continue
+            os.remove(claimed_path)
+        if jobs or expired:
+            logger.info(f"📥 {len(jobs)} jobs pendentes retomados ({expired} expirados descartados).")
+        return jobs
+
+    def write_drain_report(self, report: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, DRAIN_REPORT_FILENAME)
+        tmp_path = f"{path}.tmp-{os.getpid()}"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(report, f)
+        os.replace(tmp_path, path)
+
+    def read_drain_report(self):
+        """Relatório do último drain de qualquer worker (para /health), ou None."""
+        try:
+            with open(os.path.join(self.directory, DRAIN_REPORT_FILENAME), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
@@ -0,0 +1,291 @@
+"""
+Armazenamento versionado da base de conhecimento (ChromaDB).
+
+Cada build é gravado num diretório de staging, validado e publicado por uma troca
+atômica do link simbólico ./chroma_db → chroma_db_versions/<versão>. Quem já abriu a
+versão anterior (ex.: workers do app.py) continua servindo-a até recarregar, e as
+últimas KB_KEEP_VERSIONS versões são mantidas para rollback instantâneo.
+
+Cada versão publicada carrega um manifesto (kb_manifest.json) com o modelo e a dimensão
+dos embeddings, a configuração do chunker, o número de chunks, a data do build e um hash
+de versão. O app.py valida a compatibilidade lendo só esse arquivo.
+"""
+
+import os
+import json
+import uuid
+import fcntl
+import shutil
+import hashlib
+import logging
+from datetime import datetime, timezone
+from contextlib import contextmanager
+
+import chromadb
+
+from vector_index import VECTOR_BACKEND, build_numpy_index
+from lexical_index import build_bm25_index
+
+logger = logging.getLogger(__name__)
+
+# Nome padrão da coleção criada pelo wrapper Chroma do LangChain
+COLLECTION_NAME = "langchain"
+
+KB_KEEP_VERSIONS = int(os.getenv('KB_KEEP_VERSIONS', 3))
+
+STAGING_PREFIX = ".staging-"
+LOCK_FILENAME = ".lock"
+MANIFEST_FILENAME = "kb_manifest.json"
+MANIFEST_FORMAT_VERSION = 1
+
+
+def versions_directory_for(pointer: str) -> str:
+    """Diretório que guarda as versões publicadas de um ponteiro (ex.: ./chroma_db → ./chroma_db_versions)."""
+    return f"{os.path.normpath(pointer)}_versions"
+
+
+@contextmanager
+def _publish_lock(pointer: str):
+    versions_directory = versions_directory_for(pointer)
+    os.makedirs(versions_directory, exist_ok=True)
+    with open(os.path.join(versions_directory, LOCK_FILENAME), "w") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield versions_directory
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def resolve_version_path(pointer: str):
+    """
+    Caminho real da versão publicada (None se não houver base).
+    Leitores devem abrir o Chroma por este caminho, e não pelo ponteiro: assim continuam
+    na mesma versão mesmo que uma nova seja publicada enquanto estão em uso.
+    """
+    if not os.path.lexists(pointer):
+        return None
+    path = os.path.realpath(pointer)
+    return path if os.path.isdir(path) else None
+
+
+def list_versions(pointer: str):
+    """Versões publicadas, da mais antiga para a mais recente."""
+    versions_directory = versions_directory_for(pointer)
+    if not os.path.isdir(versions_directory):
+        return []
+    return sorted(
+        os.path.join(versions_directory, name)
+        for name in os.listdir(versions_directory)
+        if not name.startswith(".") and os.path.isdir(os.path.join(versions_directory, name))
+    )
+
+
+def create_staging_directory(pointer: str, run_key: str = None, copy_current: bool = False) -> str:
+    """
+    Cria (ou reaproveita) um diretório de staging para um novo build.
+
+    Se já existe um staging da mesma run_key, do mesmo modo e partindo da mesma versão
+    publicada (build interrompido), ele é reaproveitado para retomar a ingestão. Com
+    copy_current=True o staging novo parte de uma cópia da versão publicada (usado para
+    adicionar documentos sem tocar na versão em uso); se outra versão foi publicada depois
+    da interrupção, o staging antigo é descartado, senão publicaria uma cópia desatualizada.
+    """
+    versions_directory = versions_directory_for(pointer)
+    os.makedirs(versions_directory, exist_ok=True)
+    current_path = resolve_version_path(pointer) if copy_current else None
+    mode = "add" if copy_current else "create"
+    # Versão de origem no nome: só um build com a mesma base de partida pode ser retomado
+    parent = hashlib.sha256(os.path.basename(current_path).encode("utf-8")).hexdigest()[:8] if current_path else "empty"
+    run_prefix = f"{STAGING_PREFIX}{(run_key or uuid.uuid4().hex)[:16]}-{mode}-"
+    prefix = f"{run_prefix}{parent}-"
+
+    for name in sorted(os.listdir(versions_directory)):
+        staging_path = os.path.join(versions_directory, name)
+        if name.startswith(prefix):
+            logger.info(f"♻️ Reaproveitando staging de build interrompido: {staging_path}")
+            return staging_path
+        if name.startswith(run_prefix):
+            logger.info(f"🗑️ Staging de build interrompido descartado (a versão publicada mudou): {staging_path}")
+            discard_staging_directory(staging_path)
+
+    # Sufixo aleatório: o cliente do Chroma mantém cache por caminho, então um caminho nunca é reutilizado
+    staging_path = os.path.join(versions_directory, f"{prefix}{uuid.uuid4().hex[:8]}")
+    if current_path:
+        shutil.copytree(current_path, staging_path)
+    else:
+        os.makedirs(staging_path)
+    logger.info(f"📦 Staging criado em {staging_path}")
+    return staging_path
+
+
+def discard_staging_directory(staging_path: str):
+    shutil.rmtree(staging_path, ignore_errors=True)
+
+
+def validate_version(path: str) -> dict:
+    """
+    Valida uma versão antes de publicar: a coleção precisa abrir, ter chunks e embeddings
+    com dimensão consistente. Retorna {"document_count", "embedding_dimension", "version_hash"};
+    levanta ValueError se inválida.
+    """
+    client = chromadb.PersistentClient(path=path)
+    collection = client.get_collection(COLLECTION_NAME)
+    count = collection.count()
+    if count == 0:
+        raise ValueError("a coleção está vazia")
+    sample = collection.peek(limit=1)
+    embeddings = sample.get("embeddings")
+    if embeddings is None or len(embeddings) == 0 or len(embeddings[0]) == 0:
+        raise ValueError("a coleção não contém embeddings")
+    return {
+        "document_count": count,
+        "embedding_dimension": len(embeddings[0]),
+        "version_hash": _content_hash(collection, count),
+    }
+
+
+def _content_hash(collection, count: int, page_size: int = 5000) -> str:
+    """Hash dos IDs dos chunks (que já são hashes de conteúdo): muda sempre que o conteúdo muda."""
+    ids = []
+    for offset in range(0, count, page_size):
+        ids.extend(collection.get(include=[], limit=page_size, offset=offset)["ids"])
+    return hashlib.sha256("\n".join(sorted(ids)).encode("utf-8")).hexdigest()
+
+
+def read_manifest(path: str):
+    """Manifesto de uma versão (ou de um staging), ou None se ausente/ilegível (bases antigas)."""
+    if not path:
+        return None
+    manifest_path = os.path.join(path, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception as e:
+        logger.warning(f"⚠️ Manifesto da base ilegível em '{manifest_path}' ({e}).")
+        return None
+
+
+def _write_manifest(path: str, manifest: dict):
+    manifest_path = os.path.join(path, MANIFEST_FILENAME)
+    tmp_path = f"{manifest_path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, manifest_path)
+
+
+def check_manifest(manifest: dict, embedding_model: str, embedding_dimension: int = None):
+    """Levanta ValueError se a base foi construída com outro modelo ou outra dimensão de embedding."""
+    if manifest.get("embedding_model") != embedding_model:
+        raise ValueError(
+            f"a base foi construída com o modelo '{manifest.get('embedding_model')}', "
+            f"mas o configurado é '{embedding_model}'"
+        )
+    if embedding_dimension and manifest.get("embedding_dimension") != embedding_dimension:
+        raise ValueError(
+            f"a base tem embeddings de {manifest.get('embedding_dimension')} dimensões, "
+            f"mas o modelo configurado gera {embedding_dimension}"
+        )
+
+
+def build_manifest(staging_path: str, embedding_model: str, chunkers) -> dict:
+    """
+    Monta o manifesto de um staging validado. Se o staging partiu de uma cópia da versão
+    publicada, o modelo precisa ser o mesmo e as configurações de chunker anteriores são mantidas.
+    """
+    stats = validate_version(staging_path)
+    chunkers = list(chunkers or [])
+    previous = read_manifest(staging_path)
+    if previous:
+        check_manifest(previous, embedding_model, stats["embedding_dimension"])
+        chunkers = [c for c in previous.get("chunkers", []) if c not in chunkers] + chunkers
+    return {
+        "format_version": MANIFEST_FORMAT_VERSION,
+        "embedding_model": embedding_model,
+        "embedding_dimension": stats["embedding_dimension"],
+        "chunkers": chunkers,
+        "document_count": stats["document_count"],
+        "built_at": datetime.now(timezone.utc).isoformat(),
+        "version_hash": hashlib.sha256(
+            f"{embedding_model}:{stats['embedding_dimension']}:{stats['version_hash']}".encode("utf-8")
+        ).hexdigest()[:16],
+    }
+
+
+def _swap_pointer(pointer: str, target: str):
+    """Troca atômica do link simbólico (symlink temporário + rename)."""
+    link_target = os.path.relpath(target, os.path.dirname(os.path.abspath(pointer)))
+    tmp_link = f"{os.path.normpath(pointer)}.tmp-{uuid.uuid4().hex[:8]}"
+    os.symlink(link_target, tmp_link)
+    os.replace(tmp_link, pointer)
+
+
+def _migrate_legacy_directory(pointer: str, versions_directory: str):
+    """Bases antigas eram um diretório real em ./chroma_db: vira uma versão para poder ser substituída por um link."""
+    if os.path.isdir(pointer) and not os.path.islink(pointer):
+        legacy_path = os.path.join(versions_directory, f"legacy-{datetime.now(timezone.utc):%Y%m%d%H%M%S}")
+        os.rename(pointer, legacy_path)
+        _swap_pointer(pointer, legacy_path)
+        logger.info(f"Base legada movida para {legacy_path}")
+
+
+def _prune_versions(pointer: str, keep: int):
+    current_path = resolve_version_path(pointer)
+    versions = list_versions(pointer)
+    for version_path in versions[:max(0, len(versions) - keep)]:
+        if version_path != current_path:
+            shutil.rmtree(version_path, ignore_errors=True)
+            logger.info(f"🗑️ Versão antiga removida: {version_path}")
+
+
+def publish_version(pointer: str, staging_path: str, embedding_model: str, chunkers=(),
+                    keep: int = KB_KEEP_VERSIONS) -> str:
+    """
+    Valida o staging, grava o manifesto, move-o para uma versão definitiva e aponta o
+    ponteiro para ela atomicamente. Mantém as últimas `keep` versões.
+
+    chunkers: configurações de chunker usadas no build (ver ingestion.chunker_settings).
+    Retorna o caminho da versão publicada.
+    """
+    manifest = build_manifest(staging_path, embedding_model, chunkers)
+    _write_manifest(staging_path, manifest)
+    # Índices derivados são gerados antes da troca para que os workers não precisem exportá-los ao recarregar.
+    # O BM25 é sempre gerado (custo pequeno perto do embedding), então RETRIEVAL_MODE pode mudar sem rebuild.
+    build_bm25_index(staging_path)
+    if VECTOR_BACKEND == "numpy":
+        build_numpy_index(staging_path)
+    with _publish_lock(pointer) as versions_directory:
+        _migrate_legacy_directory(pointer, versions_directory)
+        version_name = f"v{datetime.now(timezone.utc):%Y%m%d%H%M%S}-{uuid.uuid4().hex[:6]}"
+        version_path = os.path.join(versions_directory, version_name)
+        os.rename(staging_path, version_path)
+        _swap_pointer(pointer, version_path)
+        _prune_versions(pointer, keep)
+    logger.info(f"🚀 Versão {version_name} publicada com {manifest['document_count']} chunks (hash {manifest['version_hash']}).")
+    return version_path
+
+
+def rollback(pointer: str) -> str:
+    """Aponta o ponteiro para a versão publicada anterior à atual. Retorna o caminho dela."""
+    with _publish_lock(pointer):
+        current_path = resolve_version_path(pointer)
+        versions = list_versions(pointer)
+        if current_path not in versions or versions.index(current_path) == 0:
+            raise ValueError("não há versão anterior disponível para rollback")
+        previous_path = versions[versions.index(current_path) - 1]
+        _swap_pointer(pointer, previous_path)
+    logger.info(f"⏪ Rollback da base de conhecimento para {previous_path}")
+    return previous_path
+
+
+def reset_knowledge_base(pointer: str):
+    """Remove o ponteiro e todas as versões (ação explícita de 'Resetar Base')."""
+    with _publish_lock(pointer) as versions_directory:
+        if os.path.islink(pointer):
+            os.unlink(pointer)
+        elif os.path.isdir(pointer):
+            shutil.rmtree(pointer, ignore_errors=True)
+        for name in os.listdir(versions_directory):
+            if name != LOCK_FILENAME:
+                shutil.rmtree(os.path.join(versions_directory, name), ignore_errors=True)
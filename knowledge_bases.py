@@ -0,0 +1,411 @@
+"""
+Bases de conhecimento por tenant (instância do WhatsApp) para o app.py.
+
+Cada base é um ponteiro versionado próprio (ver kb_store.py): a base padrão continua em
+./chroma_db e as demais ficam em KNOWLEDGE_BASES_DIRECTORY/<nome>. A instância do webhook
+escolhe a base (e, opcionalmente, um filtro de metadados) pelo mapa KB_TENANTS.
+
+O KnowledgeBaseRegistry mantém um LRU de no máximo KB_MAX_OPEN bases abertas, de modo que
+um processo atende muitos números sem carregar todas as bases na memória, e recarrega cada
+base quando uma nova versão dela é publicada.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+from chromadb.api.shared_system_client import SharedSystemClient
+from langchain_chroma import Chroma
+from langchain.chains import RetrievalQA
+
+from kb_store import resolve_version_path, read_manifest, check_manifest
+from embedding_pipeline import EMBEDDING_MODEL, EMBEDDING_MODEL_DIMENSIONS
+from vector_index import VECTOR_BACKEND, VECTOR_BACKENDS, VECTOR_INDEX_DTYPE, FILTER_FIELDS, NumpyVectorIndex, NumpyRetriever
+from lexical_index import RETRIEVAL_MODE, RETRIEVAL_MODES, HYBRID_CANDIDATES, BM25Index, HybridRetriever
+from reranking import RAG_MMR_ENABLED, RAG_MMR_FETCH_K, RAG_MMR_LAMBDA, MMRRetriever, chroma_vector_lookup
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KNOWLEDGE_BASE = "default"
+DEFAULT_PERSIST_DIRECTORY = "./chroma_db"
+KNOWLEDGE_BASES_DIRECTORY = os.getenv('KNOWLEDGE_BASES_DIRECTORY', './knowledge_bases')
+
+# Bases abertas ao mesmo tempo por processo (as menos usadas recentemente são fechadas)
+KB_MAX_OPEN = int(os.getenv('KB_MAX_OPEN', 8))
+# Intervalo mínimo entre verificações de nova versão publicada, por base
+KB_RELOAD_CHECK_SECONDS = float(os.getenv('KB_RELOAD_CHECK_SECONDS', 10))
+# Instância → {"knowledge_base": "<nome>", "filter": {"tag": "..."}} (JSON). Instâncias fora do mapa
+# usam a base com o próprio ID, se existir; senão, a base padrão (se KB_SHARED_FALLBACK).
+KB_TENANTS = json.loads(os.getenv('KB_TENANTS', '{}') or '{}')
+KB_SHARED_FALLBACK = os.getenv('KB_SHARED_FALLBACK', 'true').lower() == 'true'
+
+# Número de chunks enviados ao modelo
+RAG_TOP_K = 3
+
+KNOWLEDGE_BASE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9][A-Za-z0-9_.-]{0,63}$")
+
+
+def persist_directory_for(name: str) -> str:
+    """Ponteiro da base com esse nome. Nomes são validados porque viram caminhos no disco."""
+    if not name or name == DEFAULT_KNOWLEDGE_BASE:
+        return DEFAULT_PERSIST_DIRECTORY
+    if not KNOWLEDGE_BASE_NAME_PATTERN.match(name) or ".." in name or name.endswith("_versions"):
+        raise ValueError(f"nome de base de conhecimento inválido: '{name}'")
+    return os.path.join(KNOWLEDGE_BASES_DIRECTORY, name)
+
+
+def list_knowledge_bases():
+    """Nomes das bases com alguma versão publicada (a padrão sempre primeiro)."""
+    names = [DEFAULT_KNOWLEDGE_BASE]
+    if os.path.isdir(KNOWLEDGE_BASES_DIRECTORY):
+        for entry in sorted(os.listdir(KNOWLEDGE_BASES_DIRECTORY)):
+            if KNOWLEDGE_BASE_NAME_PATTERN.match(entry) and not entry.endswith("_versions") \
+                    and resolve_version_path(os.path.join(KNOWLEDGE_BASES_DIRECTORY, entry)):
+                names.append(entry)
+    return names
+
+
+def validate_metadata_filter(metadata_filter):
+    """Normaliza um filtro {campo: valor}; só os campos de FILTER_FIELDS são aceitos."""
+    if not metadata_filter:
+        return None
+    if not isinstance(metadata_filter, dict):
+        raise ValueError("o filtro de metadados deve ser um objeto {campo: valor}")
+    unknown = [field for field in metadata_filter if field not in FILTER_FIELDS]
+    if unknown:
+        raise ValueError(f"campos de filtro não suportados: {unknown} (opções: {', '.join(FILTER_FIELDS)})")
+    return {field: str(value) for field, value in metadata_filter.items()}
+
+
+def resolve_tenant(instance_id: str = None):
+    """Base de conhecimento e filtro de metadados de uma instância: (nome da base, filtro)."""
+    if not instance_id:
+        return DEFAULT_KNOWLEDGE_BASE, None
+    config = KB_TENANTS.get(instance_id)
+    if config:
+        return config.get("knowledge_base", DEFAULT_KNOWLEDGE_BASE), validate_metadata_filter(config.get("filter"))
+    try:
+        if resolve_version_path(persist_directory_for(instance_id)):
+            return instance_id, None
+    except ValueError:
+        pass
+    return (DEFAULT_KNOWLEDGE_BASE if KB_SHARED_FALLBACK else None), None
+
+
+def _chroma_where(metadata_filter: dict):
+    if len(metadata_filter) == 1:
+        return dict(metadata_filter)
+    return {"$and": [{field: value} for field, value in metadata_filter.items()]}
+
+
+class KnowledgeBaseClosed(RuntimeError):
+    pass
+
+
+# Bases abertas por caminho do Chroma: a mesma versão reaberta (ex.: depois do LRU) compartilha
+# o System em cache do chromadb, que só pode ser parado quando a última delas fecha
+_chroma_users = {}
+_chroma_users_lock = threading.Lock()
+
+
+def _acquire_chroma_system(identifier: str):
+    with _chroma_users_lock:
+        _chroma_users[identifier] = _chroma_users.get(identifier, 0) + 1
+
+
+def _release_chroma_system(identifier: str):
+    with _chroma_users_lock:
+        remaining = _chroma_users.get(identifier, 1) - 1
+        if remaining > 0:
+            _chroma_users[identifier] = remaining
+            return
+        _chroma_users.pop(identifier, None)
+        system = SharedSystemClient._identifier_to_system.pop(identifier, None)
+    if system is not None:
+        system.stop()
+
+
+class KnowledgeBase:
+    """
+    Uma versão aberta de uma base: o backend vetorial configurado (VECTOR_BACKEND), o índice
+    BM25 (RETRIEVAL_MODE=hybrid) e as cadeias RAG, uma por filtro de metadados.
+
+    Consultas usam a base pega com KnowledgeBaseRegistry.acquire() até release(): quando o
+    registro descarrega ou substitui a base (retire()), ela só é fechada depois que a última
+    consulta em curso termina.
+    """
+
+    def __init__(self, name: str, version_path: str, llm, embeddings):
+        self.name = name
+        self.version_path = version_path
+        self.llm = llm
+        self.embeddings = embeddings
+        self._chains = {}
+        self._chains_lock = threading.Lock()
+        self._usage_lock = threading.Lock()
+        self._users = 0
+        self._retired = False
+        self._closed = False
+
+        if RETRIEVAL_MODE not in RETRIEVAL_MODES:
+            raise ValueError(f"RETRIEVAL_MODE inválido: '{RETRIEVAL_MODE}' (opções: {', '.join(RETRIEVAL_MODES)})")
+        if VECTOR_BACKEND not in VECTOR_BACKENDS:
+            raise ValueError(f"VECTOR_BACKEND inválido: '{VECTOR_BACKEND}' (opções: {', '.join(VECTOR_BACKENDS)})")
+
+        # A compatibilidade (modelo e dimensão dos embeddings) é validada pelo manifesto gravado
+        # na ingestão, sem consultar a base nem a API de embeddings.
+        self.manifest = read_manifest(version_path)
+        if self.manifest:
+            check_manifest(self.manifest, EMBEDDING_MODEL, EMBEDDING_MODEL_DIMENSIONS.get(EMBEDDING_MODEL))
+
+        if VECTOR_BACKEND == "numpy":
+            logger.info(f"[{name}] Carregando o índice NumPy ({VECTOR_INDEX_DTYPE}) da versão '{version_path}'...")
+            self.store = NumpyVectorIndex.open(version_path)
+            expected_dimension = EMBEDDING_MODEL_DIMENSIONS.get(EMBEDDING_MODEL)
+            if expected_dimension and self.store.dimension != expected_dimension:
+                raise ValueError(f"o índice tem {self.store.dimension} dimensões, mas o modelo configurado gera {expected_dimension}")
+            self.document_count = len(self.store)
+        else:
+            logger.info(f"[{name}] Carregando ChromaDB publicado em '{version_path}'...")
+            # Abre pelo caminho real da versão: uma publicação nova não afeta quem já está servindo esta
+            self.store = Chroma(persist_directory=version_path, embedding_function=embeddings)
+            _acquire_chroma_system(self.store._client._identifier)
+            if self.manifest:
+                self.document_count = self.manifest["document_count"]
+            else:
+                # Bases publicadas antes do manifesto: força uma busca para verificar compatibilidade
+                # (pode falhar se a dimensão for incompatível)
+                logger.warning(f"⚠️ [{name}] Versão sem manifesto (kb_manifest.json). Validando com uma busca de teste.")
+                self.store.similarity_search("teste", k=1)
+                self.document_count = self.store._collection.count()
+        if self.document_count == 0:
+            raise ValueError("a versão publicada está vazia")
+
+        self.lexical = None
+        if RETRIEVAL_MODE == "hybrid":
+            logger.info(f"[{name}] Carregando o índice BM25 (recuperação híbrida)...")
+            self.lexical = BM25Index.open(version_path)
+
+    @property
+    def version_hash(self):
+        return self.manifest["version_hash"] if self.manifest else None
+
+    def _vector_retriever(self, k: int, metadata_filter):
+        if isinstance(self.store, NumpyVectorIndex):
+            return NumpyRetriever(index=self.store, embeddings=self.embeddings, k=k, metadata_filter=metadata_filter)
+        search_kwargs = {"k": k}
+        if metadata_filter:
+            search_kwargs["filter"] = _chroma_where(metadata_filter)
+        return self.store.as_retriever(search_type="similarity", search_kwargs=search_kwargs)
+
+    def retriever(self, metadata_filter: dict = None):
+        """
+        Retriever da base: vetorial ou híbrido (RETRIEVAL_MODE) e, com RAG_MMR_ENABLED, busca
+        RAG_MMR_FETCH_K candidatos e escolhe os finais por MMR (ver reranking.py).
+        """
+        fetch_k = RAG_MMR_FETCH_K if RAG_MMR_ENABLED else RAG_TOP_K
+        if self.lexical is None:
+            retriever = self._vector_retriever(fetch_k, metadata_filter)
+        else:
+            retriever = HybridRetriever(
+                lexical=self.lexical,
+                vector_retriever=self._vector_retriever(max(HYBRID_CANDIDATES, fetch_k), metadata_filter),
+                k=fetch_k,
+                metadata_filter=metadata_filter,
+            )
+        if RAG_MMR_ENABLED:
+            if isinstance(self.store, NumpyVectorIndex):
+                vector_lookup = self.store.vectors_for_ids
+            else:
+                vector_lookup = chroma_vector_lookup(self.store._collection)
+            retriever = MMRRetriever(
+                base_retriever=retriever,
+                vector_lookup=vector_lookup,
+                embeddings=self.embeddings,
+                k=RAG_TOP_K,
+                lambda_mult=RAG_MMR_LAMBDA,
+            )
+        return retriever
+
+    def rag_chain(self, metadata_filter: dict = None):
+        """Cadeia RetrievalQA para o filtro (montada na primeira vez e reaproveitada)."""
+        key = tuple(sorted((metadata_filter or {}).items()))
+        with self._chains_lock:
+            chain = self._chains.get(key)
+            if chain is None:
+                chain = RetrievalQA.from_chain_type(
+                    llm=self.llm,
+                    chain_type="stuff",
+                    retriever=self.retriever(metadata_filter),
+                    return_source_documents=True,
+                )
+                self._chains[key] = chain
+            return chain
+
+    def _try_acquire(self) -> bool:
+        """Marca a base em uso, se ela ainda não foi descarregada (ver KnowledgeBaseRegistry.acquire)."""
+        with self._usage_lock:
+            if self._retired or self._closed:
+                return False
+            self._users += 1
+            return True
+
+    def release(self):
+        """Fim da consulta: a base descarregada durante ela é fechada aqui, se for a última."""
+        with self._usage_lock:
+            self._users -= 1
+            close_now = self._retired and self._users == 0
+        if close_now:
+            self.close()
+
+    @property
+    def retired(self) -> bool:
+        return self._retired
+
+    def retire(self):
+        """Descarregada ou substituída: fecha agora ou quando a última consulta em curso terminar."""
+        with self._usage_lock:
+            self._retired = True
+            close_now = self._users == 0
+        if close_now:
+            self.close()
+
+    def close(self):
+        """Libera os índices: memory-maps e arquivos (NumPy/BM25) ou o System do Chroma desta versão."""
+        with self._usage_lock:
+            if self._closed:
+                return
+            self._closed = True
+        with self._chains_lock:
+            self._chains.clear()
+        if isinstance(self.store, Chroma):
+            # O chromadb guarda um System por caminho pelo resto do processo: sem isso cada
+            # versão antiga ou base descarregada continuaria em memória
+            _release_chroma_system(self.store._client._identifier)
+        else:
+            self.store.close()
+        if self.lexical is not None:
+            self.lexical.close()
+        logger.info(f"📦 [{self.name}] Índices da versão '{os.path.basename(self.version_path)}' liberados.")
+
+
+class _Entry:
+    __slots__ = ("knowledge_base", "attempted_version_path", "checked_at")
+
+    def __init__(self):
+        self.knowledge_base = None
+        self.attempted_version_path = None
+        self.checked_at = 0.0
+
+
+def _retired(entry: _Entry) -> bool:
+    return entry.knowledge_base is not None and entry.knowledge_base.retired
+
+
+class KnowledgeBaseRegistry:
+    """LRU de bases abertas, com recarga quando uma nova versão de uma base é publicada."""
+
+    def __init__(self, llm, embeddings, max_open: int = KB_MAX_OPEN,
+                 reload_check_seconds: float = KB_RELOAD_CHECK_SECONDS):
+        self.llm = llm
+        self.embeddings = embeddings
+        self.max_open = max(1, max_open)
+        self.reload_check_seconds = reload_check_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._name_locks = {}
+
+    def _name_lock(self, name: str):
+        with self._lock:
+            return self._name_locks.setdefault(name, threading.Lock())
+
+    def get(self, name: str = DEFAULT_KNOWLEDGE_BASE):
+        """
+        Base aberta com esse nome (ou None se não houver versão publicada). A verificação de
+        nova versão é um readlink, feito no máximo a cada reload_check_seconds por base; se a
+        nova versão falhar ao carregar, a anterior continua sendo servida.
+        """
+        if not name:
+            return None
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is not None:
+                self._entries.move_to_end(name)
+                if time.monotonic() - entry.checked_at < self.reload_check_seconds and not _retired(entry):
+                    return entry.knowledge_base
+
+        with self._name_lock(name):
+            with self._lock:
+                entry = self._entries.get(name)
+            if entry is not None and time.monotonic() - entry.checked_at < self.reload_check_seconds and not _retired(entry):
+                return entry.knowledge_base
+            entry = entry or _Entry()
+            entry.checked_at = time.monotonic()
+            version_path = resolve_version_path(persist_directory_for(name))
+            # Base descarregada pelo LRU enquanto esta thread a buscava: abre de novo
+            if version_path != entry.attempted_version_path or _retired(entry):
+                entry.attempted_version_path = version_path
+                self._load(name, entry, version_path)
+            self._store(name, entry)
+            return entry.knowledge_base
+
+    def acquire(self, name: str = DEFAULT_KNOWLEDGE_BASE, attempts: int = 3):
+        """
+        Como get(), mas com a base já marcada em uso (sob a trava do registro), para quem vai
+        consultá-la em outra thread: descarregada ou substituída depois disso, ela só é fechada
+        quando quem pegou chamar release(). Se ela foi descarregada entre o get() e a marcação,
+        pega de novo (a recarregada). None se não houver versão publicada.
+        """
+        for _ in range(attempts):
+            knowledge_base = self.get(name)
+            if knowledge_base is None:
+                return None
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is not None and entry.knowledge_base is knowledge_base and knowledge_base._try_acquire():
+                    return knowledge_base
+        raise KnowledgeBaseClosed(f"a base '{name}' foi descarregada {attempts} vezes seguidas antes de ser usada")
+
+    def _load(self, name: str, entry: _Entry, version_path):
+        previous = entry.knowledge_base
+        if not version_path:
+            logger.warning(f"⚠️ [{name}] Nenhuma base de conhecimento publicada.")
+            entry.knowledge_base = None
+        else:
+            try:
+                entry.knowledge_base = KnowledgeBase(name, version_path, self.llm, self.embeddings)
+                logger.info(f"🧠 [{name}] Base carregada: {entry.knowledge_base.document_count} chunks "
+                            f"(versão {os.path.basename(version_path)}, hash {entry.knowledge_base.version_hash or 'n/d'}, "
+                            f"backend {VECTOR_BACKEND}, recuperação {RETRIEVAL_MODE}, MMR {'sim' if RAG_MMR_ENABLED else 'não'}).")
+            except Exception as e:
+                if previous is not None:
+                    logger.error(f"❌ [{name}] Erro ao carregar a versão '{version_path}': {e}. Mantendo a versão '{previous.version_path}'.", exc_info=True)
+                else:
+                    logger.error(f"❌ [{name}] Erro ao carregar a base de conhecimento: {e}", exc_info=True)
+                return
+        # Consultas em curso na versão anterior terminam nela; depois ela é fechada
+        if previous is not None and previous is not entry.knowledge_base:
+            logger.info(f"🔄 [{name}] Versão '{os.path.basename(previous.version_path)}' substituída.")
+            previous.retire()
+
+    def _store(self, name: str, entry: _Entry):
+        with self._lock:
+            self._entries[name] = entry
+            self._entries.move_to_end(name)
+            evicted = []
+            while len(self._entries) > self.max_open:
+                evicted.append(self._entries.popitem(last=False))
+        for evicted_name, evicted_entry in evicted:
+            logger.info(f"📦 [{evicted_name}] Base descarregada (LRU, máximo de {self.max_open} abertas); os índices são liberados quando as consultas em curso terminarem.")
+            if evicted_entry.knowledge_base is not None:
+                evicted_entry.knowledge_base.retire()
+
+    def loaded(self):
+        """{nome: KnowledgeBase} das bases abertas no momento (para /health)."""
+        with self._lock:
+            return {name: entry.knowledge_base for name, entry in self._entries.items() if entry.knowledge_base}
+
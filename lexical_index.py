@@ -0,0 +1,254 @@
+"""
+Índice léxico BM25 da base de conhecimento e recuperação híbrida.
+
+Códigos de produto, preços e nomes próprios costumam se perder na busca só por embeddings.
+O índice invertido BM25 é gerado junto com cada versão publicada (ver kb_store.py) e o
+HybridRetriever funde os rankings léxico e vetorial por reciprocal rank fusion (RRF).
+
+Quando o ranking léxico é inequívoco (um termo raro da pergunta, como um código, aparece no
+melhor chunk e ele vence o segundo com folga), a resposta sai só do BM25, sem gerar o
+embedding da pergunta.
+
+Selecionado com RETRIEVAL_MODE=hybrid (padrão: vector).
+"""
+
+import os
+import re
+import json
+import uuid
+import shutil
+import logging
+import unicodedata
+from typing import Any, Optional
+
+import numpy as np
+import chromadb
+from langchain_core.retrievers import BaseRetriever
+
+from vector_index import COLLECTION_NAME, DocumentStore, DocumentStoreWriter, top_k
+
+logger = logging.getLogger(__name__)
+
+RETRIEVAL_MODE = os.getenv('RETRIEVAL_MODE', 'vector').lower()
+RETRIEVAL_MODES = ('vector', 'hybrid')
+
+BM25_K1 = float(os.getenv('BM25_K1', 1.2))
+BM25_B = float(os.getenv('BM25_B', 0.75))
+# Candidatos de cada ranking antes da fusão e constante do RRF
+HYBRID_CANDIDATES = int(os.getenv('HYBRID_CANDIDATES', 10))
+RRF_K = int(os.getenv('RRF_K', 60))
+# Atalho léxico: termo raro (presente em até N chunks) no melhor resultado, com folga sobre o segundo
+LEXICAL_FAST_PATH = os.getenv('LEXICAL_FAST_PATH', 'true').lower() == 'true'
+LEXICAL_FAST_PATH_MAX_DF = int(os.getenv('LEXICAL_FAST_PATH_MAX_DF', 3))
+LEXICAL_FAST_PATH_MARGIN = float(os.getenv('LEXICAL_FAST_PATH_MARGIN', 1.5))
+
+INDEX_DIRNAME = "bm25_index"
+VOCABULARY_FILENAME = "vocabulary.json"
+POSTINGS_DOCS_FILENAME = "postings_docs.npy"
+POSTINGS_TF_FILENAME = "postings_tf.npy"
+DOC_LENGTHS_FILENAME = "doc_lengths.npy"
+
+# Palavras muito frequentes em português que não ajudam a distinguir chunks
+STOPWORDS = frozenset("""
+a à ao aos as às até com como da das de do dos e é ela elas ele eles em entre era essa esse esta este eu
+foi há isso isto já la lhe mais mas me mesmo meu minha muito na nas não nem no nos o os ou para pela pelas
+pelo pelos por qual quando que quem se sem seu sua são só também te tem um uma umas uns você vocês
+""".split())
+
+# Palavras, números e identificadores compostos (COD-00012-03, 1.299,90, v2.1)
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+(?:[-./,][a-z0-9]+)*")
+
+
+def _strip_accents(text: str) -> str:
+    return "".join(c for c in unicodedata.normalize("NFKD", text) if not unicodedata.combining(c))
+
+
+def tokenize(text: str):
+    """
+    Tokens para o BM25: minúsculas sem acento e sem stopwords. Identificadores compostos
+    entram inteiros e também por partes ("cod-00012-03" → cod-00012-03, cod, 00012, 03).
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(_strip_accents(text.lower())):
+        parts = re.split(r"[-./,]", token)
+        if len(parts) > 1:
+            tokens.append(token)
+        tokens.extend(part for part in parts if part and part not in STOPWORDS)
+    return tokens
+
+
+def index_directory_for(version_path: str) -> str:
+    return os.path.join(version_path, INDEX_DIRNAME)
+
+
+def write_bm25_index(index_directory: str, records, count: int) -> str:
+    """Grava o índice invertido a partir de registros (id, texto, metadados)."""
+    tmp_directory = f"{index_directory}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(tmp_directory)
+    try:
+        writer = DocumentStoreWriter(tmp_directory, count)
+        doc_lengths = np.zeros(count, dtype=np.float32)
+        postings = {}
+        for position, (chunk_id, text, metadata) in enumerate(records):
+            writer.add(chunk_id, text, metadata)
+            tokens = tokenize(text or "")
+            doc_lengths[position] = len(tokens)
+            term_counts = {}
+            for token in tokens:
+                term_counts[token] = term_counts.get(token, 0) + 1
+            for term, tf in term_counts.items():
+                postings.setdefault(term, []).append((position, tf))
+        if writer.close() != count:
+            raise ValueError(f"indexados {writer.count} de {count} chunks")
+
+        vocabulary, docs, tfs, cursor = {}, [], [], 0
+        for term in sorted(postings):
+            entries = postings[term]
+            vocabulary[term] = [cursor, cursor + len(entries)]
+            docs.extend(position for position, _ in entries)
+            tfs.extend(tf for _, tf in entries)
+            cursor += len(entries)
+        np.save(os.path.join(tmp_directory, POSTINGS_DOCS_FILENAME), np.asarray(docs, dtype=np.int32))
+        np.save(os.path.join(tmp_directory, POSTINGS_TF_FILENAME), np.asarray(tfs, dtype=np.float32))
+        np.save(os.path.join(tmp_directory, DOC_LENGTHS_FILENAME), doc_lengths)
+        with open(os.path.join(tmp_directory, VOCABULARY_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(vocabulary, f, ensure_ascii=False)
+
+        shutil.rmtree(index_directory, ignore_errors=True)
+        try:
+            os.rename(tmp_directory, index_directory)
+        except OSError:
+            if not os.path.isdir(index_directory):
+                raise
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return index_directory
+
+
+def build_bm25_index(version_path: str, page_size: int = 1000) -> str:
+    """Gera o índice BM25 a partir da coleção do Chroma de uma versão. Retorna o diretório do índice."""
+    collection = chromadb.PersistentClient(path=version_path).get_collection(COLLECTION_NAME)
+    count = collection.count()
+
+    def _records():
+        for offset in range(0, count, page_size):
+            page = collection.get(include=["documents", "metadatas"], limit=page_size, offset=offset)
+            yield from zip(page["ids"], page["documents"], page["metadatas"])
+
+    index_directory = write_bm25_index(index_directory_for(version_path), _records(), count)
+    logger.info(f"🔤 Índice BM25 gerado em {index_directory} ({count} chunks).")
+    return index_directory
+
+
+class BM25Index:
+    """Busca BM25 vetorizada sobre o índice invertido de uma versão."""
+
+    def __init__(self, index_directory: str, k1: float = BM25_K1, b: float = BM25_B):
+        with open(os.path.join(index_directory, VOCABULARY_FILENAME), "r", encoding="utf-8") as f:
+            self.vocabulary = json.load(f)
+        self.postings_docs = np.load(os.path.join(index_directory, POSTINGS_DOCS_FILENAME), mmap_mode="r")
+        self.postings_tf = np.load(os.path.join(index_directory, POSTINGS_TF_FILENAME), mmap_mode="r")
+        doc_lengths = np.load(os.path.join(index_directory, DOC_LENGTHS_FILENAME))
+        self.k1 = k1
+        # Parte do denominador do BM25 que só depende do documento, pré-calculada
+        average_length = float(doc_lengths.mean()) if len(doc_lengths) else 0.0
+        self._length_norm = k1 * (1 - b + b * doc_lengths / max(average_length, 1e-9))
+        self.documents = DocumentStore(index_directory)
+
+    @classmethod
+    def open(cls, version_path: str, build_if_missing: bool = True, **kwargs) -> "BM25Index":
+        """Abre o índice da versão, gerando-o a partir do Chroma se ainda não existir (versões antigas)."""
+        index_directory = index_directory_for(version_path)
+        if not os.path.isdir(index_directory):
+            if not build_if_missing:
+                raise FileNotFoundError(f"índice BM25 ausente em '{version_path}'")
+            build_bm25_index(version_path)
+        return cls(index_directory, **kwargs)
+
+    def __len__(self):
+        return len(self._length_norm)
+
+    def close(self):
+        self.documents.close()
+        self.postings_docs = self.postings_tf = None
+
+    def document_frequency(self, term: str) -> int:
+        start, end = self.vocabulary.get(term, (0, 0))
+        return end - start
+
+    def search(self, query: str, k: int = 3, metadata_filter: dict = None):
+        """
+        Retorna ([(posição, score)] dos k melhores chunks, menor document frequency entre os
+        termos da pergunta presentes no melhor chunk). Sem termos conhecidos, retorna ([], None).
+        metadata_filter restringe a busca aos chunks com esses metadados.
+        """
+        n = len(self)
+        scores = np.zeros(n, dtype=np.float32)
+        matched_terms = []
+        for term in set(tokenize(query)):
+            if term not in self.vocabulary:
+                continue
+            start, end = self.vocabulary[term]
+            docs = self.postings_docs[start:end]
+            tf = self.postings_tf[start:end]
+            df = end - start
+            idf = np.log(1 + (n - df + 0.5) / (df + 0.5))
+            scores[docs] += idf * tf * (self.k1 + 1) / (tf + self._length_norm[docs])
+            matched_terms.append((term, docs))
+        if not matched_terms:
+            return [], None
+        mask = self.documents.filter_mask(metadata_filter)
+        if mask is not None:
+            scores[~mask] = 0.0
+
+        k = min(k, int(np.count_nonzero(scores)))
+        results = [(int(position), float(scores[position])) for position in top_k(scores, k)] if k else []
+        best = results[0][0] if results else None
+        rarest = min((len(docs) for _, docs in matched_terms if best in docs), default=None)
+        return results, rarest
+
+
+def _document_key(document) -> str:
+    return document.id or document.metadata.get("id") or document.page_content
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    Funde o ranking BM25 com o de um retriever vetorial (Chroma ou NumPy) por RRF.
+    O retriever vetorial deve devolver `candidates` documentos.
+    """
+
+    lexical: Any
+    vector_retriever: Any
+    k: int = 3
+    candidates: int = HYBRID_CANDIDATES
+    rrf_k: int = RRF_K
+    fast_path: bool = LEXICAL_FAST_PATH
+    fast_path_max_df: int = LEXICAL_FAST_PATH_MAX_DF
+    fast_path_margin: float = LEXICAL_FAST_PATH_MARGIN
+    metadata_filter: Optional[dict] = None
+
+    def is_confident(self, lexical_results, rarest_df) -> bool:
+        if not lexical_results or rarest_df is None or rarest_df > self.fast_path_max_df:
+            return False
+        if len(lexical_results) == 1:
+            return True
+        return lexical_results[0][1] >= self.fast_path_margin * lexical_results[1][1]
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None):
+        lexical_results, rarest_df = self.lexical.search(query, self.candidates, self.metadata_filter)
+        lexical_documents = [self.lexical.documents.document(position, score) for position, score in lexical_results]
+
+        if self.fast_path and self.is_confident(lexical_results, rarest_df):
+            logger.info(f"🔤 Atalho léxico: resposta pelo BM25 sem embedding da pergunta (df={rarest_df}).")
+            return lexical_documents[:self.k]
+
+        vector_documents = self.vector_retriever.invoke(query)
+        fused, documents = {}, {}
+        for ranking in (lexical_documents, vector_documents):
+            for rank, document in enumerate(ranking):
+                key = _document_key(document)
+                fused[key] = fused.get(key, 0.0) + 1.0 / (self.rrf_k + rank + 1)
+                documents.setdefault(key, document)
+        best = sorted(fused, key=fused.get, reverse=True)[:self.k]
+        return [documents[key] for key in best]
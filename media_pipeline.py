@@ -0,0 +1,344 @@
+"""
+Pipeline das mensagens de mídia (áudio, imagem, vídeo, documento), fora do caminho do texto.
+
+Uma mídia recebida no webhook não ocupa os workers das instâncias nem a fila da IA enquanto é
+baixada e processada:
+
+1. download: threads próprias (MEDIA_DOWNLOAD_WORKERS) baixam o anexo pelo endpoint de
+   download da MEGA API (MEDIA_DOWNLOAD_ENDPOINT), em blocos de MEDIA_CHUNK_BYTES direto
+   para MEDIA_DIRECTORY, até MEDIA_MAX_BYTES, passando pelo circuit breaker da instância;
+2. processamento: o processador do tipo roda num processo próprio por mídia (no máximo
+   MEDIA_PROCESS_WORKERS ao mesmo tempo), então transcrição, OCR e leitura de PDF não disputam
+   o GIL com o servidor; passando de MEDIA_PROCESS_TIMEOUT_SECONDS o processo é encerrado,
+   libera a vaga e só então o arquivo é apagado;
+3. retorno: o texto extraído, junto com a legenda, vira um job de texto comum e segue o
+   caminho normal (limite por remetente, admissão, IA). Se algo falhar, a IA recebe um aviso
+   de que o arquivo não pôde ser lido e responde de acordo.
+
+Processadores padrão em media_processors.py (com substitutos locais, sem rede). Para trocar:
+MEDIA_PROCESSORS='{"audio": "meu_modulo:transcrever"}' (função fn(path, metadata) -> str;
+vazio desativa o tipo). Figurinhas sem legenda são ignoradas.
+
+Acima de MEDIA_MAX_PENDING mídias na fila, ou de MEDIA_MAX_PENDING_PER_SENDER de um mesmo
+remetente, a mídia não é baixada e a IA recebe só o aviso de falha.
+"""
+
+import os
+import json
+import time
+import uuid
+import base64
+import logging
+import sys
+import mimetypes
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+import media_processors
+from media_processors import MEDIA_LABELS
+from metrics import MEDIA_JOBS, MEDIA_STAGE_SECONDS, MEDIA_DOWNLOAD_BYTES
+
+logger = logging.getLogger(__name__)
+
+MEDIA_PIPELINE_ENABLED = os.getenv('MEDIA_PIPELINE_ENABLED', 'true').lower() == 'true'
+MEDIA_DIRECTORY = os.getenv('MEDIA_DIRECTORY', './media_downloads')
+# Endpoint de download da MEGA API: POST /rest/<endpoint>/<instance_id>
+MEDIA_DOWNLOAD_ENDPOINT = os.getenv('MEDIA_DOWNLOAD_ENDPOINT', 'instance/downloadMediaMessage')
+MEDIA_DOWNLOAD_TIMEOUT_SECONDS = float(os.getenv('MEDIA_DOWNLOAD_TIMEOUT_SECONDS', 30))
+MEDIA_CHUNK_BYTES = int(os.getenv('MEDIA_CHUNK_BYTES', 64 * 1024))
+MEDIA_MAX_BYTES = int(os.getenv('MEDIA_MAX_BYTES', 20 * 1024 * 1024))
+MEDIA_DOWNLOAD_WORKERS = int(os.getenv('MEDIA_DOWNLOAD_WORKERS', 4))
+MEDIA_PROCESS_WORKERS = int(os.getenv('MEDIA_PROCESS_WORKERS', 2))
+MEDIA_PROCESS_TIMEOUT_SECONDS = float(os.getenv('MEDIA_PROCESS_TIMEOUT_SECONDS', 120))
+# Espera pelo fim de um processo encerrado (SIGTERM) antes do SIGKILL
+MEDIA_PROCESS_KILL_GRACE_SECONDS = float(os.getenv('MEDIA_PROCESS_KILL_GRACE_SECONDS', 5))
+# Mídias aguardando download ou processamento; acima disso a mídia vira só o aviso de falha
+MEDIA_MAX_PENDING = int(os.getenv('MEDIA_MAX_PENDING', 100))
+# Mídias de um mesmo remetente aguardando ao mesmo tempo: o limite por remetente (flood_control.py)
+# só vê a mídia depois de processada, então sem isto um cliente ocuparia a fila de todos
+MEDIA_MAX_PENDING_PER_SENDER = int(os.getenv('MEDIA_MAX_PENDING_PER_SENDER', 3))
+
+DEFAULT_MEDIA_PROCESSORS = {
+    "audio": "media_processors:transcribe_audio",
+    "image": "media_processors:ocr_image",
+    "document": "media_processors:extract_document",
+    "video": "media_processors:describe_media",
+}
+MEDIA_PROCESSORS = {**DEFAULT_MEDIA_PROCESSORS, **json.loads(os.getenv('MEDIA_PROCESSORS', '{}') or '{}')}
+# Como o resultado de cada tipo é apresentado à IA
+RESULT_LABELS = {
+    "audio": "Áudio do cliente",
+    "image": "Imagem do cliente",
+    "document": "Documento do cliente",
+    "video": "Vídeo do cliente",
+}
+
+
+class MediaDownloadError(RuntimeError):
+    pass
+
+
+def media_job_text(media: dict, content: str = None) -> str:
+    """Texto do job que segue para a IA: legenda do cliente + conteúdo extraído (ou o aviso de falha)."""
+    media_type = media.get("media_type")
+    if content:
+        body = f"[{RESULT_LABELS.get(media_type, 'Arquivo do cliente')}]: {content}"
+    else:
+        body = f"[O cliente enviou um(a) {MEDIA_LABELS.get(media_type, 'arquivo')}, mas não foi possível ler o conteúdo]"
+    caption = (media.get("caption") or "").strip()
+    return f"{caption}\n{body}" if caption else body
+
+
+def _file_extension(media: dict) -> str:
+    extension = os.path.splitext(media.get("file_name") or "")[1]
+    if not extension and media.get("mimetype"):
+        extension = mimetypes.guess_extension(media["mimetype"].split(";")[0].strip()) or ""
+    return extension.lower()
+
+
+class MediaPipeline:
+    """Download e processamento das mídias; cada resultado vai para on_done(job de texto)."""
+
+    def __init__(self, instances, on_done, directory: str = MEDIA_DIRECTORY, processors: dict = None,
+                 download_workers: int = MEDIA_DOWNLOAD_WORKERS, process_workers: int = MEDIA_PROCESS_WORKERS,
+                 max_pending: int = MEDIA_MAX_PENDING, max_pending_per_sender: int = MEDIA_MAX_PENDING_PER_SENDER):
+        self.instances = instances
+        self.on_done = on_done
+        self.directory = directory
+        self.processors = dict(MEDIA_PROCESSORS if processors is None else processors)
+        self.process_workers = max(1, process_workers)
+        self.max_pending = max_pending
+        self.max_pending_per_sender = max(1, max_pending_per_sender)
+        self._download_executor = ThreadPoolExecutor(max_workers=max(1, download_workers), thread_name_prefix="media-download")
+        self._process_slots = threading.BoundedSemaphore(self.process_workers)
+        self._lock = threading.Lock()
+        self._pending = {}  # future → job, para gravar as não iniciadas no desligamento
+        self._pending_by_sender = {}  # jid → mídias dele em _pending
+        self._stats = {"processed": 0, "failed": 0, "skipped": 0, "dropped": 0, "downloaded_bytes": 0}
+
+    def process(self, spec: str, path: str, metadata: dict, timeout: float = MEDIA_PROCESS_TIMEOUT_SECONDS) -> str:
+        """
+        Roda o processador "módulo:função" num processo só desta mídia. Com um pool, o processo
+        de um processador travado continuaria ocupando a vaga depois do prazo; este é encerrado
+        (TimeoutError) e, ao retornar, já terminou: o arquivo pode ser apagado.
+
+        É um interpretador novo (media_processors.py), não um fork: o worker do gunicorn tem
+        muitas threads, e um filho por fork herdaria travas presas e os descritores da vaga de
+        afinidade e do log de conversas (um substituto não conseguiria a vaga enquanto ele roda).
+        O multiprocessing com spawn/forkserver evitaria o fork, mas reexecuta o __main__ do pai
+        em cada filho (o app.py inteiro, no servidor de desenvolvimento).
+        """
+        request = json.dumps({"spec": spec, "path": path, "metadata": metadata, "sys_path": sys.path})
+        with self._process_slots:
+            process = subprocess.Popen(
+                [sys.executable, os.path.abspath(media_processors.__file__)],
+                stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                close_fds=True, text=True, encoding="utf-8",
+            )
+            try:
+                output, errors = process.communicate(request, timeout=timeout)
+            except subprocess.TimeoutExpired:
+                process.terminate()
+                try:
+                    process.communicate(timeout=MEDIA_PROCESS_KILL_GRACE_SECONDS)
+                except subprocess.TimeoutExpired:
+                    process.kill()
+                    process.communicate()
+                raise TimeoutError(f"processador '{spec}' passou de {timeout:g}s e foi encerrado")
+            except BaseException:
+                process.kill()
+                process.communicate()
+                raise
+        try:
+            result = json.loads(output)
+        except ValueError:
+            raise RuntimeError(f"processo do processador '{spec}' terminou sem resultado "
+                               f"(código {process.returncode}): {errors.strip()[-500:]}")
+        if "error" in result:
+            raise RuntimeError(result["error"])
+        return result["text"]
+
+    def _count(self, media_type: str, result: str):
+        MEDIA_JOBS.labels(media_type=media_type, result=result).inc()
+        with self._lock:
+            self._stats[result] += 1
+
+    def submit(self, job: dict) -> bool:
+        """Agenda a mídia do job (job["media"]). Retorna na hora; False se ela foi descartada."""
+        media = job["media"]
+        media_type = media.get("media_type")
+        if not self.processors.get(media_type):
+            if media.get("caption"):
+                # Tipo sem processador: vale só a legenda
+                self.on_done(self._text_job(job, media["caption"]))
+            self._count(media_type or "unknown", "skipped")
+            return False
+        with self._lock:
+            sender_pending = self._pending_by_sender.get(job["jid"], 0)
+            overloaded = len(self._pending) >= self.max_pending or sender_pending >= self.max_pending_per_sender
+            if not overloaded:
+                # Reservado já aqui: mídias simultâneas do mesmo remetente não passam juntas do limite
+                self._pending_by_sender[job["jid"]] = sender_pending + 1
+        if overloaded:
+            if sender_pending >= self.max_pending_per_sender:
+                logger.warning(f"⚠️ {job['jid']} já tem {sender_pending} mídias na fila (máximo {self.max_pending_per_sender}). "
+                               f"{media_type} não processado.")
+            else:
+                logger.warning(f"⚠️ Fila de mídias cheia ({self.max_pending}). {media_type} de {job['jid']} não processado.")
+            self._count(media_type, "dropped")
+            self.on_done(self._text_job(job, media_job_text(media)))
+            return False
+        future = self._download_executor.submit(self._handle, job)
+        with self._lock:
+            self._pending[future] = job
+        future.add_done_callback(self._forget)
+        return True
+
+    def _forget(self, future):
+        with self._lock:
+            job = self._pending.pop(future, None)
+            if job is None:
+                return
+            remaining = self._pending_by_sender.get(job["jid"], 1) - 1
+            if remaining > 0:
+                self._pending_by_sender[job["jid"]] = remaining
+            else:
+                self._pending_by_sender.pop(job["jid"], None)
+
+    def _text_job(self, job: dict, text: str) -> dict:
+        text_job = {key: value for key, value in job.items() if key != "media"}
+        text_job["text"] = text
+        return text_job
+
+    def _handle(self, job: dict):
+        media = job["media"]
+        media_type = media["media_type"]
+        path, content = None, None
+        try:
+            started = time.monotonic()
+            path = self.download(job)
+            MEDIA_STAGE_SECONDS.labels(media_type=media_type, stage="download").observe(time.monotonic() - started)
+
+            started = time.monotonic()
+            metadata = {key: media.get(key) for key in ("media_type", "mimetype", "file_name", "file_length")}
+            content = (self.process(self.processors[media_type], path, metadata) or "").strip()
+            MEDIA_STAGE_SECONDS.labels(media_type=media_type, stage="process").observe(time.monotonic() - started)
+            logger.info(f"🎞️ {media_type} de {job['jid']} processado: {len(content)} caracteres extraídos.")
+        except TimeoutError:
+            logger.error(f"⏱️ Processamento do {media_type} de {job['jid']} passou de {MEDIA_PROCESS_TIMEOUT_SECONDS}s. Processo encerrado.")
+        except MediaDownloadError as e:
+            logger.error(f"❌ {media_type} de {job['jid']} não baixado: {e}")
+        except Exception as e:
+            logger.error(f"❌ Falha no {media_type} de {job['jid']}: {e}", exc_info=True)
+        finally:
+            if path:
+                self._discard(path)
+        self._count(media_type, "processed" if content else "failed")
+        self.on_done(self._text_job(job, media_job_text(media, content)))
+
+    def download(self, job: dict) -> str:
+        """Baixa a mídia do job em blocos para MEDIA_DIRECTORY. Retorna o caminho do arquivo."""
+        media = job["media"]
+        if int(media.get("file_length") or 0) > MEDIA_MAX_BYTES:
+            raise MediaDownloadError(f"arquivo de {media['file_length']} bytes acima de MEDIA_MAX_BYTES ({MEDIA_MAX_BYTES})")
+        instance = self.instances.get(job["instance"])
+        if instance is None:
+            raise MediaDownloadError(f"instância '{job['instance']}' não configurada")
+        if not instance.breaker.allow():
+            raise MediaDownloadError(f"circuit breaker da instância {instance.instance_id} aberto")
+
+        payload = {"messageKeys": {
+            "mediaKey": media.get("media_key"),
+            "url": media.get("media_url"),
+            "mimetype": media.get("mimetype"),
+            "messageType": media.get("media_type"),
+        }}
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{uuid.uuid4().hex}{_file_extension(media)}")
+        dependency_failed = False
+        try:
+            with instance.session.post(instance.url(MEDIA_DOWNLOAD_ENDPOINT), json=payload, stream=True,
+                                       timeout=MEDIA_DOWNLOAD_TIMEOUT_SECONDS) as response:
+                response.raise_for_status()
+                if response.headers.get("Content-Type", "").startswith("application/json"):
+                    size = self._write_base64(response, path)
+                else:
+                    size = self._write_stream(response, path)
+        except requests.exceptions.RequestException as e:
+            dependency_failed = getattr(e, "response", None) is None or e.response.status_code >= 500
+            self._discard(path)
+            raise MediaDownloadError(f"erro ao baixar da MEGA API: {e}") from e
+        except Exception:
+            self._discard(path)
+            raise
+        finally:
+            instance.breaker.record(dependency_failed)
+        MEDIA_DOWNLOAD_BYTES.labels(media_type=media.get("media_type")).inc(size)
+        with self._lock:
+            self._stats["downloaded_bytes"] += size
+        return path
+
+    def _write_stream(self, response, path: str) -> int:
+        size = 0
+        with open(path, "wb") as f:
+            for chunk in response.iter_content(chunk_size=MEDIA_CHUNK_BYTES):
+                size += len(chunk)
+                if size > MEDIA_MAX_BYTES:
+                    raise MediaDownloadError(f"download passou de MEDIA_MAX_BYTES ({MEDIA_MAX_BYTES})")
+                f.write(chunk)
+        return size
+
+    def _write_base64(self, response, path: str) -> int:
+        """Resposta JSON com o arquivo em base64 ({"data": "..."}), decodificada em blocos."""
+        declared = int(response.headers.get("Content-Length") or 0)
+        if declared > MEDIA_MAX_BYTES * 4 // 3 + 1024:
+            raise MediaDownloadError(f"download passou de MEDIA_MAX_BYTES ({MEDIA_MAX_BYTES})")
+        body = response.json()
+        if body.get("error"):
+            raise MediaDownloadError(f"MEGA API recusou o download: {body.get('message', body)}")
+        data = body.get("data") or body.get("base64") or ""
+        if isinstance(data, dict):
+            data = data.get("base64") or data.get("data") or ""
+        if "," in data[:100]:
+            # data URI: "data:<mimetype>;base64,<conteúdo>"
+            data = data.split(",", 1)[1]
+        data = "".join(data.split())
+        if not data:
+            raise MediaDownloadError("resposta da MEGA API sem o arquivo")
+        size = 0
+        # Blocos de tamanho múltiplo de 4 decodificam sem depender dos vizinhos
+        step = MEDIA_CHUNK_BYTES // 3 * 4
+        with open(path, "wb") as f:
+            for start in range(0, len(data), step):
+                chunk = base64.b64decode(data[start:start + step])
+                size += len(chunk)
+                if size > MEDIA_MAX_BYTES:
+                    raise MediaDownloadError(f"download passou de MEDIA_MAX_BYTES ({MEDIA_MAX_BYTES})")
+                f.write(chunk)
+        return size
+
+    @staticmethod
+    def _discard(path: str):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def shutdown(self):
+        """Para o pipeline. Retorna os jobs de mídia que ainda não começaram (para o próximo processo)."""
+        with self._lock:
+            waiting = [(future, job) for future, job in self._pending.items()]
+        leftover = [job for future, job in waiting if future.cancel()]
+        self._download_executor.shutdown(wait=False, cancel_futures=True)
+        return leftover
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled_types": sorted(media_type for media_type, spec in self.processors.items() if spec),
+                "pending": len(self._pending),
+                **self._stats,
+            }
@@ -0,0 +1,111 @@
+"""
+Processadores de mídia do media_pipeline.py: transformam um anexo baixado em texto.
+
+Cada processador é uma função de nível de módulo `fn(path, metadata) -> str` (roda num
+interpretador separado, `python media_processors.py`, então precisa ser importável por
+"módulo:função"). metadata traz media_type, mimetype, file_name e file_length do webhook.
+
+Os padrões funcionam offline: sem OPENAI_API_KEY para a transcrição ou sem o pytesseract
+para o OCR, os substitutos locais devolvem uma descrição do anexo, e o resto do fluxo
+(download, fila, retorno ao texto) continua testável.
+"""
+
+import os
+import sys
+import json
+import importlib
+
+# Rótulos dos tipos de mídia do webhook_parser nas mensagens para a IA
+MEDIA_LABELS = {"audio": "áudio", "image": "imagem", "video": "vídeo", "document": "documento", "sticker": "figurinha"}
+
+# "openai" (Whisper) ou "local" (substituto: só descreve o áudio)
+MEDIA_STT_BACKEND = os.getenv('MEDIA_STT_BACKEND', 'openai').lower()
+MEDIA_STT_MODEL = os.getenv('MEDIA_STT_MODEL', 'whisper-1')
+MEDIA_OCR_LANGUAGE = os.getenv('MEDIA_OCR_LANGUAGE', 'por')
+# Texto máximo extraído de um documento (o orçamento de tokens corta o resto, ver token_budget.py)
+MEDIA_DOCUMENT_MAX_CHARS = int(os.getenv('MEDIA_DOCUMENT_MAX_CHARS', 6000))
+
+
+def _size_label(path: str) -> str:
+    try:
+        return f"{os.path.getsize(path) / 1024:.0f} KB"
+    except OSError:
+        return "tamanho desconhecido"
+
+
+def run_processor(spec: str, path: str, metadata: dict) -> str:
+    """Executa o processador "módulo:função" (chamado no processo de cada mídia, ver main())."""
+    module_name, _, function_name = spec.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)(path, metadata)
+
+
+def describe_media(path: str, metadata: dict) -> str:
+    """Substituto local: descreve o anexo sem extrair conteúdo."""
+    label = MEDIA_LABELS.get(metadata.get("media_type"), "arquivo")
+    name = metadata.get("file_name") or metadata.get("mimetype") or "sem nome"
+    return f"{label} '{name}' ({_size_label(path)}), conteúdo não extraído"
+
+
+def transcribe_audio(path: str, metadata: dict) -> str:
+    """Fala → texto com o Whisper da OpenAI (ou o substituto local com MEDIA_STT_BACKEND=local)."""
+    if MEDIA_STT_BACKEND != "openai" or not os.getenv("OPENAI_API_KEY"):
+        return describe_media(path, metadata)
+    from openai import OpenAI
+
+    client = OpenAI(timeout=60, max_retries=1)
+    with open(path, "rb") as f:
+        transcription = client.audio.transcriptions.create(model=MEDIA_STT_MODEL, file=f, language="pt")
+    return transcription.text.strip()
+
+
+def ocr_image(path: str, metadata: dict) -> str:
+    """Texto de uma imagem com o Tesseract (pytesseract + Pillow), se instalados."""
+    try:
+        import pytesseract
+        from PIL import Image
+    except ImportError:
+        return describe_media(path, metadata)
+    with Image.open(path) as image:
+        text = pytesseract.image_to_string(image, lang=MEDIA_OCR_LANGUAGE)
+    return " ".join(text.split()) or describe_media(path, metadata)
+
+
+def extract_document(path: str, metadata: dict) -> str:
+    """
+    Texto de um PDF ou TXT, lido página a página com os loaders da ingestão da base de
+    conhecimento (ingestion.get_loader), para a IA usar como contexto da conversa.
+    """
+    from ingestion import get_loader
+
+    try:
+        loader = get_loader(path)
+    except ValueError:
+        return describe_media(path, metadata)
+    parts, size = [], 0
+    for page in loader.lazy_load():
+        text = " ".join(page.page_content.split())
+        parts.append(text)
+        size += len(text) + 1
+        if size >= MEDIA_DOCUMENT_MAX_CHARS:
+            break
+    return " ".join(parts)[:MEDIA_DOCUMENT_MAX_CHARS] or describe_media(path, metadata)
+
+
+def main():
+    """
+    Processo de uma mídia (ver media_pipeline.MediaPipeline.process): lê {"spec", "path",
+    "metadata", "sys_path"} em JSON da entrada e escreve {"text"} ou {"error"} na saída.
+    """
+    request = json.load(sys.stdin)
+    sys.path[:0] = [entry for entry in request.get("sys_path", []) if entry not in sys.path]
+    # Prints de bibliotecas vão para o stderr: o stdout leva só o resultado
+    output, sys.stdout = sys.stdout, sys.stderr
+    try:
+        result = {"text": run_processor(request["spec"], request["path"], request["metadata"])}
+    except Exception as e:
+        result = {"error": f"{type(e).__name__}: {e}"}
+    json.dump(result, output, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
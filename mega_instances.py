@@ -0,0 +1,284 @@
+"""
+Instâncias da MEGA API (números de WhatsApp) atendidas por um único processo.
+
+Cada instância tem credenciais próprias, um pool de conexões HTTP (requests.Session), um
+limite de envios por segundo (token bucket) e uma fatia própria de workers para processar
+as mensagens recebidas. Assim uma instância com muito tráfego enfileira as próprias
+mensagens sem atrasar as das outras.
+
+Os workers tiram as mensagens de uma fila justa ponderada por classe de prioridade (ver
+scheduling.py), não de uma fila por ordem de chegada: um grupo movimentado da instância não
+atrasa as conversas diretas dela, mesmo com todos os workers ocupados.
+
+Configuração em MEGA_INSTANCES (JSON):
+    {"<instance_id>": {"token": "...", "base_url": "...", "send_rate_per_second": 2,
+                       "send_burst": 5, "max_concurrency": 4, "http_pool_size": 8}}
+Campos omitidos usam os padrões abaixo. A instância de MEGA_INSTANCE_ID/MEGA_API_TOKEN,
+se definida, é sempre incluída e atende webhooks sem identificação de instância.
+"""
+
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import Future, wait as wait_futures
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from circuit_breaker import CircuitBreaker
+from scheduling import PRIORITY_DIRECT, WeightedFairQueue
+
+logger = logging.getLogger(__name__)
+
+MEGA_INSTANCES = json.loads(os.getenv('MEGA_INSTANCES', '{}') or '{}')
+# Padrões por instância
+MEGA_SEND_RATE_PER_SECOND = float(os.getenv('MEGA_SEND_RATE_PER_SECOND', 2))
+MEGA_SEND_BURST = int(os.getenv('MEGA_SEND_BURST', 5))
+MEGA_INSTANCE_MAX_CONCURRENCY = int(os.getenv('MEGA_INSTANCE_MAX_CONCURRENCY', 4))
+MEGA_HTTP_POOL_SIZE = int(os.getenv('MEGA_HTTP_POOL_SIZE', 8))
+# Espera máxima por uma vaga de envio antes de desistir da mensagem
+MEGA_SEND_MAX_WAIT_SECONDS = float(os.getenv('MEGA_SEND_MAX_WAIT_SECONDS', 30))
+
+
+class TokenBucket:
+    """Limite de taxa: `rate` permissões por segundo, acumulando até `burst`."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, timeout: float = None) -> bool:
+        """Espera uma permissão. Retorna False se não houver vaga dentro de `timeout` segundos."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return True
+                wait = (1 - self._tokens) / self.rate if self.rate > 0 else 1.0
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class MegaInstance:
+    """Uma instância da MEGA API: credenciais, sessão HTTP, limite de envio e workers próprios."""
+
+    def __init__(self, instance_id: str, base_url: str, token: str,
+                 send_rate_per_second: float = MEGA_SEND_RATE_PER_SECOND,
+                 send_burst: int = MEGA_SEND_BURST,
+                 max_concurrency: int = MEGA_INSTANCE_MAX_CONCURRENCY,
+                 http_pool_size: int = MEGA_HTTP_POOL_SIZE):
+        self.instance_id = instance_id
+        self.base_url = base_url.rstrip("/")
+        self.token = token
+        self.max_concurrency = max(1, max_concurrency)
+
+        # Conexões keep-alive reaproveitadas entre envios (uma sessão por instância)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(1, http_pool_size))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers.update({
+            'Authorization': f'Bearer {token}',
+            'Content-Type': 'application/json'
+        })
+
+        self.send_limiter = TokenBucket(send_rate_per_second, send_burst)
+        # Instância fora do ar: envios falham na hora e as conversas dela são adiadas
+        self.breaker = CircuitBreaker(f"mega:{instance_id}")
+        self._stats_lock = threading.Lock()
+        # Fila dos jobs que esperam worker; os workers são criados sob demanda até max_concurrency
+        self._queue = WeightedFairQueue()
+        self._queue_ready = threading.Condition(self._stats_lock)
+        self._workers = []
+        self._stopped = False
+        self._queued = 0
+        self._running = 0
+        # Jobs ainda não concluídos (na fila ou em execução), para o drain no desligamento
+        self._jobs = {}
+        self.accepting = True
+        self.sent = 0
+        self.send_failures = 0
+        self.rate_limited = 0
+
+    def url(self, *parts: str) -> str:
+        """URL de um endpoint da instância (ex.: url("sendMessage", "text") → /rest/sendMessage/<id>/text)."""
+        return f"{self.base_url}/rest/{parts[0]}/{self.instance_id}" + "".join(f"/{part}" for part in parts[1:])
+
+    def submit(self, job: dict, fn):
+        """
+        Processa fn(job) nos workers da instância (no máximo max_concurrency ao mesmo tempo),
+        na vez da classe job["priority"] na fila justa. Retorna um Future, ou None se a
+        instância não aceita mais jobs (desligamento em andamento).
+        """
+        future = Future()
+        with self._stats_lock:
+            if not self.accepting:
+                return None
+            self._queue.push(job.get("priority", PRIORITY_DIRECT), (future, fn, job))
+            self._jobs[future] = job
+            self._queued += 1
+            if len(self._workers) < min(self.max_concurrency, self._queued + self._running):
+                worker = threading.Thread(
+                    target=self._work, name=f"mega-{self.instance_id}_{len(self._workers)}", daemon=True
+                )
+                self._workers.append(worker)
+                worker.start()
+            self._queue_ready.notify()
+        future.add_done_callback(self._forget)
+        return future
+
+    def _work(self):
+        while True:
+            with self._queue_ready:
+                while not len(self._queue) and not self._stopped:
+                    self._queue_ready.wait()
+                if not len(self._queue):
+                    return
+                _, (future, fn, job) = self._queue.pop()
+                self._queued -= 1
+                self._running += 1
+            try:
+                # Cancelado na fila (desligamento sem espera): não executa
+                if future.set_running_or_notify_cancel():
+                    try:
+                        future.set_result(fn(job))
+                    except BaseException as e:
+                        future.set_exception(e)
+            finally:
+                with self._stats_lock:
+                    self._running -= 1
+
+    def _forget(self, future):
+        with self._stats_lock:
+            self._jobs.pop(future, None)
+
+    def acquire_send_slot(self, timeout: float = MEGA_SEND_MAX_WAIT_SECONDS) -> bool:
+        if self.send_limiter.acquire(timeout):
+            return True
+        with self._stats_lock:
+            self.rate_limited += 1
+        return False
+
+    def record_send(self, success: bool):
+        with self._stats_lock:
+            if success:
+                self.sent += 1
+            else:
+                self.send_failures += 1
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            return {
+                "queued": self._queued,
+                "running": self._running,
+                "queued_by_priority": self._queue.lengths(),
+                "max_concurrency": self.max_concurrency,
+                "send_rate_per_second": self.send_limiter.rate,
+                "sent": self.sent,
+                "send_failures": self.send_failures,
+                "rate_limited": self.rate_limited,
+                "circuit_breaker": self.breaker.state,
+            }
+
+    def stop_accepting(self):
+        with self._stats_lock:
+            self.accepting = False
+
+    def pending_futures(self):
+        with self._stats_lock:
+            return list(self._jobs)
+
+    def pending_jobs(self):
+        with self._stats_lock:
+            return list(self._jobs.values())
+
+    def shutdown(self, wait: bool = True):
+        # Jobs que ainda não começaram são cancelados (quem chama já guardou os pendentes)
+        cancelled = []
+        with self._queue_ready:
+            self._stopped = True
+            self.accepting = False
+            while not wait and len(self._queue):
+                _, (future, _fn, _job) = self._queue.pop()
+                self._queued -= 1
+                cancelled.append(future)
+            self._queue_ready.notify_all()
+            workers = list(self._workers)
+        for future in cancelled:
+            future.cancel()
+        if wait:
+            for worker in workers:
+                worker.join()
+        self.session.close()
+
+
+class MegaInstanceRouter:
+    """Instâncias configuradas, por ID. Webhooks sem ID vão para a instância padrão."""
+
+    def __init__(self, default_instance_id: str = None, default_base_url: str = None,
+                 default_token: str = None, instances: dict = None):
+        self.default_instance_id = default_instance_id
+        self.instances = {}
+        configs = dict(instances or {})
+        if default_instance_id and default_token and default_instance_id not in configs:
+            configs[default_instance_id] = {"token": default_token}
+        for instance_id, config in configs.items():
+            base_url = config.get("base_url") or default_base_url
+            if not base_url or not config.get("token"):
+                raise ValueError(f"instância '{instance_id}' sem base_url ou token")
+            self.instances[instance_id] = MegaInstance(
+                instance_id,
+                base_url,
+                config["token"],
+                send_rate_per_second=float(config.get("send_rate_per_second", MEGA_SEND_RATE_PER_SECOND)),
+                send_burst=int(config.get("send_burst", MEGA_SEND_BURST)),
+                max_concurrency=int(config.get("max_concurrency", MEGA_INSTANCE_MAX_CONCURRENCY)),
+                http_pool_size=int(config.get("http_pool_size", MEGA_HTTP_POOL_SIZE)),
+            )
+        if self.default_instance_id not in self.instances and len(self.instances) == 1:
+            self.default_instance_id = next(iter(self.instances))
+
+    def get(self, instance_id: str = None):
+        """Instância pelo ID (ou a padrão, sem ID). None se o ID não estiver configurado."""
+        return self.instances.get(instance_id or self.default_instance_id)
+
+    def stats(self) -> dict:
+        return {instance_id: instance.stats() for instance_id, instance in self.instances.items()}
+
+    def drain(self, timeout: float) -> dict:
+        """
+        Para de aceitar jobs e espera até `timeout` segundos pelos que estão na fila ou em
+        execução. Retorna o relatório do drain, com os jobs não concluídos em "leftover_jobs"
+        (os em execução podem ainda terminar antes do processo sair: reprocessá-los pode
+        repetir uma resposta, mas nenhuma se perde).
+        """
+        started = time.monotonic()
+        for instance in self.instances.values():
+            instance.stop_accepting()
+        futures = [future for instance in self.instances.values() for future in instance.pending_futures()]
+        done, not_done = wait_futures(futures, timeout=timeout)
+        leftover_jobs = [job for instance in self.instances.values() for job in instance.pending_jobs()]
+        self.shutdown(wait=False)
+        return {
+            "duration_seconds": round(time.monotonic() - started, 3),
+            "completed": len(done),
+            "abandoned": len(leftover_jobs),
+            "leftover_jobs": leftover_jobs,
+        }
+
+    def shutdown(self, wait: bool = True):
+        for instance in self.instances.values():
+            instance.shutdown(wait=wait)
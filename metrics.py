@@ -0,0 +1,128 @@
+"""
+Métricas Prometheus do agente, expostas em /metrics pelo app.py.
+
+Com vários workers do gunicorn, defina PROMETHEUS_MULTIPROC_DIR (diretório vazio a cada
+deploy) para que /metrics agregue os contadores de todos os processos.
+"""
+
+import os
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram, generate_latest, multiprocess
+)
+
+# --- Admissão de mensagens (ver admission.py) ---
+ADMISSION_ADMITTED = Counter(
+    "whatsapp_admission_admitted_total", "Mensagens aceitas para processamento pela IA", ["priority"]
+)
+ADMISSION_SHED = Counter(
+    "whatsapp_admission_shed_total", "Mensagens não admitidas por sobrecarga", ["action", "priority"]
+)
+ADMISSION_IN_FLIGHT = Gauge(
+    "whatsapp_admission_in_flight", "Mensagens sendo processadas pela IA agora", multiprocess_mode="livesum"
+)
+ADMISSION_BACKLOG = Gauge(
+    "whatsapp_admission_backlog", "Mensagens admitidas esperando uma vaga de processamento", ["priority"],
+    multiprocess_mode="livesum"
+)
+JOB_LATENCY = Histogram(
+    "whatsapp_job_latency_seconds", "Tempo do recebimento da mensagem até o fim do processamento", ["priority"],
+    buckets=(0.5, 1, 2, 5, 10, 20, 30, 60, 120, 300)
+)
+
+# --- Proteção contra flood por remetente (ver flood_control.py) ---
+FLOOD_LIMITED = Counter(
+    "whatsapp_flood_limited_total", "Mensagens acima do limite do remetente", ["action"]
+)
+FLOOD_COOLDOWN_REPLIES = Counter(
+    "whatsapp_flood_cooldown_replies_total", "Avisos de espera enviados a remetentes acima do limite"
+)
+FLOOD_EVICTED_PENDING = Counter(
+    "whatsapp_flood_evicted_pending_total", "Remetentes esquecidos (LRU) com mensagens guardadas, entregues na hora"
+)
+FLOOD_TRACKED_SENDERS = Gauge(
+    "whatsapp_flood_tracked_senders", "Remetentes com contagem em memória", multiprocess_mode="livesum"
+)
+
+# --- Tokens das chamadas à IA (ver token_budget.py) ---
+LLM_TOKENS = Counter(
+    "whatsapp_llm_tokens_total", "Tokens enviados (prompt) e gerados (completion) nas chamadas à IA", ["kind", "type"]
+)
+LLM_PROMPT_TOKENS = Histogram(
+    "whatsapp_llm_prompt_tokens", "Tamanho do prompt de cada chamada à IA, em tokens", ["kind"],
+    buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 8000, 16000)
+)
+PROMPT_TRIMMED_TOKENS = Counter(
+    "whatsapp_prompt_trimmed_tokens_total", "Tokens cortados do prompt para caber no orçamento", ["section"]
+)
+
+# --- Roteamento entre modelos (ver model_routing.py) ---
+LLM_TIER_CALLS = Counter(
+    "whatsapp_llm_tier_calls_total", "Chamadas à IA por nível de modelo", ["tier", "model"]
+)
+LLM_TIER_LATENCY = Histogram(
+    "whatsapp_llm_tier_latency_seconds", "Duração das chamadas à IA por nível de modelo", ["tier", "model"],
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 20, 30, 60)
+)
+LLM_TIER_COST = Counter(
+    "whatsapp_llm_tier_cost_usd_total", "Custo estimado das chamadas à IA por nível de modelo (USD)", ["tier", "model"]
+)
+
+# --- Prazos e requisições duplicadas (ver deadlines.py) ---
+DEADLINE_EXCEEDED = Counter(
+    "whatsapp_deadline_exceeded_total", "Etapas da resposta que passaram do prazo", ["stage"]
+)
+LLM_HEDGED = Counter(
+    "whatsapp_llm_hedged_total", "Chamadas à IA com cópia enviada, por qual respondeu primeiro", ["winner"]
+)
+LATE_REPLIES = Counter(
+    "whatsapp_late_replies_total", "Respostas enviadas depois do aviso de prazo", ["result"]
+)
+
+# --- Circuit breakers (ver circuit_breaker.py) ---
+CIRCUIT_BREAKER_STATE = Gauge(
+    "whatsapp_circuit_breaker_state", "Estado do circuit breaker (0 fechado, 1 meio aberto, 2 aberto)", ["dependency"],
+    multiprocess_mode="max"
+)
+CIRCUIT_BREAKER_REJECTED = Counter(
+    "whatsapp_circuit_breaker_rejected_total", "Chamadas recusadas na hora com o breaker aberto", ["dependency"]
+)
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "whatsapp_circuit_breaker_transitions_total", "Mudanças de estado do circuit breaker", ["dependency", "state"]
+)
+
+# --- Mídias (ver media_pipeline.py) ---
+MEDIA_JOBS = Counter(
+    "whatsapp_media_jobs_total", "Mensagens de mídia por tipo e resultado", ["media_type", "result"]
+)
+MEDIA_STAGE_SECONDS = Histogram(
+    "whatsapp_media_stage_seconds", "Duração do download e do processamento das mídias", ["media_type", "stage"],
+    buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30, 60, 120)
+)
+MEDIA_DOWNLOAD_BYTES = Counter(
+    "whatsapp_media_download_bytes_total", "Bytes de mídia baixados da MEGA API", ["media_type"]
+)
+
+# --- Log de conversas (ver conversation_log.py) ---
+CONVERSATION_LOG_RECORDS = Counter(
+    "whatsapp_conversation_log_records_total", "Trocas gravadas no log de conversas"
+)
+CONVERSATION_LOG_FSYNC_BATCH = Histogram(
+    "whatsapp_conversation_log_fsync_batch_size", "Trocas gravadas por fsync do log de conversas",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+CONVERSATION_RESTORES = Counter(
+    "whatsapp_conversation_restores_total", "Conversas restauradas do disco na primeira mensagem", ["result"]
+)
+CONVERSATION_COMPACTIONS = Counter(
+    "whatsapp_conversation_compactions_total", "Compactações do log de conversas em snapshots"
+)
+
+
+def render():
+    """(corpo, content type) da página /metrics."""
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
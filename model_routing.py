@@ -0,0 +1,195 @@
+"""
+Roteamento de cada mensagem para um modelo rápido ou avançado.
+
+A maioria das mensagens ("oi", "obrigado", uma pergunta curta já respondida pela base de
+conhecimento) não precisa do modelo mais caro. classify_turn() decide localmente, sem
+chamadas à IA, por características baratas da mensagem: tamanho, várias perguntas ou
+partes, palavras de raciocínio ("compare", "por que", "passo a passo") e se a busca na
+base trouxe contexto. Acima de MODEL_ROUTING_THRESHOLD pontos a mensagem vai para o
+modelo avançado.
+
+Os modelos de cada nível, a temperatura e o máximo de tokens da resposta vêm da página
+"Configuração" do Streamlit, que grava AGENT_CONFIG_PATH; o app.py relê o arquivo quando
+ele muda. Sem o arquivo valem MODEL_FAST e MODEL_STRONG. Latência e custo por nível vão
+para o Prometheus (whatsapp_llm_tier_*) e para /health.
+"""
+
+import os
+import re
+import json
+import time
+import logging
+import threading
+
+from langchain_openai import ChatOpenAI
+
+from deadlines import LLM_MAX_RETRIES, LLM_TIMEOUT_SECONDS
+from metrics import LLM_TIER_CALLS, LLM_TIER_LATENCY, LLM_TIER_COST
+
+logger = logging.getLogger(__name__)
+
+TIER_FAST = "fast"
+TIER_STRONG = "strong"
+MODEL_TIERS = (TIER_FAST, TIER_STRONG)
+
+AGENT_CONFIG_PATH = os.getenv('AGENT_CONFIG_PATH', './agent_config.json')
+MODEL_FAST = os.getenv('MODEL_FAST', 'gpt-3.5-turbo')
+MODEL_STRONG = os.getenv('MODEL_STRONG', 'gpt-4o')
+# Modelos oferecidos na página de configuração (todos atendidos pelo ChatOpenAI)
+AVAILABLE_MODELS = ("gpt-3.5-turbo", "gpt-4o-mini", "gpt-4o", "gpt-4-turbo")
+# false: tudo vai para o modelo rápido (o comportamento antigo, com um modelo só)
+MODEL_ROUTING_ENABLED = os.getenv('MODEL_ROUTING_ENABLED', 'true').lower() == 'true'
+MODEL_ROUTING_THRESHOLD = float(os.getenv('MODEL_ROUTING_THRESHOLD', 2.0))
+AGENT_CONFIG_CHECK_SECONDS = float(os.getenv('AGENT_CONFIG_CHECK_SECONDS', 10))
+
+DEFAULT_AGENT_CONFIG = {
+    "models": {TIER_FAST: MODEL_FAST, TIER_STRONG: MODEL_STRONG},
+    "temperature": 0.7,
+    "max_tokens": None,
+}
+
+# Pedidos que pedem raciocínio, comparação ou explicação longa
+COMPLEXITY_PATTERN = re.compile(
+    r"\b(compar\w*|diferen[çc]a\w*|por que|porque|explique|expli[cq]\w*|como funciona|passo a passo|"
+    r"vantage\w*|desvantage\w*|calcul\w*|analis\w*|recomend\w*|estrat[ée]gia\w*|planej\w*|melhor op[çc][ãa]o)\b",
+    re.IGNORECASE
+)
+# Várias partes numa mensagem: itens de lista, linhas separadas, "e também", "além disso"
+MULTIPART_PATTERN = re.compile(r"(^\s*(?:\d+[.)]|[-*•])\s)|\b(al[ée]m disso|e tamb[ée]m)\b", re.IGNORECASE | re.MULTILINE)
+
+
+def classify_turn(message: str, retrieval_hit: bool = False, history_turns: int = 0):
+    """(nível, pontuação, características) de uma mensagem. Só regex e contagens."""
+    words = len(message.split())
+    features = {
+        "words": words,
+        "questions": message.count("?"),
+        "complexity_terms": len(COMPLEXITY_PATTERN.findall(message)),
+        "multipart": bool(MULTIPART_PATTERN.search(message)) or message.strip().count("\n") >= 2,
+        "retrieval_hit": retrieval_hit,
+        "history_turns": history_turns,
+    }
+    score = 0.0
+    score += 1.0 if words > 25 else 0.0
+    score += 1.0 if words > 60 else 0.0
+    score += 1.0 if features["questions"] > 1 else 0.0
+    score += min(features["complexity_terms"], 2) * 1.5
+    score += 1.0 if features["multipart"] else 0.0
+    # Com contexto da base a resposta já está no prompt; sem ele o modelo precisa raciocinar mais
+    score += -1.0 if retrieval_hit else 0.0
+    # Conversa longa: o modelo rápido perde o fio com mais facilidade
+    score += 0.5 if history_turns >= 10 else 0.0
+    tier = TIER_STRONG if score >= MODEL_ROUTING_THRESHOLD else TIER_FAST
+    return tier, score, features
+
+
+def _default_config() -> dict:
+    return json.loads(json.dumps(DEFAULT_AGENT_CONFIG))
+
+
+def load_agent_config(path: str = AGENT_CONFIG_PATH) -> dict:
+    """Configuração salva pelo Streamlit, completada com os padrões (ou só os padrões)."""
+    config = _default_config()
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+    except FileNotFoundError:
+        return config
+    config["models"].update({tier: model for tier, model in (saved.get("models") or {}).items() if tier in MODEL_TIERS and model})
+    for key in ("temperature", "max_tokens", "personality"):
+        if key in saved:
+            config[key] = saved[key]
+    return config
+
+
+def save_agent_config(config: dict, path: str = AGENT_CONFIG_PATH):
+    """Grava a configuração de forma atômica (o app.py pode estar lendo ao mesmo tempo)."""
+    tmp_path = f"{path}.tmp-{os.getpid()}"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(config, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, path)
+
+
+class ModelRouter:
+    """Escolhe o modelo de cada chamada e registra latência e custo por nível."""
+
+    def __init__(self, api_key: str, config_path: str = AGENT_CONFIG_PATH, enabled: bool = MODEL_ROUTING_ENABLED,
+                 check_seconds: float = AGENT_CONFIG_CHECK_SECONDS):
+        self.api_key = api_key
+        self.config_path = config_path
+        self.enabled = enabled
+        self.check_seconds = check_seconds
+        self._lock = threading.Lock()
+        self._config = None
+        self._config_mtime = None
+        self._checked_at = 0.0
+        self._models = {}
+        self._stats = {tier: {"calls": 0, "seconds": 0.0, "cost_usd": 0.0} for tier in MODEL_TIERS}
+
+    def config(self) -> dict:
+        """Configuração atual; relê o arquivo (no máximo a cada check_seconds) se ele mudou."""
+        now = time.monotonic()
+        with self._lock:
+            if self._config is not None and now - self._checked_at < self.check_seconds:
+                return self._config
+            self._checked_at = now
+            try:
+                mtime = os.stat(self.config_path).st_mtime
+            except FileNotFoundError:
+                mtime = None
+            if self._config is None or mtime != self._config_mtime:
+                try:
+                    self._config = load_agent_config(self.config_path)
+                    self._config_mtime = mtime
+                    logger.info(f"🤖 Modelos do agente: {self._config['models']}")
+                except (OSError, ValueError) as e:
+                    logger.error(f"❌ Configuração do agente ilegível em '{self.config_path}': {e}. Mantendo a anterior.")
+                    self._config = self._config or _default_config()
+            return self._config
+
+    def _model(self, name: str, temperature: float, max_tokens):
+        key = (name, temperature, max_tokens)
+        with self._lock:
+            model = self._models.get(key)
+            if model is None:
+                model = self._models[key] = ChatOpenAI(
+                    api_key=self.api_key, model=name, temperature=temperature, max_tokens=max_tokens,
+                    timeout=LLM_TIMEOUT_SECONDS, max_retries=LLM_MAX_RETRIES
+                )
+            return model
+
+    def route(self, message: str, retrieval_hit: bool = False, history_turns: int = 0):
+        """(nível, modelo LangChain) para a mensagem."""
+        config = self.config()
+        if self.enabled:
+            tier, score, features = classify_turn(message, retrieval_hit, history_turns)
+            logger.info(f"🧭 Nível '{tier}' ({config['models'][tier]}) para a mensagem: pontuação {score:.1f}, {features}")
+        else:
+            tier = TIER_FAST
+        return tier, self._model(config["models"][tier], config["temperature"], config["max_tokens"])
+
+    def record(self, tier: str, model_name: str, seconds: float, cost: float):
+        LLM_TIER_CALLS.labels(tier=tier, model=model_name).inc()
+        LLM_TIER_LATENCY.labels(tier=tier, model=model_name).observe(seconds)
+        LLM_TIER_COST.labels(tier=tier, model=model_name).inc(cost)
+        with self._lock:
+            stats = self._stats[tier]
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["cost_usd"] += cost
+
+    def stats(self) -> dict:
+        config = self.config()
+        with self._lock:
+            return {
+                "enabled": self.enabled,
+                "models": dict(config["models"]),
+                "tiers": {
+                    tier: {
+                        "calls": stats["calls"],
+                        "avg_latency_seconds": round(stats["seconds"] / stats["calls"], 3) if stats["calls"] else None,
+                        "cost_usd": round(stats["cost_usd"], 6),
+                    }
+                    for tier, stats in self._stats.items()
+                },
+            }
@@ -1,11 +1,14 @@
 import os
+import sys
 from dotenv import load_dotenv
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from langchain_chroma import Chroma
 from langchain.schema import Document
 import logging
-import shutil # Importar shutil para remover o diretório
+
+from ingestion import iter_chunks, split_documents, files_run_key, ingest_incremental, chunker_settings
+from embedding_pipeline import checkpoint_path_for, EMBEDDING_MODEL
+from kb_store import create_staging_directory, discard_staging_directory, publish_version
 
 # Configuração de Logging
 logging.basicConfig(
@@ -24,7 +27,11 @@ if not OPENAI_API_KEY:
 
 PERSIST_DIRECTORY = "./chroma_db"
 
-def populate_chroma_db():
+def populate_chroma_db(file_paths=None):
+    """
+    Popula o ChromaDB com os textos embutidos abaixo e, opcionalmente, com arquivos
+    PDF/TXT passados na linha de comando (processados em paralelo por ingestion.py).
+    """
     logger.info("Iniciando o processo de popular o ChromaDB...")
 
     # --- SEUS DOCUMENTOS AQUI ---
@@ -38,40 +45,52 @@ def populate_chroma_db():
     ]
 
     # Converte o conteúdo em objetos Document do LangChain
-    documents = [Document(page_content=content) for content in docs_content]
+    documents = [Document(page_content=content, metadata={"source": "populate_chroma"}) for content in docs_content]
 
     # Divide os documentos em chunks (pedaços menores para a IA processar)
-    text_splitter = RecursiveCharacterTextSplitter(
+    inline_chunker = chunker_settings(
         chunk_size=500,        # Tamanho máximo de cada pedaço de texto (ajuste se precisar)
         chunk_overlap=100      # Quanto os pedaços se sobrepõem para manter contexto
     )
-    chunks = text_splitter.split_documents(documents)
-    logger.info(f"Documentos divididos em {len(chunks)} chunks.")
+    chunks = split_documents(documents, inline_chunker["chunk_size"], inline_chunker["chunk_overlap"])
+    logger.info(f"Documentos embutidos divididos em {len(chunks)} chunks.")
+
+    # Arquivos adicionais (PDF/TXT) seguem em fluxo, página a página, com a configuração padrão do pipeline
+    file_paths = list(file_paths or [])
+    failures = {}
+
+    def all_chunks():
+        yield from chunks
+        if file_paths:
+            yield from iter_chunks(file_paths, failures=failures)
 
     # Inicializa os embeddings (MESMO MODELO USADO NO APP.PY - IMPORTANTE!)
-    embeddings = OpenAIEmbeddings(model="text-embedding-ada-002", openai_api_key=OPENAI_API_KEY)
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL, openai_api_key=OPENAI_API_KEY)
 
-    # Remove o diretório persistente antes de criar um novo para garantir a compatibilidade
-    # e evitar problemas de versões anteriores.
-    if os.path.exists(PERSIST_DIRECTORY):
-        try:
-            shutil.rmtree(PERSIST_DIRECTORY)
-            logger.info(f"Diretório '{PERSIST_DIRECTORY}' removido com sucesso para recriação.")
-        except Exception as e:
-            logger.error(f"Erro ao remover o diretório '{PERSIST_DIRECTORY}': {e}. Por favor, verifique permissões ou se o diretório não está em uso.")
-            exit(1) # Sai se não conseguir remover
+    # Constrói a nova base num diretório de staging; a versão publicada continua em uso até a troca.
+    # Se a última execução com os mesmos documentos foi interrompida, o staging dela é reaproveitado
+    # e os chunks já gravados são ignorados.
+    run_key = files_run_key(file_paths, extra_texts=docs_content)
+    staging_path = create_staging_directory(PERSIST_DIRECTORY, run_key)
+    logger.info(f"Criando novo ChromaDB em '{staging_path}' e adicionando documentos...")
+    vectorstore = Chroma(persist_directory=staging_path, embedding_function=embeddings)
+    stats = ingest_incremental(all_chunks(), vectorstore._collection, embeddings, staging_path,
+                               checkpoint_path=checkpoint_path_for(staging_path),
+                               run_key=run_key, failures=failures)
+    if failures:
+        logger.warning(f"⚠️ {len(failures)} arquivo(s) não puderam ser processados e foram ignorados: {list(failures)}")
 
-    # Cria ou carrega o ChromaDB e adiciona os chunks
-    logger.info(f"Criando novo ChromaDB em '{PERSIST_DIRECTORY}' e adicionando documentos...")
-    vectorstore = Chroma.from_documents(
-        documents=chunks,
-        embedding=embeddings,
-        persist_directory=PERSIST_DIRECTORY
-    )
-    # Salva o vectorstore no disco para uso futuro
-    vectorstore.persist()
-    logger.info(f"✅ ChromaDB populado com {len(chunks)} documentos e salvo!")
+    # Valida e publica com troca atômica do ponteiro PERSIST_DIRECTORY
+    try:
+        chunkers = [inline_chunker] + ([chunker_settings()] if file_paths else [])
+        version_path = publish_version(PERSIST_DIRECTORY, staging_path, EMBEDDING_MODEL, chunkers)
+    except Exception as e:
+        logger.error(f"❌ A nova base falhou na validação e não foi publicada: {e}. A versão atual continua ativa.")
+        discard_staging_directory(staging_path)
+        exit(1)
+    logger.info(f"✅ ChromaDB populado com {stats['added'] + stats['unchanged']} documentos e publicado em '{version_path}'!")
     logger.info("Processo de população concluído. Agora você pode reiniciar seu 'app.py'.")
 
 if __name__ == "__main__":
-    populate_chroma_db()
\ No newline at end of file
+    # Uso: python populate_chroma.py [arquivo1.pdf arquivo2.txt ...]
+    populate_chroma_db(sys.argv[1:])
\ No newline at end of file
@@ -0,0 +1,95 @@
+"""
+Re-ranking por diversidade (maximal marginal relevance) dos chunks recuperados.
+
+Com chunks de 1000/200 caracteres com sobreposição, os k resultados de uma busca costumam
+ser quase o mesmo trecho repetido. O MMRRetriever busca um conjunto maior de candidatos e
+escolhe os k finais equilibrando relevância e diversidade, numa única passada vetorizada
+sobre os embeddings dos candidatos (uma multiplicação de matrizes + k passos de argmax).
+"""
+
+import os
+import logging
+from typing import Any
+
+import numpy as np
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+RAG_MMR_ENABLED = os.getenv('RAG_MMR_ENABLED', 'false').lower() == 'true'
+# Candidatos buscados antes do re-ranking
+RAG_MMR_FETCH_K = int(os.getenv('RAG_MMR_FETCH_K', 20))
+# 1.0 = só relevância, 0.0 = só diversidade
+RAG_MMR_LAMBDA = float(os.getenv('RAG_MMR_LAMBDA', 0.5))
+
+
+def _normalize(vectors):
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+
+def mmr_select(relevance, candidate_vectors, k: int, lambda_mult: float = RAG_MMR_LAMBDA):
+    """
+    Índices dos k candidatos escolhidos por MMR, na ordem de escolha.
+    relevance: relevância de cada candidato para a pergunta (maior = melhor).
+    """
+    relevance = np.asarray(relevance, dtype=np.float32)
+    k = min(k, len(relevance))
+    if k <= 0:
+        return []
+    vectors = _normalize(candidate_vectors)
+    similarity = vectors @ vectors.T
+    selected = [int(np.argmax(relevance))]
+    # Maior similaridade de cada candidato com algum já escolhido
+    redundancy = similarity[selected[0]].copy()
+    for _ in range(1, k):
+        scores = lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores[selected] = -np.inf
+        chosen = int(np.argmax(scores))
+        selected.append(chosen)
+        np.maximum(redundancy, similarity[chosen], out=redundancy)
+    return selected
+
+
+def chroma_vector_lookup(collection):
+    """Busca os embeddings de chunks pelo ID numa coleção do Chroma."""
+    def _lookup(ids):
+        result = collection.get(ids=list(ids), include=["embeddings"])
+        by_id = dict(zip(result["ids"], result["embeddings"]))
+        return [by_id.get(chunk_id) for chunk_id in ids]
+    return _lookup
+
+
+class MMRRetriever(BaseRetriever):
+    """
+    Aplica MMR sobre os documentos de outro retriever (vetorial, NumPy ou híbrido), que deve
+    devolver fetch_k candidatos com Document.id preenchido.
+
+    A relevância é a similaridade com a pergunta quando o embedding dela já está no cache
+    (ver embedding_pipeline.CachedQueryEmbeddings); senão, a posição no ranking original, para
+    não gerar um embedding só para o re-ranking (ex.: atalho léxico do HybridRetriever).
+    """
+
+    base_retriever: Any
+    vector_lookup: Any
+    embeddings: Any = None
+    k: int = 3
+    lambda_mult: float = RAG_MMR_LAMBDA
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None):
+        documents = self.base_retriever.invoke(query)
+        if len(documents) <= self.k:
+            return documents
+
+        ids = [document.id or document.metadata.get("id") for document in documents]
+        vectors = self.vector_lookup(ids) if all(ids) else None
+        if vectors is None or any(vector is None for vector in vectors):
+            logger.warning("⚠️ MMR: embeddings dos candidatos indisponíveis. Usando a ordem original.")
+            return documents[:self.k]
+
+        query_vector = self.embeddings.cached_query(query) if hasattr(self.embeddings, "cached_query") else None
+        if query_vector is not None:
+            relevance = _normalize(vectors) @ _normalize(query_vector)
+        else:
+            relevance = 1.0 - np.arange(len(documents), dtype=np.float32) / len(documents)
+        return [documents[i] for i in mmr_select(relevance, vectors, self.k, self.lambda_mult)]
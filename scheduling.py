@@ -0,0 +1,76 @@
+"""
+Classes de prioridade e fila justa ponderada (weighted fair queuing) do processamento.
+
+Conversas diretas com clientes, mensagens de grupo, testes pela /api/chat e tarefas de
+fundo (resumos, re-embedding) disputam as mesmas vagas de processamento da IA (ver
+admission.py). Cada classe recebe vagas na proporção do seu peso em PRIORITY_WEIGHTS: um
+grupo movimentado enche a fila dele, mas não atrasa a vez dos clientes no privado.
+"""
+
+import os
+import heapq
+import itertools
+
+PRIORITY_DIRECT = "direct"
+PRIORITY_GROUP = "group"
+PRIORITY_API = "api"
+PRIORITY_BACKGROUND = "background"
+PRIORITY_CLASSES = (PRIORITY_DIRECT, PRIORITY_GROUP, PRIORITY_API, PRIORITY_BACKGROUND)
+
+
+def _parse_weights(value: str) -> dict:
+    weights = {priority: 1.0 for priority in PRIORITY_CLASSES}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        priority, _, weight = item.partition("=")
+        if priority not in weights or float(weight) <= 0:
+            raise ValueError(f"PRIORITY_WEIGHTS inválido: '{item}' (classes: {', '.join(PRIORITY_CLASSES)})")
+        weights[priority] = float(weight)
+    return weights
+
+
+# Pesos por classe ("classe=peso,..."); classes omitidas têm peso 1
+PRIORITY_WEIGHTS = _parse_weights(os.getenv('PRIORITY_WEIGHTS', 'direct=8,group=2,api=1,background=1'))
+
+
+def priority_for_jid(jid: str) -> str:
+    """Classe de uma mensagem do WhatsApp pelo remoteJid (grupos terminam em @g.us)."""
+    return PRIORITY_GROUP if jid.endswith("@g.us") else PRIORITY_DIRECT
+
+
+class WeightedFairQueue:
+    """
+    Self-clocked fair queuing entre as classes: cada item recebe a etiqueta de término
+    max(tempo virtual, última etiqueta da classe) + 1/peso e sai o de menor etiqueta.
+    Dentro de uma classe a ordem é de chegada. Não é thread-safe (quem usa trava).
+    """
+
+    def __init__(self, weights: dict = None):
+        self.weights = dict(weights or PRIORITY_WEIGHTS)
+        self._heap = []
+        self._sequence = itertools.count()
+        self._last_finish = {priority: 0.0 for priority in self.weights}
+        self._virtual_time = 0.0
+        self._lengths = {priority: 0 for priority in self.weights}
+
+    def push(self, priority: str, item):
+        if priority not in self.weights:
+            raise ValueError(f"classe de prioridade desconhecida: '{priority}'")
+        finish = max(self._virtual_time, self._last_finish[priority]) + 1.0 / self.weights[priority]
+        self._last_finish[priority] = finish
+        self._lengths[priority] += 1
+        heapq.heappush(self._heap, (finish, next(self._sequence), priority, item))
+
+    def pop(self):
+        """(classe, item) com a menor etiqueta, ou None se a fila estiver vazia."""
+        if not self._heap:
+            return None
+        finish, _, priority, item = heapq.heappop(self._heap)
+        self._virtual_time = finish
+        self._lengths[priority] -= 1
+        return priority, item
+
+    def lengths(self) -> dict:
+        return dict(self._lengths)
+
+    def __len__(self):
+        return len(self._heap)
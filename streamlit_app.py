@@ -7,14 +7,22 @@ import shutil
 import pytz
 
 # Langchain imports for RAG
-from langchain_community.document_loaders import PyPDFLoader, TextLoader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_openai import OpenAIEmbeddings
-from langchain_community.vectorstores import Chroma
+from langchain_chroma import Chroma
 from langchain.chains import RetrievalQA
 from langchain_openai import ChatOpenAI
 from openai import AuthenticationError, APIError # <--- IMPORTE ESTES ERROS ESPECÍFICOS
 
+from ingestion import save_uploaded_files, iter_chunks, tag_chunks, files_run_key, ingest_incremental, chunker_settings
+from embedding_pipeline import checkpoint_path_for, EMBEDDING_MODEL, CachedQueryEmbeddings
+from reranking import RAG_MMR_ENABLED, RAG_MMR_FETCH_K, RAG_MMR_LAMBDA, MMRRetriever, chroma_vector_lookup
+from kb_store import (
+    resolve_version_path, create_staging_directory, discard_staging_directory,
+    publish_version, list_versions, rollback, reset_knowledge_base, read_manifest
+)
+from knowledge_bases import DEFAULT_KNOWLEDGE_BASE, persist_directory_for, list_knowledge_bases
+from model_routing import AVAILABLE_MODELS, TIER_FAST, TIER_STRONG, load_agent_config, save_agent_config
+
 # --- Configuração Inicial e Variáveis de Ambiente ---
 load_dotenv()
 
@@ -29,7 +37,7 @@ if not OPENAI_API_KEY:
 
 try:
     # Tenta inicializar os embeddings globalmente e verifica a chave
-    GLOBAL_OPENAI_EMBEDDINGS = OpenAIEmbeddings(model="text-embedding-ada-002", openai_api_key=OPENAI_API_KEY)
+    GLOBAL_OPENAI_EMBEDDINGS = OpenAIEmbeddings(model=EMBEDDING_MODEL, openai_api_key=OPENAI_API_KEY)
     
     # Você pode adicionar uma pequena chamada de teste aqui se quiser, mas a própria inicialização
     # do OpenAIEmbeddings já dispara AuthenticationError para chaves inválidas na maioria dos casos.
@@ -112,68 +120,129 @@ def init_openai():
     # Esta função agora retorna o modelo de chat global, já inicializado e validado
     return GLOBAL_CHAT_MODEL
 
-def create_new_knowledge_base(uploaded_files, persist_directory):
+def ingest_uploaded_files(saved_files, vectorstore, persist_directory, run_key, tag=None):
+    """
+    Ingestão em fluxo dos arquivos salvos (ver ingestion.py): o parsing roda em paralelo,
+    página a página, e os chunks seguem direto para o embedding incremental (chunks já
+    ingeridos são ignorados). Exibe o progresso por arquivo e por lote; arquivos com erro
+    são reportados sem abortar o lote. tag (opcional) marca os chunks novos para filtros.
+    """
+    files_bar = st.progress(0.0, text="📄 Processando arquivos...")
+    batches_text = st.empty()
+    failures = {}
+
+    def on_file_progress(done, total, file_path, error):
+        status = "❌ falhou" if error else "✅ ok"
+        files_bar.progress(done / total, text=f"📄 [{done}/{total}] {os.path.basename(file_path)} {status}")
+
+    def on_batch_progress(done_batches, written_chunks):
+        batches_text.caption(f"🧠 {done_batches} lotes de embedding concluídos ({written_chunks} chunks gravados)")
+
+    try:
+        stats = ingest_incremental(
+            tag_chunks(iter_chunks(saved_files, progress_callback=on_file_progress, failures=failures), tag),
+            vectorstore._collection,
+            GLOBAL_OPENAI_EMBEDDINGS,
+            persist_directory,
+            checkpoint_path=checkpoint_path_for(persist_directory),
+            run_key=run_key,
+            failures=failures,
+            progress_callback=on_batch_progress
+        )
+    finally:
+        files_bar.empty()
+        batches_text.empty()
+
+    for file_path, error in failures.items():
+        st.warning(f"⚠️ Não foi possível processar '{os.path.basename(file_path)}': {error}")
+
+    return stats
+
+def build_and_publish(uploaded_files, persist_directory, copy_current, tag=None):
+    """
+    Faz a ingestão num diretório de staging (ver kb_store.py) e publica a nova versão com
+    uma troca atômica do ponteiro. A versão em uso continua servindo o agente durante todo
+    o processo. Retorna as contagens da ingestão, ou None se nada foi publicado.
+    """
+    saved_files = save_uploaded_files(uploaded_files)
+    run_key = files_run_key(saved_files)
+    staging_path = create_staging_directory(persist_directory, run_key, copy_current=copy_current)
+    
+    # USAR O EMBEDDING GLOBAL AQUI
+    vectorstore = Chroma(persist_directory=staging_path, embedding_function=GLOBAL_OPENAI_EMBEDDINGS)
+    try:
+        stats = ingest_uploaded_files(saved_files, vectorstore, staging_path, run_key, tag)
+    except Exception as e:
+        st.error(f"❌ Falha ao gerar embeddings: {e}. Tente novamente para retomar do último lote concluído.")
+        return None
+    
+    if not stats['added'] + stats['unchanged']:
+        discard_staging_directory(staging_path)
+        st.error("❌ Nenhum conteúdo pôde ser extraído dos arquivos enviados. A base não foi alterada.")
+        return None
+    
+    try:
+        publish_version(persist_directory, staging_path, EMBEDDING_MODEL, [chunker_settings()])
+    except Exception as e:
+        discard_staging_directory(staging_path)
+        st.error(f"❌ A nova versão da base falhou na validação e não foi publicada: {e}. A versão atual continua ativa.")
+        return None
+    return stats
+
+def create_new_knowledge_base(uploaded_files, persist_directory, tag=None):
     """Cria uma nova base de conhecimento com os documentos fornecidos."""
     with st.spinner("🔄 Criando nova base de conhecimento..."):
-        os.makedirs("uploaded_files", exist_ok=True)
-        saved_files = []
-        
-        for uploaded_file in uploaded_files:
-            file_path = os.path.join("uploaded_files", uploaded_file.name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            saved_files.append(file_path)
-        
-        documents = []
-        for file_path in saved_files:
-            if file_path.endswith('.pdf'):
-                loader = PyPDFLoader(file_path)
-            elif file_path.endswith('.txt'):
-                loader = TextLoader(file_path)
-            documents.extend(loader.load())
-        
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(documents)
-        
-        # USAR O EMBEDDING GLOBAL AQUI
-        embeddings = GLOBAL_OPENAI_EMBEDDINGS 
-        
-        if os.path.exists(persist_directory):
-            shutil.rmtree(persist_directory)
-        
-        vectorstore = Chroma.from_documents(chunks, embeddings, persist_directory=persist_directory)
+        stats = build_and_publish(uploaded_files, persist_directory, copy_current=False, tag=tag)
+        if stats is None:
+            return
         
-        show_notification(f"Base de conhecimento criada com {len(chunks)} chunks!", "success")
+        show_notification(f"Base de conhecimento criada com {stats['added'] + stats['unchanged']} chunks!", "success")
         st.rerun()
 
-def process_and_add_documents(uploaded_files, vectorstore, persist_directory):
-    """Adiciona novos documentos a uma base de conhecimento existente."""
+def process_and_add_documents(uploaded_files, persist_directory, tag=None):
+    """
+    Adiciona documentos a uma base existente. Documentos já ingeridos não são duplicados:
+    chunks inalterados são ignorados e documentos alterados geram apenas o diff (novos/removidos).
+    As alterações são feitas numa cópia da versão atual e publicadas ao final.
+    """
     with st.spinner("➕ Adicionando documentos à base existente..."):
-        os.makedirs("uploaded_files", exist_ok=True)
-        saved_files = []
-        
-        for uploaded_file in uploaded_files:
-            file_path = os.path.join("uploaded_files", uploaded_file.name)
-            with open(file_path, "wb") as f:
-                f.write(uploaded_file.getbuffer())
-            saved_files.append(file_path)
-        
-        documents = []
-        for file_path in saved_files:
-            if file_path.endswith('.pdf'):
-                loader = PyPDFLoader(file_path)
-            elif file_path.endswith('.txt'):
-                loader = TextLoader(file_path)
-            documents.extend(loader.load())
-        
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-        chunks = text_splitter.split_documents(documents)
-        
-        vectorstore.add_documents(chunks) 
+        stats = build_and_publish(uploaded_files, persist_directory, copy_current=True, tag=tag)
+        if stats is None:
+            return
         
-        show_notification(f"{len(chunks)} novos chunks adicionados à base!", "success")
+        show_notification(
+            f"{stats['added']} novos chunks adicionados, {stats['unchanged']} já existentes ignorados "
+            f"e {stats['deleted']} obsoletos removidos!",
+            "success"
+        )
         st.rerun()
 
+def current_persist_directory():
+    """Ponteiro da base de conhecimento selecionada na barra lateral (ver knowledge_bases.py)."""
+    return persist_directory_for(st.session_state.get("knowledge_base", DEFAULT_KNOWLEDGE_BASE))
+
+def knowledge_base_selector():
+    """Seleção da base de conhecimento (uma por instância/cliente) na barra lateral."""
+    options = list_knowledge_bases()
+    current = st.session_state.get("knowledge_base", DEFAULT_KNOWLEDGE_BASE)
+    if current not in options:
+        options.append(current)
+    selected = st.sidebar.selectbox(
+        "📚 Base de conhecimento:", options, index=options.index(current),
+        help="A base 'default' atende as instâncias sem base própria. Use o ID da instância como nome para vinculá-la."
+    )
+    new_name = st.sidebar.text_input("Nova base (nome ou ID da instância):", key="new_knowledge_base_name").strip()
+    if new_name and new_name != selected:
+        try:
+            persist_directory_for(new_name)
+            selected = new_name
+        except ValueError as e:
+            st.sidebar.error(f"❌ {e}")
+    if selected != current:
+        # O histórico do chat de teste pertence à base anterior
+        st.session_state.messages = []
+    st.session_state.knowledge_base = selected
+
 # --- Páginas da Aplicação (continuando) ---
 
 def dashboard_page():
@@ -195,7 +264,7 @@ def dashboard_page():
     
     st.markdown("</div>", unsafe_allow_html=True)
 
-    persist_directory = "./chroma_db"
+    persist_directory = current_persist_directory()
     db_status = "Não Inicializado"
     chunk_count = 0
     status_type = "offline"
@@ -203,17 +272,16 @@ def dashboard_page():
     if os.path.exists(persist_directory) and os.listdir(persist_directory):
         try:
             # USAR O EMBEDDING GLOBAL AQUI
-            vectorstore = Chroma(persist_directory=persist_directory, embedding_function=GLOBAL_OPENAI_EMBEDDINGS)
+            vectorstore = Chroma(persist_directory=resolve_version_path(persist_directory), embedding_function=GLOBAL_OPENAI_EMBEDDINGS)
             collection = vectorstore._collection
             chunk_count = collection.count()
             db_status = "Online"
             status_type = "online"
         except Exception as e:
-            st.error(f"Erro ao carregar base de conhecimento: {e}. Tentando recriar ou avisar...")
-            shutil.rmtree(persist_directory, ignore_errors=True) 
+            st.error(f"Erro ao carregar base de conhecimento: {e}.")
             db_status = "Erro"
             status_type = "warning"
-            st.warning("Base de conhecimento corrompida ou não carregada. Por favor, crie uma nova base na seção 'Documentos'.")
+            st.warning("Base de conhecimento corrompida ou não carregada. Use o rollback ou crie uma nova base na seção 'Documentos'.")
 
     col1, col2, col3, col4 = st.columns(4)
     
@@ -290,7 +358,7 @@ def documents_page():
     </div>
     """, unsafe_allow_html=True)
     
-    persist_directory = "./chroma_db"
+    persist_directory = current_persist_directory()
     
     # USAR O EMBEDDING GLOBAL AQUI
     embeddings_openai = GLOBAL_OPENAI_EMBEDDINGS
@@ -310,7 +378,7 @@ def documents_page():
         
         try:
             # USAR O EMBEDDING GLOBAL AQUI
-            vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embeddings_openai)
+            vectorstore = Chroma(persist_directory=resolve_version_path(persist_directory), embedding_function=embeddings_openai)
             collection = vectorstore._collection
             count = collection.count()
             st.markdown(f"""
@@ -334,8 +402,12 @@ def documents_page():
                 key="add_docs_uploader"
             )
             
+            add_tag = st.text_input(
+                "Tag dos novos documentos (opcional)", key="add_docs_tag",
+                help="Permite restringir as buscas a um assunto (ex.: produtos, suporte). Trechos já existentes mantêm a tag original."
+            )
             if uploaded_files and st.button("🚀 Processar e Adicionar Documentos", key="process_add_button"):
-                process_and_add_documents(uploaded_files, vectorstore, persist_directory)
+                process_and_add_documents(uploaded_files, persist_directory, add_tag.strip() or None)
 
         except Exception as e:
             st.error(f"⚠️ Erro ao carregar base de conhecimento existente: {e}. A base pode estar corrompida. Recomenda-se resetar ou criar uma nova.")
@@ -374,9 +446,24 @@ def documents_page():
             confirm_reset = st.checkbox("Confirmo que quero deletar toda a base de conhecimento", key="confirm_reset_checkbox")
         with col_reset2:
             if st.button("🗑️ Resetar Base", type="secondary", disabled=not confirm_reset, key="reset_button"):
-                shutil.rmtree(persist_directory, ignore_errors=True)
+                reset_knowledge_base(persist_directory)
                 show_notification("Base de conhecimento resetada!", "success")
                 st.rerun()
+        
+        versions = list_versions(persist_directory)
+        current_version = resolve_version_path(persist_directory)
+        manifest = read_manifest(current_version)
+        if manifest:
+            st.caption(
+                f"Modelo: {manifest['embedding_model']} ({manifest['embedding_dimension']} dimensões) · "
+                f"{manifest['document_count']} chunks · hash {manifest['version_hash']}"
+            )
+        if current_version in versions and versions.index(current_version) > 0:
+            st.caption(f"Versão ativa: {os.path.basename(current_version)} ({len(versions)} versões mantidas)")
+            if st.button("⏪ Voltar para a versão anterior", key="rollback_button"):
+                previous_version = rollback(persist_directory)
+                show_notification(f"Base revertida para {os.path.basename(previous_version)}!", "success")
+                st.rerun()
     
     else:
         st.markdown("""
@@ -399,8 +486,12 @@ def documents_page():
             key="create_docs_uploader"
         )
         
+        create_tag = st.text_input(
+            "Tag dos documentos (opcional)", key="create_docs_tag",
+            help="Permite restringir as buscas a um assunto (ex.: produtos, suporte)."
+        )
         if uploaded_files and st.button("🚀 Criar Base de Conhecimento", key="create_base_button"):
-            create_new_knowledge_base(uploaded_files, persist_directory)
+            create_new_knowledge_base(uploaded_files, persist_directory, create_tag.strip() or None)
 
     st.markdown("---")
     
@@ -438,10 +529,12 @@ def rag_chat_page():
     </div>
     """, unsafe_allow_html=True)
     
-    persist_directory = "./chroma_db"
+    persist_directory = current_persist_directory()
     
-    # USAR O EMBEDDING GLOBAL AQUI
-    embeddings_openai = GLOBAL_OPENAI_EMBEDDINGS
+    # USAR O EMBEDDING GLOBAL AQUI, com cache de perguntas mantido entre os reruns (o MMR reaproveita o vetor)
+    if "query_embeddings" not in st.session_state:
+        st.session_state.query_embeddings = CachedQueryEmbeddings(GLOBAL_OPENAI_EMBEDDINGS)
+    embeddings_openai = st.session_state.query_embeddings
 
     if not os.path.exists(persist_directory) or not os.listdir(persist_directory):
         st.markdown("""
@@ -465,7 +558,7 @@ def rag_chat_page():
     
     try:
         # USAR O EMBEDDING GLOBAL AQUI
-        vectorstore = Chroma(persist_directory=persist_directory, embedding_function=embeddings_openai)
+        vectorstore = Chroma(persist_directory=resolve_version_path(persist_directory), embedding_function=embeddings_openai)
         
         if vectorstore._collection.count() == 0:
             st.error("⚠️ A base de conhecimento está vazia ou corrompida. Por favor, resete-a na seção 'Documentos'.")
@@ -475,10 +568,39 @@ def rag_chat_page():
         st.error(f"⚠️ Erro ao carregar base de conhecimento: {e}. A base pode estar corrompida. Por favor, resete-a na seção 'Documentos'.")
         return
     
+    with st.expander("⚙️ Ajustes de recuperação"):
+        use_mmr = st.checkbox(
+            "Diversificar trechos (MMR)", value=RAG_MMR_ENABLED, key="rag_mmr_enabled",
+            help="Busca mais candidatos e evita enviar ao modelo trechos quase repetidos."
+        )
+        mmr_fetch_k = st.slider("Candidatos avaliados", 5, 50, RAG_MMR_FETCH_K, key="rag_mmr_fetch_k", disabled=not use_mmr)
+        mmr_lambda = st.slider(
+            "Relevância × diversidade", 0.0, 1.0, RAG_MMR_LAMBDA, 0.05, key="rag_mmr_lambda", disabled=not use_mmr,
+            help="1.0 = só relevância; 0.0 = só diversidade."
+        )
+        filter_tag = st.text_input("Filtrar por tag", key="rag_filter_tag").strip()
+        filter_source = st.text_input("Filtrar por arquivo (caminho da fonte)", key="rag_filter_source").strip()
+
+    search_kwargs = {"k": mmr_fetch_k if use_mmr else 3}
+    metadata_filter = {field: value for field, value in (("tag", filter_tag), ("source", filter_source)) if value}
+    if len(metadata_filter) == 1:
+        search_kwargs["filter"] = metadata_filter
+    elif metadata_filter:
+        search_kwargs["filter"] = {"$and": [{field: value} for field, value in metadata_filter.items()]}
+    retriever = vectorstore.as_retriever(search_kwargs=search_kwargs)
+    if use_mmr:
+        retriever = MMRRetriever(
+            base_retriever=retriever,
+            vector_lookup=chroma_vector_lookup(vectorstore._collection),
+            embeddings=embeddings_openai,
+            k=3,
+            lambda_mult=mmr_lambda
+        )
+
     qa_chain = RetrievalQA.from_chain_type(
         llm=llm,
         chain_type="stuff",
-        retriever=vectorstore.as_retriever(search_kwargs={"k": 3}),
+        retriever=retriever,
         return_source_documents=True
     )
     
@@ -547,6 +669,7 @@ def agent_config_page():
     </div>
     """, unsafe_allow_html=True)
     
+    agent_config = load_agent_config()
     col1, col2 = st.columns(2)
     
     with col1:
@@ -558,9 +681,11 @@ def agent_config_page():
         </div>
         """, unsafe_allow_html=True)
         
+        personalities = ["Profissional", "Amigável", "Técnico", "Casual"]
         personality = st.selectbox(
             "Escolha a personalidade:",
-            ["Profissional", "Amigável", "Técnico", "Casual"],
+            personalities,
+            index=personalities.index(agent_config.get("personality", "Profissional")) if agent_config.get("personality") in personalities else 0,
             key="agent_personality_select"
         )
     
@@ -573,11 +698,19 @@ def agent_config_page():
         </div>
         """, unsafe_allow_html=True)
         
-        model = st.selectbox(
-            "Modelo:",
-            ["GPT-3.5-Turbo", "GPT-4o", "Claude 3 Opus", "Gemini Pro"],
+        # Mensagens simples vão para o modelo rápido e as complexas para o avançado (ver model_routing.py)
+        fast_model = st.selectbox(
+            "Modelo rápido (mensagens simples):",
+            AVAILABLE_MODELS,
+            index=_model_index(agent_config["models"][TIER_FAST]),
             key="agent_model_select"
         )
+        strong_model = st.selectbox(
+            "Modelo avançado (perguntas complexas):",
+            AVAILABLE_MODELS,
+            index=_model_index(agent_config["models"][TIER_STRONG]),
+            key="agent_strong_model_select"
+        )
     
     st.markdown("---")
     
@@ -588,20 +721,33 @@ def agent_config_page():
     
     temperature = st.slider(
         "Temperatura (Criatividade)", 
-        min_value=0.0, max_value=1.0, value=0.7, step=0.1,
+        min_value=0.0, max_value=1.0, value=float(agent_config["temperature"]), step=0.1,
         help="Um valor mais alto torna as respostas mais criativas"
     )
     
     max_tokens = st.slider(
         "Máximo de Tokens na Resposta", 
-        min_value=50, max_value=2000, value=500, step=50,
+        min_value=50, max_value=2000, value=int(agent_config["max_tokens"] or 500), step=50,
         help="Define o tamanho máximo da resposta gerada pela IA"
     )
     
     st.markdown("</div>", unsafe_allow_html=True)
     
     if st.button("💾 Salvar Configurações do Agente", key="save_agent_config_button"):
-        show_notification(f"Configurações salvas! Personalidade: {personality}, Modelo: {model}", "success")
+        try:
+            # O app.py relê o arquivo e passa a usar os novos modelos sem reiniciar
+            save_agent_config({
+                "personality": personality,
+                "models": {TIER_FAST: fast_model, TIER_STRONG: strong_model},
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+            })
+            st.success(f"Configurações salvas! Personalidade: {personality}, modelos: {fast_model} (rápido) / {strong_model} (avançado)")
+        except OSError as e:
+            st.error(f"❌ Não foi possível salvar as configurações: {e}")
+
+def _model_index(model: str) -> int:
+    return AVAILABLE_MODELS.index(model) if model in AVAILABLE_MODELS else 0
 
 def analytics_page():
     st.markdown('<h2 class="section-title fade-in">📊 Analytics e Relatórios</h2>', unsafe_allow_html=True)
@@ -934,6 +1080,8 @@ def main():
         list(pages.keys()),
         format_func=lambda x: x
     )
+
+    knowledge_base_selector()
     
     st.sidebar.markdown(f"""
     <div style="background: rgba(255,255,255,0.1); padding: 1rem; border-radius: 12px; margin: 1rem 0;">
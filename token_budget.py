@@ -0,0 +1,182 @@
+"""
+Contagem de tokens e orçamento do prompt das chamadas à IA.
+
+Cada chamada mede as partes do prompt (modelo do prompt, histórico, contexto recuperado e a
+mensagem do usuário) e, se a soma passar de PROMPT_TOKEN_BUDGET, corta primeiro o que vale
+menos: os trechos recuperados de pior colocação e as trocas mais antigas do histórico. Só
+em último caso a parte mais valiosa restante e a própria mensagem são truncadas.
+
+Os tokens de prompt e de resposta de cada chamada são registrados por conversa
+(TokenLedger, em /health) e no Prometheus (whatsapp_llm_tokens_total).
+
+A contagem usa o tiktoken do modelo; sem o arquivo de codificação (por exemplo, sem acesso
+à internet no primeiro uso) cai para uma estimativa por caracteres.
+"""
+
+import os
+import logging
+import threading
+from collections import OrderedDict
+
+from metrics import LLM_TOKENS, LLM_PROMPT_TOKENS, PROMPT_TRIMMED_TOKENS
+
+logger = logging.getLogger(__name__)
+
+try:
+    import tiktoken
+except ImportError:  # pragma: no cover - tiktoken vem no requirements.txt
+    tiktoken = None
+
+# Tokens do prompt enviado (modelo do prompt + histórico/contexto + mensagem)
+PROMPT_TOKEN_BUDGET = int(os.getenv('PROMPT_TOKEN_BUDGET', 3000))
+# Partes menores que isso não valem a pena truncar (são descartadas inteiras)
+MIN_TRUNCATED_PART_TOKENS = int(os.getenv('MIN_TRUNCATED_PART_TOKENS', 50))
+# Conversas com consumo guardado em memória (LRU)
+TOKEN_LEDGER_MAX_CONVERSATIONS = int(os.getenv('TOKEN_LEDGER_MAX_CONVERSATIONS', 10000))
+_CHARS_PER_TOKEN = 3.5
+
+
+class TokenCounter:
+    """Conta tokens com o tiktoken do modelo (ou estima por caracteres, se indisponível)."""
+
+    def __init__(self, model: str):
+        self.model = model
+        self._encoding = None
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def _get_encoding(self):
+        if not self._loaded:
+            with self._lock:
+                if not self._loaded:
+                    try:
+                        try:
+                            self._encoding = tiktoken.encoding_for_model(self.model)
+                        except KeyError:
+                            self._encoding = tiktoken.get_encoding("cl100k_base")
+                    except Exception as e:
+                        logger.warning(f"⚠️ Codificação do tiktoken indisponível para '{self.model}' ({e}). "
+                                       f"Tokens estimados por caracteres.")
+                    self._loaded = True
+        return self._encoding
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        encoding = self._get_encoding() if tiktoken is not None else None
+        if encoding is None:
+            return int(len(text) / _CHARS_PER_TOKEN) + 1
+        return len(encoding.encode(text, disallowed_special=()))
+
+    def truncate(self, text: str, max_tokens: int) -> str:
+        """Os primeiros max_tokens tokens de text."""
+        if max_tokens <= 0:
+            return ""
+        encoding = self._get_encoding() if tiktoken is not None else None
+        if encoding is None:
+            return text[:int(max_tokens * _CHARS_PER_TOKEN)]
+        tokens = encoding.encode(text, disallowed_special=())
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+
+
+class PromptPart:
+    """Trecho opcional do prompt. Maior `value` = mais importante (cortado por último)."""
+
+    __slots__ = ("section", "text", "value", "tokens", "payload")
+
+    def __init__(self, section: str, text: str, value: float, payload=None):
+        self.section = section
+        self.text = text
+        self.value = value
+        self.tokens = 0
+        self.payload = payload
+
+
+class TokenBudget:
+    def __init__(self, counter: TokenCounter, prompt_budget: int = PROMPT_TOKEN_BUDGET):
+        self.counter = counter
+        self.prompt_budget = prompt_budget
+
+    def fit(self, template: str, message: str, parts: list):
+        """
+        Ajusta o prompt ao orçamento. template é o prompt sem as partes nem a mensagem.
+        Retorna (mensagem, partes mantidas na ordem original, relatório de tokens por seção).
+        """
+        template_tokens = self.counter.count(template)
+        message_tokens = self.counter.count(message)
+        # A mensagem do usuário só é truncada se não couber nem sozinha
+        if template_tokens + message_tokens > self.prompt_budget:
+            message = self.counter.truncate(message, self.prompt_budget - template_tokens)
+            logger.warning(f"✂️ Mensagem truncada de {message_tokens} tokens para caber no orçamento do prompt.")
+            PROMPT_TRIMMED_TOKENS.labels(section="message").inc(message_tokens - self.counter.count(message))
+            message_tokens = self.counter.count(message)
+        available = self.prompt_budget - template_tokens - message_tokens
+
+        for part in parts:
+            part.tokens = self.counter.count(part.text)
+        report = {"template": template_tokens, "message": message_tokens, "trimmed": {}}
+        kept = sorted(parts, key=lambda part: part.value, reverse=True)
+        used = sum(part.tokens for part in kept)
+        while kept and used > available:
+            part = kept[-1]
+            overflow = used - available
+            if len(kept) == 1 and part.tokens - overflow >= MIN_TRUNCATED_PART_TOKENS:
+                # Última parte (a mais valiosa): truncada em vez de descartada
+                part.text = self.counter.truncate(part.text, part.tokens - overflow)
+                trimmed = part.tokens - self.counter.count(part.text)
+                part.tokens -= trimmed
+            else:
+                kept.pop()
+                trimmed = part.tokens
+            used -= trimmed
+            report["trimmed"][part.section] = report["trimmed"].get(part.section, 0) + trimmed
+            PROMPT_TRIMMED_TOKENS.labels(section=part.section).inc(trimmed)
+
+        kept_ids = {id(part) for part in kept}
+        kept = [part for part in parts if id(part) in kept_ids]
+        for part in kept:
+            report[part.section] = report.get(part.section, 0) + part.tokens
+        report["prompt"] = template_tokens + message_tokens + used
+        return message, kept, report
+
+
+class TokenLedger:
+    """Tokens de prompt e resposta por conversa (as mais recentes, até max_conversations)."""
+
+    def __init__(self, max_conversations: int = TOKEN_LEDGER_MAX_CONVERSATIONS):
+        self.max_conversations = max(1, max_conversations)
+        self._conversations = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record(self, conversation_id: str, kind: str, prompt_tokens: int, completion_tokens: int, cost: float = 0.0):
+        LLM_TOKENS.labels(kind=kind, type="prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(kind=kind, type="completion").inc(completion_tokens)
+        LLM_PROMPT_TOKENS.labels(kind=kind).observe(prompt_tokens)
+        with self._lock:
+            usage = self._conversations.pop(conversation_id, None) or {
+                "calls": 0, "prompt_tokens": 0, "completion_tokens": 0, "cost_usd": 0.0
+            }
+            usage["calls"] += 1
+            usage["prompt_tokens"] += prompt_tokens
+            usage["completion_tokens"] += completion_tokens
+            usage["cost_usd"] += cost
+            self._conversations[conversation_id] = usage
+            while len(self._conversations) > self.max_conversations:
+                self._conversations.popitem(last=False)
+
+    def usage(self, conversation_id: str):
+        with self._lock:
+            usage = self._conversations.get(conversation_id)
+            return dict(usage) if usage else None
+
+    def stats(self, top: int = 10) -> dict:
+        with self._lock:
+            conversations = list(self._conversations.items())
+        heaviest = sorted(conversations, key=lambda item: item[1]["prompt_tokens"] + item[1]["completion_tokens"],
+                          reverse=True)[:top]
+        return {
+            "conversations": len(conversations),
+            "prompt_tokens": sum(usage["prompt_tokens"] for _, usage in conversations),
+            "completion_tokens": sum(usage["completion_tokens"] for _, usage in conversations),
+            "top_conversations": {conversation_id: dict(usage) for conversation_id, usage in heaviest},
+        }
@@ -0,0 +1,392 @@
+"""
+Índice vetorial em processo (NumPy) como alternativa ao Chroma nas consultas do app.py.
+
+Os embeddings de uma versão da base são exportados para uma matriz float32 contígua e
+normalizada (embeddings.npy), aberta com memory-map: todos os workers do gunicorn
+compartilham as mesmas páginas do cache do sistema operacional. O top-k é um produto
+escalar vetorizado seguido de argpartition. Os textos e metadados ficam num JSONL com
+os offsets de cada linha, lidos só para os k resultados.
+
+Com VECTOR_INDEX_DTYPE=int8 (quantização escalar com uma escala por vetor), a varredura
+usa uma cópia quantizada da matriz, 4× menor, e só os melhores candidatos são reordenados
+com os vetores float32 exatos, lidos do disco sob demanda. O ganho é de memória (o que cada
+worker mantém no cache de páginas), não de CPU: a varredura int8 custa o mesmo que a float32.
+Não há opção float16: o NumPy não tem produto escalar nativo em float16 e a conversão de
+cada bloco deixava a varredura ~10× mais lenta que a exata.
+
+Selecionado com VECTOR_BACKEND=numpy (padrão: chroma).
+"""
+
+import os
+import json
+import uuid
+import shutil
+import logging
+from typing import Any, Optional
+
+import numpy as np
+import chromadb
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+logger = logging.getLogger(__name__)
+
+VECTOR_BACKEND = os.getenv('VECTOR_BACKEND', 'chroma').lower()
+VECTOR_BACKENDS = ('chroma', 'numpy')
+
+# Tipo da matriz varrida em cada consulta (a float32 exata fica sempre no disco para o rescoring)
+VECTOR_INDEX_DTYPE = os.getenv('VECTOR_INDEX_DTYPE', 'float32').lower()
+VECTOR_INDEX_DTYPES = ('float32', 'int8')
+# Candidatos reordenados com os vetores exatos = k × fator
+VECTOR_INDEX_RESCORE_FACTOR = int(os.getenv('VECTOR_INDEX_RESCORE_FACTOR', 10))
+# Linhas convertidas para float32 por vez ao varrer uma matriz quantizada (o bloco convertido,
+# ~1,5 MB com 1536 dimensões, cabe no cache L2/L3 e é reaproveitado entre os blocos)
+SCAN_BLOCK_ROWS = 256
+
+# Mesmo nome de coleção usado pelo wrapper Chroma do LangChain (ver kb_store.COLLECTION_NAME)
+COLLECTION_NAME = "langchain"
+
+INDEX_DIRNAME = "numpy_index"
+EMBEDDINGS_FILENAME = "embeddings.npy"
+QUANTIZED_FILENAME = "embeddings_{dtype}.npy"
+SCALES_FILENAME = "scales_int8.npy"
+OFFSETS_FILENAME = "offsets.npy"
+DOCUMENTS_FILENAME = "documents.jsonl"
+IDS_FILENAME = "ids.json"
+METADATA_COLUMNS_FILENAME = "metadata_columns.json"
+
+# Metadados usados em filtros de busca (ex.: {"tag": "precos"} ou {"source": "uploaded_files/catalogo.pdf"})
+FILTER_FIELDS = ("source", "tag")
+
+
+def index_directory_for(version_path: str) -> str:
+    return os.path.join(version_path, INDEX_DIRNAME)
+
+
+class DocumentStoreWriter:
+    """Grava os textos e metadados de um índice (JSONL + offsets de cada linha)."""
+
+    def __init__(self, directory: str, count: int):
+        self.directory = directory
+        self.offsets = np.zeros(count + 1, dtype=np.int64)
+        self.ids = []
+        self.columns = {field: [] for field in FILTER_FIELDS}
+        self.count = 0
+        self._file = open(os.path.join(directory, DOCUMENTS_FILENAME), "wb")
+
+    def add(self, chunk_id: str, text: str, metadata: dict):
+        self._file.write(json.dumps(
+            {"id": chunk_id, "document": text, "metadata": metadata or {}}, ensure_ascii=False
+        ).encode("utf-8") + b"\n")
+        self.ids.append(chunk_id)
+        for field, values in self.columns.items():
+            values.append((metadata or {}).get(field))
+        self.count += 1
+        self.offsets[self.count] = self._file.tell()
+
+    def close(self) -> int:
+        self._file.close()
+        np.save(os.path.join(self.directory, OFFSETS_FILENAME), self.offsets[:self.count + 1])
+        with open(os.path.join(self.directory, IDS_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(self.ids, f)
+        with open(os.path.join(self.directory, METADATA_COLUMNS_FILENAME), "w", encoding="utf-8") as f:
+            json.dump(self.columns, f, ensure_ascii=False)
+        return self.count
+
+
+class DocumentStore:
+    """Leitura por posição dos registros gravados pelo DocumentStoreWriter."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self._positions = None
+        self._columns = None
+        self._masks = {}
+        self.offsets = np.load(os.path.join(directory, OFFSETS_FILENAME), mmap_mode="r")
+        # os.pread não usa a posição do arquivo, então o descritor pode ser usado por várias threads
+        self._fd = os.open(os.path.join(directory, DOCUMENTS_FILENAME), os.O_RDONLY)
+
+    def record(self, position: int) -> dict:
+        """Registro {"id", "document", "metadata"} de uma posição."""
+        start, end = int(self.offsets[position]), int(self.offsets[position + 1])
+        return json.loads(os.pread(self._fd, end - start, start))
+
+    def position_of(self, chunk_id: str):
+        """Posição de um chunk pelo ID (o mapa é carregado na primeira chamada)."""
+        if self._positions is None:
+            ids_path = os.path.join(self.directory, IDS_FILENAME)
+            if os.path.exists(ids_path):
+                with open(ids_path, "r", encoding="utf-8") as f:
+                    ids = json.load(f)
+            else:
+                # Índices gerados antes do ids.json
+                ids = [self.record(position)["id"] for position in range(len(self.offsets) - 1)]
+            self._positions = {chunk_id: position for position, chunk_id in enumerate(ids)}
+        return self._positions.get(chunk_id)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def filter_mask(self, metadata_filter: dict = None):
+        """
+        Máscara booleana das posições cujos metadados batem com todos os pares do filtro
+        (None = sem filtro). As máscaras ficam em cache por filtro.
+        """
+        if not metadata_filter:
+            return None
+        key = tuple(sorted(metadata_filter.items()))
+        mask = self._masks.get(key)
+        if mask is None:
+            if self._columns is None:
+                self._columns = self._load_columns()
+            mask = np.ones(len(self), dtype=bool)
+            for field, value in key:
+                column = self._columns.get(field)
+                if column is None:
+                    column = self._columns[field] = [self.record(p)["metadata"].get(field) for p in range(len(self))]
+                mask &= np.fromiter((item == value for item in column), dtype=bool, count=len(self))
+            self._masks[key] = mask
+        return mask
+
+    def _load_columns(self) -> dict:
+        path = os.path.join(self.directory, METADATA_COLUMNS_FILENAME)
+        if not os.path.exists(path):
+            return {}  # Índices gerados antes do metadata_columns.json: colunas lidas dos registros
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def document(self, position: int, score: float = None) -> Document:
+        record = self.record(position)
+        metadata = dict(record["metadata"])
+        if score is not None:
+            metadata["score"] = score
+        return Document(id=record["id"], page_content=record["document"], metadata=metadata)
+
+    def close(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+        self.offsets = None
+
+    def __del__(self):
+        self.close()
+
+
+def _chroma_pages(collection, count: int, page_size: int):
+    for offset in range(0, count, page_size):
+        page = collection.get(include=["embeddings", "documents", "metadatas"], limit=page_size, offset=offset)
+        yield page["ids"], page["embeddings"], page["documents"], page["metadatas"]
+
+
+def write_numpy_index(index_directory: str, pages, count: int, dimension: int, dtype: str = VECTOR_INDEX_DTYPE) -> str:
+    """
+    Grava um índice a partir de páginas (ids, vetores, textos, metadados), sem manter a
+    matriz inteira em memória. A escrita é feita num diretório temporário e trocada no final.
+    """
+    tmp_directory = f"{index_directory}.tmp-{uuid.uuid4().hex[:8]}"
+    os.makedirs(tmp_directory)
+    try:
+        matrix = np.lib.format.open_memmap(
+            os.path.join(tmp_directory, EMBEDDINGS_FILENAME), mode="w+", dtype=np.float32, shape=(count, dimension)
+        )
+        writer = DocumentStoreWriter(tmp_directory, count)
+        row = 0
+        for ids, embeddings, documents, metadatas in pages:
+            vectors = np.asarray(embeddings, dtype=np.float32)
+            norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+            matrix[row:row + len(vectors)] = vectors / np.maximum(norms, 1e-12)
+            row += len(vectors)
+            for chunk_id, text, metadata in zip(ids, documents, metadatas):
+                writer.add(chunk_id, text, metadata)
+        matrix.flush()
+        del matrix
+        if writer.close() != count or row != count:
+            raise ValueError(f"exportados {row} de {count} chunks")
+        quantize_index(tmp_directory, dtype)
+
+        # Troca pelo índice anterior (ex.: copiado junto com a versão atual); se outro processo
+        # publicou o mesmo índice ao mesmo tempo, o dele é mantido.
+        shutil.rmtree(index_directory, ignore_errors=True)
+        try:
+            os.rename(tmp_directory, index_directory)
+        except OSError:
+            if not os.path.isdir(index_directory):
+                raise
+    finally:
+        shutil.rmtree(tmp_directory, ignore_errors=True)
+    return index_directory
+
+
+def quantize_index(index_directory: str, dtype: str = VECTOR_INDEX_DTYPE):
+    """
+    Gera a cópia quantizada da matriz exata de um índice, bloco a bloco.
+    Escala por vetor (max|v|/127): a aproximação do score é (q · x) × escala.
+    """
+    if dtype not in VECTOR_INDEX_DTYPES:
+        raise ValueError(f"VECTOR_INDEX_DTYPE inválido: '{dtype}' (opções: {', '.join(VECTOR_INDEX_DTYPES)})")
+    if dtype == "float32":
+        return
+    matrix = np.load(os.path.join(index_directory, EMBEDDINGS_FILENAME), mmap_mode="r")
+    quantized_path = os.path.join(index_directory, QUANTIZED_FILENAME.format(dtype=dtype))
+    tmp_path = f"{quantized_path}.tmp-{uuid.uuid4().hex[:8]}.npy"
+    quantized = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.dtype(dtype), shape=matrix.shape)
+    scales = np.ones(matrix.shape[0], dtype=np.float32)
+    for start in range(0, matrix.shape[0], SCAN_BLOCK_ROWS):
+        block = np.asarray(matrix[start:start + SCAN_BLOCK_ROWS])
+        block_scales = np.maximum(np.abs(block).max(axis=1), 1e-12) / 127.0
+        quantized[start:start + len(block)] = np.rint(block / block_scales[:, None]).astype(np.int8)
+        scales[start:start + len(block)] = block_scales
+    quantized.flush()
+    del quantized
+    scales_path = os.path.join(index_directory, SCALES_FILENAME)
+    scales_tmp_path = f"{scales_path}.tmp-{uuid.uuid4().hex[:8]}.npy"
+    np.save(scales_tmp_path, scales)
+    os.replace(scales_tmp_path, scales_path)
+    os.replace(tmp_path, quantized_path)
+
+
+def build_numpy_index(version_path: str, page_size: int = 1000, dtype: str = VECTOR_INDEX_DTYPE) -> str:
+    """
+    Exporta a coleção do Chroma de uma versão para o índice NumPy, página a página.
+    Retorna o diretório do índice.
+    """
+    collection = chromadb.PersistentClient(path=version_path).get_collection(COLLECTION_NAME)
+    count = collection.count()
+    sample = collection.peek(limit=1).get("embeddings")
+    if count == 0 or sample is None or len(sample) == 0:
+        raise ValueError("a coleção está vazia")
+    dimension = len(sample[0])
+
+    index_directory = write_numpy_index(
+        index_directory_for(version_path), _chroma_pages(collection, count, page_size), count, dimension, dtype
+    )
+    logger.info(f"🧮 Índice NumPy ({dtype}) gerado em {index_directory} ({count} × {dimension}).")
+    return index_directory
+
+
+class NumpyVectorIndex:
+    """
+    Busca por similaridade de cosseno sobre a matriz memory-mapped de uma versão: exata em
+    float32, ou varredura quantizada (int8) com rescoring exato dos candidatos.
+    """
+
+    def __init__(self, index_directory: str, dtype: str = VECTOR_INDEX_DTYPE,
+                 rescore_factor: int = VECTOR_INDEX_RESCORE_FACTOR):
+        if dtype not in VECTOR_INDEX_DTYPES:
+            raise ValueError(f"VECTOR_INDEX_DTYPE inválido: '{dtype}' (opções: {', '.join(VECTOR_INDEX_DTYPES)})")
+        self.matrix = np.load(os.path.join(index_directory, EMBEDDINGS_FILENAME), mmap_mode="r")
+        self.dtype = dtype
+        self.rescore_factor = max(1, rescore_factor)
+        self.quantized = None
+        self.scales = None
+        if dtype != "float32":
+            quantized_path = os.path.join(index_directory, QUANTIZED_FILENAME.format(dtype=dtype))
+            if not os.path.exists(quantized_path):
+                # Índice gerado com outro VECTOR_INDEX_DTYPE
+                quantize_index(index_directory, dtype)
+            self.quantized = np.load(quantized_path, mmap_mode="r")
+            self.scales = np.load(os.path.join(index_directory, SCALES_FILENAME))
+        self.documents = DocumentStore(index_directory)
+
+    @classmethod
+    def open(cls, version_path: str, build_if_missing: bool = True, **kwargs) -> "NumpyVectorIndex":
+        """Abre o índice da versão, gerando-o a partir do Chroma se ainda não existir (versões antigas)."""
+        index_directory = index_directory_for(version_path)
+        if not os.path.isdir(index_directory):
+            if not build_if_missing:
+                raise FileNotFoundError(f"índice NumPy ausente em '{version_path}'")
+            build_numpy_index(version_path, dtype=kwargs.get("dtype", VECTOR_INDEX_DTYPE))
+        return cls(index_directory, **kwargs)
+
+    def __len__(self):
+        return self.matrix.shape[0]
+
+    @property
+    def dimension(self) -> int:
+        return self.matrix.shape[1]
+
+    @property
+    def scan_bytes(self) -> int:
+        """Bytes varridos por consulta (o que cada worker mantém quente no cache de páginas)."""
+        if self.quantized is None:
+            return self.matrix.nbytes
+        return self.quantized.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def close(self):
+        """Solta os memory-maps (desmapeados quando a última referência some) e o arquivo dos textos."""
+        self.documents.close()
+        self.matrix = self.quantized = self.scales = None
+
+    def search(self, query_vector, k: int = 3, metadata_filter: dict = None):
+        """
+        Retorna [(posição, similaridade)] dos k vetores mais próximos, em ordem decrescente.
+        metadata_filter restringe a busca aos chunks com esses metadados (ver FILTER_FIELDS).
+        """
+        mask = self.documents.filter_mask(metadata_filter)
+        allowed = len(self) if mask is None else int(mask.sum())
+        k = min(k, allowed)
+        if k <= 0:
+            return []
+        query = np.asarray(query_vector, dtype=np.float32)
+        query = query / max(float(np.linalg.norm(query)), 1e-12)
+        if self.quantized is None:
+            scores = self.matrix @ query
+            if mask is not None:
+                scores = np.where(mask, scores, -np.inf)
+            top = top_k(scores, k)
+            return [(int(position), float(scores[position])) for position in top]
+
+        # Varredura aproximada na matriz quantizada e rescoring exato dos candidatos
+        approximate = self.approximate_scores(query)
+        if mask is not None:
+            approximate[~mask] = -np.inf
+        candidates = top_k(approximate, min(allowed, k * self.rescore_factor))
+        candidates = np.sort(candidates)  # leitura sequencial das linhas exatas no memory-map
+        exact = self.matrix[candidates] @ query
+        order = top_k(exact, k)
+        return [(int(candidates[i]), float(exact[i])) for i in order]
+
+    def approximate_scores(self, query):
+        """Scores de todos os vetores na matriz int8, convertendo um bloco de linhas por vez num buffer reaproveitado."""
+        scores = np.empty(len(self), dtype=np.float32)
+        buffer = np.empty((SCAN_BLOCK_ROWS, self.dimension), dtype=np.float32)
+        for start in range(0, len(self), SCAN_BLOCK_ROWS):
+            block = self.quantized[start:start + SCAN_BLOCK_ROWS]
+            converted = buffer[:len(block)]
+            np.copyto(converted, block, casting="unsafe")
+            np.dot(converted, query, out=scores[start:start + len(block)])
+        scores *= self.scales
+        return scores
+
+    def record(self, position: int) -> dict:
+        """Registro {"id", "document", "metadata"} de uma posição da matriz."""
+        return self.documents.record(position)
+
+    def vectors_for_ids(self, ids):
+        """Vetores exatos (normalizados) dos chunks pelo ID; None para IDs desconhecidos."""
+        positions = [self.documents.position_of(chunk_id) for chunk_id in ids]
+        return [self.matrix[position] if position is not None else None for position in positions]
+
+    def similarity_search_by_vector(self, query_vector, k: int = 3, metadata_filter: dict = None):
+        return [
+            self.documents.document(position, score)
+            for position, score in self.search(query_vector, k, metadata_filter)
+        ]
+
+
+def top_k(scores, k: int):
+    """Posições dos k maiores scores, em ordem decrescente (argpartition + ordenação só dos k)."""
+    top = np.argpartition(-scores, k - 1)[:k]
+    return top[np.argsort(-scores[top])]
+
+
+class NumpyRetriever(BaseRetriever):
+    """Retriever do LangChain sobre o NumpyVectorIndex (usado pelo RetrievalQA do app.py)."""
+
+    index: Any
+    embeddings: Any
+    k: int = 3
+    metadata_filter: Optional[dict] = None
+
+    def _get_relevant_documents(self, query: str, *, run_manager=None):
+        return self.index.similarity_search_by_vector(self.embeddings.embed_query(query), self.k, self.metadata_filter)
@@ -0,0 +1,133 @@
+"""
+Leitura dos webhooks da MEGA API num registro único.
+
+Todos os tipos de evento (conversation, extendedTextMessage, textMessage, mídias e
+atualizações de status) viram um InboundMessage numa única passada sobre o JSON,
+decodificado com orjson direto dos bytes da requisição. O webhook() só decide o que fazer
+com o registro pelo `kind`:
+
+- "text": texto do cliente, vai para a IA;
+- "media": imagem, áudio, vídeo, documento ou figurinha (a legenda, se houver, fica em text);
+- "status": confirmação de entrega/leitura ou outro evento sem mensagem;
+- "ignored": mensagem própria (fromMe), sem remetente ou de tipo desconhecido.
+
+Microbenchmark com os exemplos de fixtures/mega_webhooks.json: `python benchmarks.py webhook-parser`.
+"""
+
+import orjson
+
+KIND_TEXT = "text"
+KIND_MEDIA = "media"
+KIND_STATUS = "status"
+KIND_IGNORED = "ignored"
+
+# messageType → campo de message com o texto (None: o próprio valor é o texto)
+TEXT_TYPES = {
+    "conversation": None,
+    "extendedTextMessage": "text",
+    "textMessage": "text",
+}
+# messageType → tipo de mídia
+MEDIA_TYPES = {
+    "imageMessage": "image",
+    "audioMessage": "audio",
+    "videoMessage": "video",
+    "documentMessage": "document",
+    "documentWithCaptionMessage": "document",
+    "stickerMessage": "sticker",
+}
+STATUS_TYPES = frozenset(("message.ack", "messages.update", "messageStatus", "message_status", "status"))
+DEFAULT_SENDER_NAME = "Usuário"
+
+
+class InboundMessage:
+    """Evento do webhook normalizado. Campos que não se aplicam ao tipo ficam None."""
+
+    __slots__ = (
+        "kind", "message_type", "instance", "jid", "message_id", "from_me", "sender", "timestamp",
+        "text", "media_type", "media_url", "mimetype", "file_name", "file_length", "media_key", "status",
+    )
+
+    def __init__(self, kind: str, message_type: str = None, instance: str = None, jid: str = None,
+                 message_id: str = None, from_me: bool = False, sender: str = None, timestamp: int = None):
+        self.kind = kind
+        self.message_type = message_type
+        self.instance = instance
+        self.jid = jid
+        self.message_id = message_id
+        self.from_me = from_me
+        self.sender = sender
+        self.timestamp = timestamp
+        self.text = None
+        self.media_type = None
+        self.media_url = None
+        self.mimetype = None
+        self.file_name = None
+        self.file_length = None
+        self.media_key = None
+        self.status = None
+
+    def __repr__(self):
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__ if getattr(self, name) is not None)
+        return f"InboundMessage({fields})"
+
+
+def parse_webhook(body: bytes) -> InboundMessage:
+    """Bytes da requisição → InboundMessage. ValueError se não for um objeto JSON."""
+    data = orjson.loads(body)
+    if not isinstance(data, dict):
+        raise ValueError("o webhook deve ser um objeto JSON")
+    return parse_event(data)
+
+
+def parse_event(data: dict) -> InboundMessage:
+    key = data.get("key") or {}
+    message = data.get("message") or {}
+    message_type = data.get("messageType")
+    if message_type is None and message:
+        # Alguns eventos trazem só o conteúdo: o tipo é a primeira chave de message
+        message_type = next(iter(message))
+
+    record = InboundMessage(
+        KIND_IGNORED,
+        message_type=message_type,
+        instance=data.get("instance_key") or data.get("instanceKey") or data.get("instance"),
+        jid=key.get("remoteJid") or data.get("jid"),
+        message_id=key.get("id") or data.get("id"),
+        from_me=bool(key.get("fromMe", False)),
+        sender=data.get("pushName") or DEFAULT_SENDER_NAME,
+        timestamp=data.get("messageTimestamp"),
+    )
+
+    if message_type in STATUS_TYPES or (not message and "status" in data):
+        record.kind = KIND_STATUS
+        update = data.get("update") or {}
+        record.status = data.get("status") or update.get("status")
+        return record
+    if record.from_me or not record.jid:
+        return record
+
+    if message_type in TEXT_TYPES:
+        field = TEXT_TYPES[message_type]
+        content = message.get(message_type)
+        if field is not None:
+            # extendedTextMessage: {"text": ...}; textMessage às vezes vem como message.text
+            content = content.get(field) if isinstance(content, dict) else message.get(field)
+        if isinstance(content, str) and content.strip():
+            record.kind = KIND_TEXT
+            record.text = content
+        return record
+
+    if message_type in MEDIA_TYPES:
+        media = message.get(message_type) or {}
+        if message_type == "documentWithCaptionMessage":
+            media = ((media.get("message") or {}).get("documentMessage")) or media
+        record.kind = KIND_MEDIA
+        record.media_type = MEDIA_TYPES[message_type]
+        record.text = media.get("caption") or None
+        record.media_url = media.get("url")
+        record.mimetype = media.get("mimetype")
+        record.file_name = media.get("fileName")
+        record.file_length = media.get("fileLength")
+        record.media_key = media.get("mediaKey")
+    return record